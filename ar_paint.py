@@ -1,11 +1,40 @@
 #!/usr/bin/python3
-import math
+import time
+
+# Start of the program, to measure the time to the first frame
+STARTED = time.perf_counter()
+
+import os
+from collections import deque
 
 from colorama import Fore, Back, Style
+from canvas import Canvas
+from capture import FrameGrabber
+from color_model import MarkerModel, createModel, loadModel
+from display import RenderScheduler
+from history import History
+from lighting import LightingCompensator
+from strokes import StrokeList
 from my_functions import *
-from time import ctime
-import json
+from persistence import CanvasFile, SnapshotWriter
+from pipeline import SegmentationPipeline
+from profiler import NullProfiler, Profiler
+from puzzle import COLORS, loadPuzzle
+from scoring import ProgressScorer
+from smoothing import StrokeSmoother
+from recording import RecordingCapture, SessionReader, SessionRecorder
+from tracker import BlobTracker, MarkerTracker
 import argparse
+import hashlib
+import json
+
+# Arguments that change the result of a session, saved in the recordings to replay them in the same way
+RECORDED_ARGUMENTS = ['use_shake_prevention', 'use_numeric_painting', 'puzzle', 'history_budget',
+                      'full_frame_tracking', 'segmentation_scale', 'refine_radius', 'adaptive_lighting', 'mask_open',
+                      'mask_close', 'smoothing_cutoff', 'smoothing_beta', 'fps']
+
+# Mouse events received since the last frame, kept to record the session
+mouse_events = []
 
 
 def onMouse(event, x, y, flags, param):
@@ -14,6 +43,8 @@ def onMouse(event, x, y, flags, param):
     """
     global ispressed, center_mouse
 
+    mouse_events.append((event, x, y, flags))
+
     if event == cv2.EVENT_MOUSEMOVE:
         if ispressed:
             center_mouse = (x, y)
@@ -27,53 +58,175 @@ def onMouse(event, x, y, flags, param):
         center_mouse = None
 
 
+def drawProgress(painted_shown, painted_image, progress):
+    """
+        Writes the live score on a copy of the painted image.
+    """
+    np.copyto(painted_shown, painted_image)
+    text = 'Accuracy: %.1f %%  Coverage: %.1f %%' % (100 * progress['accuracy'], 100 * progress['coverage'])
+    if progress['last_region'] is not None:
+        text += '  Region %d: %.0f %% done' % (progress['last_region'],
+                                              100 * progress['regions'][progress['last_region']]['accuracy'])
+    cv2.putText(painted_shown, text, (10, painted_shown.shape[0] - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 0), 2,
+                cv2.LINE_AA)
+
+    return painted_shown
+
+
 def main():
     # Initialization
 
-    global center_mouse, ispressed, cache, blank_original
+    global center_mouse, ispressed
 
     # Variables set up
     center_prev = (200, 200)
     color = (255, 0, 0)
     color_str = 'BLUE'
     size = 6
-    cache = None
     start_point = None
     center_mouse = (200, 200)
     center_prev_mouse = (200, 200)
     ispressed = False
     mouse_painting = True
     start_point_mouse = None
-    cache_mouse = None
-    listmouse = []
+    # Only the last two keys and mouse positions are needed, to know if a shape is starting
+    listmouse = deque([None, None], maxlen=2)
     real_frame = False
-    listkeys = []
+    listkeys = deque([-1, -1], maxlen=2)
     limit = 50
-
-    # Webcam video capture
-    capture = cv2.VideoCapture(0)  # Camera 0 selected
-    ret, frame = capture.read()
+    # With several markers: last centre of each pointer, and its smoother and marker with shake prevention, by
+    # pointer id
+    pointers_prev = {}
+    smoothers = {}
 
     # Create argparse
     ap = argparse.ArgumentParser(description='Paint on Augmented Reality')
-    ap.add_argument('-j', '--json', required=True, help="Input json file path")
+    ap.add_argument('-j', '--json', help="Input json file path")
     ap.add_argument('-usp', '--use_shake_prevention', action='store_true',
-                    help='Select this option to use shake prevention.')
+                    help='Select this option to use shake prevention: the strokes are filtered and smoothed, and '
+                         'jumps of the marker in a single frame are not painted.')
+    ap.add_argument('-sc', '--smoothing_cutoff', type=float, default=1.0,
+                    help='Cutoff frequency (Hz) of the shake prevention filter when the marker is still. Lower is '
+                         'smoother.')
+    ap.add_argument('-sb', '--smoothing_beta', type=float, default=0.02,
+                    help='How fast the shake prevention filter follows fast strokes. Higher has less lag.')
     ap.add_argument('-unp', '--use_numeric_painting', action='store_true',
                     help='Select this option to use numeric painting.')
+    ap.add_argument('-pz', '--puzzle', help='Prefix of a numbered image generated by puzzle.py, to use in numeric '
+                                            'painting instead of imagem_numerada.png.')
+    ap.add_argument('--workers', type=int, default=2,
+                    help='Number of threads used to segment frames in parallel.')
+    ap.add_argument('-hb', '--history_budget', type=float, default=16,
+                    help='Memory in MB used to keep the strokes that can be undone.')
+    ap.add_argument('-se', '--session', help='Session file (.npz) with the strokes. It is loaded at the start if it '
+                                            'exists, and saved when "w" is pressed and when the program closes.')
+    ap.add_argument('-cf', '--canvas_file', help='Memory-mapped file with the pixels of the canvas, reused when the '
+                                                 'program starts again (also after a crash). The strokes are not kept '
+                                                 'in it, use --session for them.')
+    ap.add_argument('-as', '--autosave', type=float, default=5,
+                    help='Interval in seconds at which the changes of the canvas file are written to the disk '
+                         '(0 only writes them when the program closes).')
+    ap.add_argument('-fft', '--full_frame_tracking', action='store_true',
+                    help='Select this option to label the whole mask on every frame instead of tracking the blob.')
+    ap.add_argument('-ss', '--segmentation_scale', type=float, default=1,
+                    help='Resolution scale used to segment the frames, e.g. 0.5 or 0.25.')
+    ap.add_argument('-rr', '--refine_radius', type=int, default=0,
+                    help='Radius in pixels of the window used to refine the centroid at full resolution. '
+                         'Only used with a segmentation scale below 1.')
+    ap.add_argument('-al', '--adaptive_lighting', action='store_true',
+                    help='Follow the changes of illumination, scaling the limits to them. The reference is the '
+                         '"illumination" saved in the json by color_segmenter, or the first frames.')
+    ap.add_argument('-mo', '--mask_open', type=int, default=0,
+                    help='Size in pixels of the opening that removes speckles from the mask before it is labelled '
+                         '(0 for none).')
+    ap.add_argument('-mc', '--mask_close', type=int, default=0,
+                    help='Size in pixels of the closing that fills holes in the mask before it is labelled (0 for none).')
+    ap.add_argument('-cr', '--canvas_rate', type=float, default=60,
+                    help='Maximum rate (frames per second) at which the canvas window is shown, 0 for every frame.')
+    ap.add_argument('-dr', '--debug_rate', type=float, default=10,
+                    help='Maximum rate at which the Original, Mask, MaxArea and Painted Image windows are shown. '
+                         'Tracking and painting still run at the rate of the camera.')
+    ap.add_argument('-sv', '--server', help='Address (host:port or Unix socket path) of a canvas server started with '
+                                            'canvas_server.py serve, to share the strokes with other stations.')
+    ap.add_argument('-rec', '--record', help='Record the camera frames, keys and mouse events to this file.')
+    ap.add_argument('-rep', '--replay', help='Replay a recorded session without camera or windows, as fast as '
+                                             'possible. The limits and options of the recording are used.')
+    ap.add_argument('-rt', '--realtime', action='store_true',
+                    help='Replay the recording at the speed it was recorded.')
+    ap.add_argument('-o', '--output', help='When replaying, save the final canvas to this image file.')
+    ap.add_argument('-prof', '--profile', action='store_true',
+                    help='Time each stage of the loop and show the fps and milliseconds on the Original window.')
+    ap.add_argument('--trace', help='Save the timings of every stage to this Chrome trace / Perfetto json file '
+                                    '(implies --profile).')
     args = vars(ap.parse_args())
-
-    # Open the JSON file
-    with open(args['json']) as file_handle:
-        # returns JSON object as a dictionary
-        limits = json.load(file_handle)
-
-    # Define shake prevention
+    if args['json'] is None and args['replay'] is None:
+        ap.error('the following arguments are required: -j/--json')
+
+    reader = None
+    recorder = None
+    camera = None
+    if args['replay'] is not None:
+        # Replay: frames, keys, mouse, limits and options come from the recording
+        reader = SessionReader(args['replay'], realtime=args['realtime'])
+        args.update(reader.header['args'])
+        limits = createModel(json.loads(reader.header['limits']))
+        capture = reader
+        print(Back.GREEN + 'Replaying ' + args['replay'] + Back.RESET)
+    else:
+        # Webcam video capture, running in its own thread. The camera opens in the background while the model is
+        # loaded and the windows are created
+        camera = FrameGrabber(0)  # Camera 0 selected
+        capture = camera
+
+        # Open the JSON file and compile it into a colour model, of one or several markers (the lookup table is cached
+        # on disk)
+        limits = loadModel(args['json'])
+
+        cv2.namedWindow('Canvas', cv2.WINDOW_AUTOSIZE)
+        cv2.namedWindow('Original', cv2.WINDOW_AUTOSIZE)
+        cv2.namedWindow('Mask', cv2.WINDOW_AUTOSIZE)
+        cv2.namedWindow('MaxArea', cv2.WINDOW_AUTOSIZE)
+
+        # Nominal frame rate of the camera, the time step of the stroke smoothing (known once the camera is open)
+        args['fps'] = camera.get(cv2.CAP_PROP_FPS) or 30
+
+        if args['record'] is not None:
+            with open(args['json']) as file_handle:
+                header = {'args': {name: args[name] for name in RECORDED_ARGUMENTS}, 'limits': file_handle.read()}
+            recorder = SessionRecorder(args['record'], header)
+            capture = RecordingCapture(capture, recorder)
+            print(Back.RED + 'Recording to ' + args['record'] + Back.RESET)
+
+    # Adaptive lighting: the model follows the illumination of the frames
+    if args.get('adaptive_lighting'):
+        limits.lighting = LightingCompensator(reference=limits.limits.get('illumination'))
+        print(Back.BLUE + 'Adaptive lighting is on.' + Back.RESET)
+
+    # Without windows (replay), nothing is shown
+    headless = reader is not None
+
+    # The first frame gives the size of the canvas
+    ret, frame = capture.read()
+    if not ret:
+        reason = camera.error if camera is not None and camera.error is not None else 'no frames'
+        print(Back.RED + 'ERROR!' + Back.RESET + Fore.RED + ' Camera is off: ' + reason + Fore.RESET)
+        capture.release()
+        if recorder is not None:
+            recorder.close()
+        cv2.destroyAllWindows()
+        return
+    if camera is not None:
+        print('First frame after ' + str(round(1000 * (time.perf_counter() - STARTED))) + ' ms')
+
+    # Define shake prevention. Recordings made before the frame rate was saved were smoothed at 30 fps
+    def newSmoother():
+        return StrokeSmoother(fps=args.get('fps') or 30, min_cutoff=args['smoothing_cutoff'],
+                              beta=args['smoothing_beta'], max_jump=limit)
+
+    smoother = None
     if args['use_shake_prevention']:  # if the user uses the shake prevention
         print(Fore.BLUE + Back.WHITE + 'You are using shake prevention.' + Style.RESET_ALL)
-        shake_prevention = 1
-    else:
-        shake_prevention = 0
+        smoother = newSmoother()
 
     if capture.isOpened() is True:
 
@@ -97,7 +250,9 @@ def main():
             ' to save the current canvas to a .png file \nPress ' + Fore.LIGHTYELLOW_EX + '"c"' + Style.RESET_ALL +
             ' to clear the canvas. \nPress ' + Fore.LIGHTYELLOW_EX + '"q"' + Style.RESET_ALL +
             ' to quit the program.\n\nPress and hold ' + Fore.LIGHTYELLOW_EX + '"s"' + Style.RESET_ALL +
-            ' to draw a rectangle \nPress and hold ' + Fore.LIGHTYELLOW_EX + '"o"' + Style.RESET_ALL + ' to draw a circle'
+            ' to draw a rectangle \nPress and hold ' + Fore.LIGHTYELLOW_EX + '"o"' + Style.RESET_ALL + ' to draw a circle' +
+            '\n\nPress ' + Fore.LIGHTYELLOW_EX + '"z"' + Style.RESET_ALL + ' to undo the last stroke \nPress ' +
+            Fore.LIGHTYELLOW_EX + '"y"' + Style.RESET_ALL + ' to redo it'
         )
     else:
         print(Back.RED + "WARNING!" + Back.RESET + Fore.RED + " Camera is off" + Fore.RESET)
@@ -105,59 +260,153 @@ def main():
     # Create white canvas
     window_width = frame.shape[1]
     window_height = frame.shape[0]
-    blank_image = 255 * np.ones(shape=[window_height, window_width, 3], dtype=np.uint8)
+    canvas_file = None
+    if args['canvas_file'] is not None:
+        # The canvas is drawn directly on the mapped file, which keeps it if the program crashes
+        try:
+            canvas_file = CanvasFile(args['canvas_file'], window_width, window_height)
+        except ValueError as error:
+            print(Back.RED + 'ERROR!' + Back.RESET + Fore.RED + ' ' + str(error) + ', it is not overwritten.' +
+                  Fore.RESET)
+            capture.release()
+            if recorder is not None:
+                recorder.close()
+            cv2.destroyAllWindows()
+            return
+        canvas = Canvas(window_width, window_height, image=canvas_file.image)
+        canvas_file.watch(canvas)
+        if args['autosave'] > 0:
+            canvas_file.start(args['autosave'])
+        if canvas_file.resumed:
+            print('Canvas resumed from ' + Fore.BLUE + args['canvas_file'] + Style.RESET_ALL)
+        elif canvas_file.backup is not None:
+            print(Fore.YELLOW + 'The canvas in ' + args['canvas_file'] + ' had another size: it was moved to ' +
+                  canvas_file.backup + ' and its pixels scaled to the new canvas' + Style.RESET_ALL)
+    else:
+        canvas = Canvas(window_width, window_height)
+
+    # The PNG images are encoded in the background, so saving does not stop the frames
+    snapshots = SnapshotWriter()
+
+    # Continue a saved session
+    if args['session'] is not None and os.path.exists(args['session']):
+        canvas.load(StrokeList.load(args['session']))
+        print('Session loaded from ' + Fore.BLUE + args['session'] + Style.RESET_ALL)
+
+    # Undo and redo of the strokes, keeping only the tiles they changed
+    history = History(canvas, budget=int(args['history_budget'] * 1024 * 1024))
+
+    # Share the strokes with a canvas server (see canvas_server.py)
+    canvas_client = None
+    if args['server'] is not None:
+        # Imported only when sharing, with the networking modules
+        from canvas_server import CanvasClient
+        try:
+            canvas_client = CanvasClient(args['server'], canvas)
+            print(Back.BLUE + 'Sharing the canvas with ' + args['server'] + Back.RESET)
+        except OSError as error:
+            print(Back.RED + 'ERROR!' + Back.RESET + Fore.RED + ' Could not reach the canvas server ' + args['server'] +
+                  ': ' + str(error) + '. Painting without sharing.' + Fore.RESET)
 
     # Setup for numeric paint
     if args['use_numeric_painting']:
         # Print
         print(Back.GREEN + '\nAR_PAINT opened' + Back.RESET)
 
-        painted_image = cv2.imread('./imagem_pintada.png')
-        image_to_paint = cv2.imread('./imagem_numerada.png')
+        # The regions of the numbered image, to score the painting region by region, updated with every stroke.
+        # A generated puzzle has them saved with the images, and the colour of each of them
+        if args['puzzle'] is not None:
+            image_to_paint, painted_image, regions, region_colors = loadPuzzle(args['puzzle'])
+            colors = COLORS[region_colors]
+        else:
+            painted_image = cv2.imread('./imagem_pintada.png')
+            image_to_paint = cv2.imread('./imagem_numerada.png')
+            _, regions = findFormsCentroids(image_to_paint)
+            colors = None
+        scorer = ProgressScorer(painted_image, regions, canvas, colors=colors)
+        painted_shown = painted_image.copy()
 
-        l = combine(blank_image, image_to_paint)
+        l = combine(canvas.image, image_to_paint)
 
-        cv2.imshow('Canvas', l)
+        if not headless:
+            cv2.imshow('Canvas', l)
         # Print to the user which color should he print in it index
         print('\nColor index 1 corresponds to ' + Fore.BLUE + 'blue ' + Fore.RESET + 'color.')
         print('Color index 2 corresponds to ' + Fore.GREEN + 'green ' + Fore.RESET + 'color.')
         print('Color index 3 corresponds to ' + Fore.RED + 'red' + Fore.RESET + 'color.')
         print('Color index 4 corresponds to ' + Fore.YELLOW + 'yellow ' + Fore.RESET + 'color.')
-        print('Press the space bar to finish and see your evaluation...\n')
+        print('Press the space bar to finish and see your evaluation. The live score is on the Painted Image '
+              'window...\n')
 
         # Defining the window and showing the painted image
-        name = 'Painted Image'
-        cv2.namedWindow(name, cv2.WINDOW_AUTOSIZE)
-        cv2.imshow(name, painted_image)
+        if not headless:
+            name = 'Painted Image'
+            cv2.namedWindow(name, cv2.WINDOW_AUTOSIZE)
+            cv2.imshow(name, painted_image)
 
+    if not headless:
+        cv2.imshow('Canvas', canvas.image)
 
-    cv2.namedWindow('Canvas', cv2.WINDOW_AUTOSIZE)
-    cv2.namedWindow('Original', cv2.WINDOW_AUTOSIZE)
-    cv2.namedWindow('Mask', cv2.WINDOW_AUTOSIZE)
-    cv2.namedWindow('MaxArea', cv2.WINDOW_AUTOSIZE)
-    cv2.namedWindow('Canvas', cv2.WINDOW_AUTOSIZE)
-    cv2.imshow('Canvas', blank_image)
+        # Defining mouse callback
+        cv2.setMouseCallback("Canvas", onMouse)
 
-    # Defining mouse callback
-    cv2.setMouseCallback("Canvas", onMouse)
+    # The canvas is shown at the rate of the display, the debug windows less often
+    display = RenderScheduler({'Canvas': args['canvas_rate']}, default_rate=args['debug_rate'])
 
-    # Execute
-    while capture.isOpened():
-        # Get and show frames from camera
-        ret, frame = capture.read()
-        frame = cv2.flip(frame, 1)
-
-        # Create original mask
-        mask_original = createMask(limits, frame)
+    # Time the stages only when asked, the null profiler does nothing
+    if args['profile'] or args['trace'] is not None:
+        profiler = Profiler(trace=args['trace'] is not None)
+    else:
+        profiler = NullProfiler()
+
+    # Capture and segmentation run in the background, painting and display in this thread
+    markers = limits if isinstance(limits, MarkerModel) else None
+    if markers is not None:
+        # Several markers are labelled in one pass over the whole frame
+        tracker = MarkerTracker(min_area=markers.min_area)
+        # The Mask window shows each marker in the colour of its pen, the marker numbers themselves are almost black
+        mask_colors = np.zeros((256, 1, 3), dtype=np.uint8)
+        for number in range(len(markers.markers)):
+            mask_colors[number + 1, 0] = markers.pen(number)[0]
+        print(Back.BLUE + 'Painting with ' + str(len(markers.markers)) + ' markers.' + Back.RESET)
+    else:
+        tracker = None if args['full_frame_tracking'] else BlobTracker()
+    pipeline = SegmentationPipeline(capture, limits, workers=args['workers'], tracker=tracker,
+                                    scale=args['segmentation_scale'], refine_radius=args['refine_radius'],
+                                    profiler=profiler, open_size=args['mask_open'], close_size=args['mask_close'])
 
-        # Find centroid
-        mask, centroid = getCentroid(mask_original)
+    # Execute
+    frame_index = 0
+    while pipeline.isOpened():
+        profiler.startFrame()
 
-        # Create a green mask for max area
-        image_green = maxArea(frame, mask)
+        # Get the next frame already segmented, with its mask and centroid
+        ret, frame, mask_original, mask, centroid, image_green = pipeline.read()
+        if not ret:
+            break
+        profiler.lap('wait')
+
+        # With several markers every pointer paints with its own pen, and the oldest one also draws the shapes
+        pointers = []
+        if markers is not None:
+            pointers = centroid
+            centroid = pointers[0].centroid if pointers else None
+
+        if reader is not None:
+            # The key and the mouse events of this frame come from the recording
+            key, events = reader.events(frame_index)
+            for event in events:
+                onMouse(*event, None)
+        else:
+            # Process the window events and get the key, without waiting
+            key = display.poll()
 
-        # Wait a key to stop the program
-        key = cv2.waitKey(1)
+        # Record the key and the mouse events of this frame
+        if recorder is not None:
+            recorder.writeEvents(frame_index, key, mouse_events)
+        mouse_events.clear()
+        frame_index += 1
+        profiler.lap('events')
 
         # key to list
         listkeys.append(key)
@@ -230,85 +479,99 @@ def main():
             # Press "c" to clear the window
             elif key == ord('c'):
 
-                blank_image = 255 * np.ones(shape=[window_height, window_width, 3], dtype=np.uint8)
+                canvas.clear()
                 print('\nYou pressed "c": The window "Canvas" was cleared.')
 
             # Press "w" to save the canvas image
             elif key == ord('w'):
-                date = ctime()
-                cv2.imwrite('drawing_' + date + '.png', blank_image)
-                print('\nCurrent image saved as: ' + Fore.BLUE + 'drawing_' + date + '.png' + Style.RESET_ALL)
+                file_name = snapshots.save(canvas.image)
+                print('\nCurrent image saved as: ' + Fore.BLUE + file_name + Style.RESET_ALL)
+                if args['session'] is not None:
+                    canvas.strokes.save(args['session'])
+                    print('Strokes saved in: ' + Fore.BLUE + args['session'] + Style.RESET_ALL)
+
+            # Press "z" to undo the last stroke
+            elif key == ord('z'):
+                if history.undo():
+                    print('You pressed "z". The last stroke was undone.                  ', end='\r')
+                else:
+                    print('You pressed "z". There is nothing to undo.                    ', end='\r')
+
+            # Press "y" to redo the last undone stroke
+            elif key == ord('y'):
+                if history.redo():
+                    print('You pressed "y". The last undone stroke was redone.           ', end='\r')
+                else:
+                    print('You pressed "y". There is nothing to redo.                    ', end='\r')
 
             # Press "s" to draw a rectangle
             if key == ord('s'):
                 # If using mask mode
                 if not mouse_painting and centroid is not None:
-                    # If the previous pressed key was not s, create a cache and save the starting point
-                    if listkeys[-2] != ord('s'):
-                        cache = copy.deepcopy(blank_image)
+                    # If the previous pressed key was not s, save the starting point
+                    if listkeys[-2] != ord('s') or start_point is None:
                         start_point = (round(centroid[0]), round(centroid[1]))
                     else:
-                        if cache is None:
-                            cache = copy.deepcopy(blank_image)
-                        if start_point is None:
-                            start_point = (round(centroid[0]), round(centroid[1]))
+                        # Preview the rectangle on the overlay, the canvas is not changed yet
                         end_point = (round(centroid[0]), round(centroid[1]))
-                        blank_image = copy.deepcopy(cache)
-                        cv2.rectangle(blank_image, start_point, end_point, color, size)
+                        canvas.setPreview(key, 'rectangle', start_point, end_point, color, size)
 
                 # If used on "mouse" mode
                 elif mouse_painting:
                     if center_mouse is not None:
-                        if listmouse[-2] is None:
-                            cache_mouse = copy.deepcopy(blank_image)
+                        if listmouse[-2] is None or start_point_mouse is None:
                             start_point_mouse = center_mouse
                         else:
-                            if start_point_mouse is None:
-                                start_point_mouse = center_mouse
-                            if cache_mouse is None:
-                                cache_mouse = copy.deepcopy(blank_image)
                             end_point_mouse = center_mouse
-                            blank_image = copy.deepcopy(cache_mouse)
-                            cv2.rectangle(blank_image, start_point_mouse, end_point_mouse, color, size)
+                            canvas.setPreview(key, 'rectangle', start_point_mouse, end_point_mouse, color, size)
 
             # Press "o" to draw a circle
             elif key == ord('o'):
                 # If used on "mask" mode
                 if not mouse_painting and centroid is not None:
-                    # If the previous pressed key was not o, create a cache and save the starting point
-                    if listkeys[-2] != ord('o'):
-                        cache = copy.deepcopy(blank_image)
+                    # If the previous pressed key was not o, save the starting point
+                    if listkeys[-2] != ord('o') or start_point is None:
                         start_point = (round(centroid[0]), round(centroid[1]))
-                    # If the previous pressed keys was an o, draw circle
+                    # If the previous pressed keys was an o, preview the circle
                     else:
-                        if cache is None:
-                            cache = copy.deepcopy(blank_image)
-                        if start_point is None:
-                            start_point = (round(centroid[0]), round(centroid[1]))
-
                         end_point = (round(centroid[0]), round(centroid[1]))
                         radius = int(((start_point[0] - end_point[0]) ** 2 + (start_point[1] - end_point[1]) ** 2)
                                      ** (1 / 2))
-                        blank_image = copy.deepcopy(cache)
-                        cv2.circle(blank_image, start_point, radius, color, size)
+                        canvas.setPreview(key, 'circle', start_point, radius, color, size)
 
                 # If used on "mouse" mode
                 elif mouse_painting:
                     if center_mouse is not None:
-                        if listmouse[-2] is None:
-                            cache_mouse = copy.deepcopy(blank_image)
+                        if listmouse[-2] is None or start_point_mouse is None:
                             start_point_mouse = center_mouse
                         else:
-                            if start_point_mouse is None:
-                                start_point_mouse = center_mouse
-                            if cache_mouse is None:
-                                cache_mouse = copy.deepcopy(blank_image)
                             end_point_mouse = center_mouse
                             radius = int(((start_point_mouse[0] - end_point_mouse[0]) ** 2 + (start_point_mouse[1] -
                                                                                               end_point_mouse[
                                                                                                   1]) ** 2) ** (1 / 2))
-                            blank_image = copy.deepcopy(cache_mouse)
-                            cv2.circle(blank_image, start_point_mouse, radius, color, size)
+                            canvas.setPreview(key, 'circle', start_point_mouse, radius, color, size)
+
+        # When the key (or the mouse button, in mouse mode) is released, draw the previewed shape on the canvas
+        if canvas.preview is not None:
+            if key != canvas.preview[0] or (mouse_painting and center_mouse is None):
+                # The shape is a stroke of its own in the history
+                history.endStroke()
+                canvas.commitPreview()
+                history.endStroke()
+                start_point = None
+                start_point_mouse = None
+
+        # A smoothed stroke is finished, with its last segment, when a key is pressed or in mouse mode
+        if smoother is not None and smoother.points and (key != -1 or mouse_painting):
+            curve = smoother.end()
+            if size != 0:
+                canvas.polyline(curve, color, size)
+
+        # A stroke ends when a key is pressed, the mouse button is released or the marker is lost (a smoothed stroke
+        # when the smoother gives up on the marker, below)
+        if (key != -1 and key != ord('s') and key != ord('o')) or (mouse_painting and not ispressed) or \
+                (not mouse_painting and centroid is None and smoother is None):
+            history.endStroke()
 
         # If the thickness of the pencil is zero the program doesn't draw
         if size == 0:
@@ -316,89 +579,185 @@ def main():
         else:
             # Painting with the mouse and not drawing rectangles or circles
             if ispressed and mouse_painting and not key == ord('s') and not key == ord('o'):
-                cv2.line(blank_image, center_prev_mouse, center_mouse, color, size)
+                canvas.line(center_prev_mouse, center_mouse, color, size)
                 # Defining the center_prev to use in the next cycle
                 center_prev_mouse = center_mouse
 
+            # Painting with several markers and not drawing rectangles or circles
+            elif markers is not None and not mouse_painting and not key == ord('s') and not key == ord('o'):
+                for pointer in pointers:
+                    # With shake prevention every pointer has its own smoother
+                    if smoother is not None:
+                        if pointer.id not in smoothers:
+                            smoothers[pointer.id] = (newSmoother(), pointer.marker)
+                        pointer_smoother, _ = smoothers[pointer.id]
+                        curve = pointer_smoother.update(pointer.centroid)
+                        if curve is not None:
+                            canvas.polyline(curve, *markers.pen(pointer.marker))
+                        continue
+
+                    center = (int(pointer.centroid[0]), int(pointer.centroid[1]))
+                    pointer_prev = pointers_prev.get(pointer.id)
+
+                    # A new pointer starts its line in this frame
+                    if pointer_prev is not None:
+                        pointer_color, pointer_size = markers.pen(pointer.marker)
+                        canvas.line(pointer_prev, center, pointer_color, pointer_size)
+                        cv2.line(frame, pointer_prev, center, pointer_color, pointer_size)
+                    pointers_prev[pointer.id] = center
+
+                # Forget the pointers that are gone, finishing their smoothed strokes
+                for pointer_id in set(pointers_prev) - {pointer.id for pointer in pointers}:
+                    del pointers_prev[pointer_id]
+                for pointer_id in set(smoothers) - {pointer.id for pointer in pointers}:
+                    pointer_smoother, marker = smoothers.pop(pointer_id)
+                    curve = pointer_smoother.end()
+                    if curve is not None:
+                        canvas.polyline(curve, *markers.pen(marker))
+
             # Painting with the mask and not drawing rectangles or circles
             elif not mouse_painting and not key == ord('s') and not key == ord('o'):
 
-                if centroid is None:
+                # If on shake prevention, the smoother filters the centroid, drops the jumps and returns the new
+                # part of the smooth stroke, drawn in one call
+                if smoother is not None:
+                    curve = smoother.update(centroid)
+                    if curve is not None:
+                        canvas.polyline(curve, color, size)
+                    # The stroke ends when the smoother gave up on the lost marker
+                    if centroid is None and not smoother.points:
+                        history.endStroke()
+
+                elif centroid is None:
                     pass
 
                 else:
                     # convert variable centroid to a tuple
                     center = (int(centroid[0]), int(centroid[1]))
-                    # If on shake prevention
-                    if shake_prevention:
-
-                        # Calculate the distance between the centroid detected and the previous centroid
-                        distance = math.sqrt(((center[0] - center_prev[0]) ** 2) + ((center[1] - center_prev[1]) ** 2))
-
-                        # If the distance is above a certain limit
-                        if distance > limit:
-                            # Center_prev to use in the next cycle
-                            center_prev = center
-                        else:
-                            # Paint a line
-                            cv2.line(blank_image, center_prev, center, color, size)
-                            # Draw the center on frame
-                            cv2.line(frame, center_prev, center, color, size)
-                            # center_prev to use in the next cycle
-                            center_prev = center
-                    else:
-                        # Paint a line
-                        cv2.line(blank_image, center_prev, center, color, size)
-                        cv2.line(frame, center_prev, center, color, size)
-                        # Center_prev to use in the next cycle
-                        center_prev = center
+                    # Paint a line
+                    canvas.line(center_prev, center, color, size)
+                    cv2.line(frame, center_prev, center, color, size)
+                    # Center_prev to use in the next cycle
+                    center_prev = center
 
         if args['use_numeric_painting']:
 
+            # Live score, only the pixels changed since the last frame are checked again
+            progress = scorer.progress()
+            if not headless:
+                # The score only changes with the canvas
+                display.show('Painted Image', lambda: drawProgress(painted_shown, painted_image, progress),
+                             canvas.version)
+
             # Press space bar, to shut down and print statistics
             if key & 0xFF == ord(' '):
                 print(Fore.WHITE + '\nThese are your statistics:' + Style.RESET_ALL)
-                mean_square_error = mse(painted_image, blank_image)
-                similarity = ssim(painted_image, blank_image, multichannel=True)
-
-                print('Error: ' + str(round(mean_square_error, 2)) + ' , Similarity: '
-                      + str(round(similarity * 100, 2)) + ' %')
-                if 0 <= similarity < 0.5:
+                score = scorer.score(canvas.image, ssim=True)
+                accuracy = score['accuracy']
+
+                print('Error: ' + str(round(score['mse'], 2)) + ' , Similarity: '
+                      + str(round(score['ssim'] * 100, 2)) + ' %')
+                print('Accuracy: ' + str(round(accuracy * 100, 2)) + ' %, Coverage: '
+                      + str(round(score['coverage'] * 100, 2)) + ' %')
+                for label, region in score['regions'].items():
+                    print('  Region ' + str(label) + ': accuracy ' + str(round(region['accuracy'] * 100, 2)) +
+                          ' %, coverage ' + str(round(region['coverage'] * 100, 2)) + ' %')
+                if 0 <= accuracy < 0.5:
                     print(Back.RED + 'You got less than 50%. Try again' + Style.RESET_ALL
                           )
-                elif 0.5 <= similarity < 0.75:
+                elif 0.5 <= accuracy < 0.75:
                     print(Back.YELLOW + 'Nice painting' + Style.RESET_ALL
                           )
-                elif 0.75 <= similarity <= 1.0:
+                elif 0.75 <= accuracy <= 1.0:
                     print(Back.GREEN + 'Perfect!' + Style.RESET_ALL
                           )
 
-                compare_images(painted_image, blank_image, "Canvas vs. Paint")
+                if not headless:
+                    # Side by side, without blocking in matplotlib
+                    cv2.imshow('Canvas vs. Paint', np.hstack([painted_image, scorer.fit(canvas.image)]))
 
-                cv2.waitKey(0)
+                    cv2.waitKey(0)
 
                 break
-        # Press v to change between real frame and blank image on canvas
-        if real_frame:
-            # Replace blank image with the real frame
-            new_frame = combine(blank_image, frame)
-            # Show the real frame on canvas
-            cv2.imshow("Canvas", new_frame)
-        else:
-            # Show the blank image on canvas
-            cv2.imshow("Canvas", blank_image)
 
-        cv2.imshow("Original", frame)
-        cv2.imshow("Mask", mask_original)
-        cv2.imshow("MaxArea", image_green)
+        # Send the new strokes to the shared canvas
+        if canvas_client is not None:
+            canvas_client.sync()
+        profiler.lap('paint')
+
+        if not headless:
+            # Press v to change between real frame and blank image on canvas. The windows are only rendered and shown
+            # when they are due
+            if real_frame:
+                # Show the painted pixels of the canvas, and the shape being drawn, over the real frame
+                display.show('Canvas', lambda: canvas.render(frame), frame_index)
+            else:
+                # Show the canvas with the shape being drawn, only when one of them changed
+                display.show('Canvas', canvas.render, (canvas.version, canvas.preview))
+            profiler.lap('render')
+
+            display.show('Original', lambda: profiler.drawHUD(frame), frame_index)
+            if markers is not None:
+                display.show('Mask', lambda: cv2.LUT(cv2.cvtColor(mask_original, cv2.COLOR_GRAY2BGR), mask_colors),
+                             frame_index)
+            else:
+                display.show('Mask', mask_original, frame_index)
+            display.show('MaxArea', image_green, frame_index)
+            profiler.lap('imshow')
 
         # Press "q" to shut down the program
         if key & 0xFF == ord('q'):
             print(Fore.RED + '\nYou closed the program.' + Style.RESET_ALL)
             break
 
+    pipeline.release()
+
+    # Draw the last segments of the smoothed strokes
+    if smoother is not None and smoother.points and size != 0:
+        canvas.polyline(smoother.end(), color, size)
+    for pointer_smoother, marker in smoothers.values():
+        if pointer_smoother.points:
+            canvas.polyline(pointer_smoother.end(), *markers.pen(marker))
+    if canvas_client is not None:
+        canvas_client.sync()
+        canvas_client.close()
+    if args['trace'] is not None:
+        profiler.saveTrace(args['trace'])
+        print('Trace saved in: ' + Fore.BLUE + args['trace'] + Style.RESET_ALL)
+    if recorder is not None:
+        recorder.close()
+        print('Session recorded in: ' + Fore.BLUE + args['record'] + Style.RESET_ALL)
+        if recorder.stalls:
+            print(Fore.YELLOW + 'The recorder fell behind ' + str(recorder.stalls) + ' times and held the capture for ' +
+                  str(round(1000 * recorder.stalled_time)) + ' ms' + Style.RESET_ALL)
+
+    # The final canvas of a replay, to compare runs
+    if reader is not None:
+        history.endStroke()
+        print('Replayed ' + str(frame_index) + ' frames. Canvas md5: ' + hashlib.md5(canvas.image.tobytes()).hexdigest())
+        if args['output'] is not None:
+            cv2.imwrite(args['output'], canvas.image)
+            print('Canvas saved as: ' + Fore.BLUE + args['output'] + Style.RESET_ALL)
+
+    # Keep the strokes to continue later, or to export them at other resolutions with strokes.py
+    if args['session'] is not None:
+        history.endStroke()
+        canvas.strokes.save(args['session'])
+        print('Strokes saved in: ' + Fore.BLUE + args['session'] + Style.RESET_ALL)
+
+    snapshots.close()
+    if canvas_file is not None:
+        canvas_file.close()
+        print('Canvas kept in: ' + Fore.BLUE + args['canvas_file'] + Style.RESET_ALL)
+
+    # Report where frames were lost
+    stats = capture.stats()
+    print('Frames captured: ' + str(stats['captured']) + ', processed: ' + str(stats['delivered']) +
+          ', dropped: ' + str(stats['dropped']) + ', max queue depth: ' + str(stats['max_queue_depth']))
+
     capture.release()
-    cv2.destroyAllWindows()
+    if not headless:
+        cv2.destroyAllWindows()
 
 
 if __name__ == "__main__":
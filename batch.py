@@ -0,0 +1,246 @@
+#!/usr/bin/python3
+import argparse
+import glob
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import groupby
+
+import cv2
+import numpy as np
+
+from canvas import Canvas
+from color_model import MarkerModel, loadModel
+from my_functions import getCentroid
+from pipeline import maskFrame, trackFrame
+from puzzle import COLORS, loadPuzzle
+from scoring import RegionScorer
+from smoothing import StrokeSmoother
+from tracker import BlobTracker, MarkerTracker
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff')
+
+# Colour model of each worker process, loaded once by initWorker
+worker_model = None
+
+
+def listFrames(path):
+    """
+        Sorted image files of a directory.
+    """
+    return sorted(file_name for file_name in glob.glob(os.path.join(path, '*'))
+                  if file_name.lower().endswith(IMAGE_EXTENSIONS))
+
+
+def countFrames(path):
+    if os.path.isdir(path):
+        return len(listFrames(path))
+    capture = cv2.VideoCapture(path)
+    count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+    capture.release()
+
+    return count
+
+
+def readFrames(path, start=0, stop=None):
+    """
+        Yields the frames start to stop - 1 of a video file or of a directory of images.
+    """
+    if os.path.isdir(path):
+        for file_name in listFrames(path)[start:stop]:
+            yield cv2.imread(file_name)
+        return
+
+    capture = cv2.VideoCapture(path)
+    if start:
+        capture.set(cv2.CAP_PROP_POS_FRAMES, start)
+    index = start
+    while stop is None or index < stop:
+        ret, frame = capture.read()
+        if not ret:
+            break
+        yield frame
+        index += 1
+    capture.release()
+
+
+def initWorker(json_file):
+    global worker_model
+    # One process per core, so OpenCV does not start threads of its own in each of them
+    cv2.setNumThreads(1)
+    worker_model = loadModel(json_file)
+
+
+def trajectory(path, start, stop, mirror, tracking, scale):
+    """
+        Worker job: segments the frames start to stop - 1 of a file and returns (frame size, rows), one row per frame
+        and blob: (frame index, pointer id, marker, x, y), with x = y = nan in frames without blobs.
+        With tracking the blob is followed with a BlobTracker (or a MarkerTracker for several markers), which needs
+        the frames in order, so it is only used for whole files.
+    """
+    model = worker_model
+    if isinstance(model, MarkerModel):
+        find = MarkerTracker(min_area=model.min_area).update
+    elif tracking:
+        find = BlobTracker().update
+    else:
+        find = getCentroid
+
+    size = None
+    rows = []
+    for index, frame in enumerate(readFrames(path, start, stop), start):
+        if mirror:
+            frame = cv2.flip(frame, 1)
+        size = frame.shape[1::-1]
+
+        centroid = trackFrame(*maskFrame(frame, model, scale), model, find=find, scale=scale)[3]
+        if isinstance(centroid, list):
+            if not centroid:
+                rows.append((index, -1, -1, np.nan, np.nan))
+            for pointer in centroid:
+                rows.append((index, pointer.id, pointer.marker, pointer.centroid[0], pointer.centroid[1]))
+        elif centroid is None:
+            rows.append((index, -1, -1, np.nan, np.nan))
+        else:
+            rows.append((index, 0, 0, centroid[0], centroid[1]))
+
+    return size, np.array(rows, dtype=np.float64).reshape(-1, 5)
+
+
+def paintTrajectory(canvas, rows, model, color, size, smoothing=None):
+    """
+        Paints a trajectory on the canvas as ar_paint paints with the mask: a line from the last centre of each pointer
+        to the new one. With smoothing (the arguments of a StrokeSmoother), the strokes are smoothed as ar_paint does
+        with shake prevention, with a smoother per pointer.
+    """
+    def pen(marker):
+        return model.pen(int(marker)) if isinstance(model, MarkerModel) else (color, size)
+
+    centers_prev = {}
+    smoothers = {}
+    # The rows are in frame order
+    for _, frame_rows in groupby(rows, key=lambda row: row[0]):
+        seen = set()
+        for _, pointer_id, marker, x, y in frame_rows:
+            if np.isnan(x):
+                continue
+            seen.add(pointer_id)
+
+            if smoothing is not None:
+                if pointer_id not in smoothers:
+                    smoothers[pointer_id] = (StrokeSmoother(**smoothing), marker)
+                smoother, _ = smoothers[pointer_id]
+                curve = smoother.update((x, y))
+                if curve is not None:
+                    canvas.polyline(curve, *pen(marker))
+                continue
+
+            center = (int(x), int(y))
+            center_prev = centers_prev.get(pointer_id)
+            if center_prev is not None:
+                canvas.line(center_prev, center, *pen(marker))
+            centers_prev[pointer_id] = center
+
+        # The smoothers of the pointers not found in this frame count them as missing
+        for pointer_id, (smoother, marker) in smoothers.items():
+            if pointer_id not in seen:
+                curve = smoother.update(None)
+                if curve is not None:
+                    canvas.polyline(curve, *pen(marker))
+
+    # Finish the smoothed strokes
+    for smoother, marker in smoothers.values():
+        curve = smoother.end()
+        if curve is not None:
+            canvas.polyline(curve, *pen(marker))
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Process recorded videos or image directories with AR_PAINT, without a '
+                                             'camera')
+    ap.add_argument('inputs', nargs='+', help='Video files or directories of images.')
+    ap.add_argument('-j', '--json', required=True, help='Input json file path with the limits.')
+    ap.add_argument('-o', '--output', default='batch_output', help='Directory of the results.')
+    ap.add_argument('-w', '--workers', type=int, default=os.cpu_count(), help='Number of worker processes.')
+    ap.add_argument('-ch', '--chunks', type=int, default=1,
+                    help='Split each file in this number of chunks of frames, processed in parallel and merged in '
+                         'order. Chunks find the centroid in the full frame, without a tracker.')
+    ap.add_argument('-m', '--mirror', action='store_true', help='Mirror the frames, as ar_paint does with the camera.')
+    ap.add_argument('-ss', '--segmentation_scale', type=float, default=1.0, help='Scale of the segmentation.')
+    ap.add_argument('-c', '--color', type=int, nargs=3, default=[255, 0, 0], help='BGR colour of the pen.')
+    ap.add_argument('-s', '--size', type=int, default=6, help='Size of the pen.')
+    ap.add_argument('-usp', '--use_shake_prevention', action='store_true',
+                    help='Smooth the strokes and do not paint jumps of the marker, as ar_paint.')
+    ap.add_argument('-pz', '--puzzle', help='Score the paintings against this numbered image generated by puzzle.py.')
+    args = vars(ap.parse_args())
+
+    os.makedirs(args['output'], exist_ok=True)
+    model = loadModel(args['json'])
+    if isinstance(model, MarkerModel) and args['chunks'] > 1:
+        ap.error('several markers need the frames in order to keep their ids, use --chunks 1')
+
+    scorer = None
+    if args['puzzle'] is not None:
+        _, painted_image, regions, region_colors = loadPuzzle(args['puzzle'])
+        scorer = RegionScorer(painted_image, regions, colors=COLORS[region_colors])
+
+    start_time = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args['workers'], initializer=initWorker,
+                             initargs=(args['json'],)) as executor:
+        # Submit every chunk of every file at once, so all the workers are busy
+        jobs = []
+        for path in args['inputs']:
+            chunks = args['chunks']
+            if chunks > 1:
+                count = countFrames(path)
+                bounds = np.linspace(0, count, chunks + 1).astype(int)
+                ranges = [(bounds[i], bounds[i + 1] if i < chunks - 1 else None) for i in range(chunks)]
+            else:
+                ranges = [(0, None)]
+            futures = [executor.submit(trajectory, path, start, stop, args['mirror'], chunks == 1,
+                                       args['segmentation_scale']) for start, stop in ranges]
+            jobs.append((path, futures))
+
+        # Merge the chunks of each file in order, paint and save
+        summary = {}
+        total_frames = 0
+        for path, futures in jobs:
+            results = [future.result() for future in futures]
+            frame_size = next((size for size, _ in results if size is not None), None)
+            if frame_size is None:
+                print('No frames in ' + path)
+                continue
+            rows = np.concatenate([rows for _, rows in results])
+
+            canvas = Canvas(*frame_size)
+            paintTrajectory(canvas, rows, model, tuple(args['color']), args['size'],
+                            {'max_jump': 50} if args['use_shake_prevention'] else None)
+
+            name = os.path.splitext(os.path.basename(os.path.normpath(path)))[0]
+            prefix = os.path.join(args['output'], name)
+            np.savez_compressed(prefix + '.npz', frames=rows[:, 0].astype(np.int32),
+                                ids=rows[:, 1].astype(np.int32), markers=rows[:, 2].astype(np.int16),
+                                centroids=rows[:, 3:].astype(np.float32))
+            canvas.strokes.save(prefix + '.strokes.npz')
+            cv2.imwrite(prefix + '.png', canvas.image)
+
+            frames = len(np.unique(rows[:, 0]))
+            total_frames += frames
+            summary[path] = {'frames': frames, 'detected': int(np.count_nonzero(~np.isnan(rows[:, 3]))),
+                             'trajectory': prefix + '.npz', 'canvas': prefix + '.png'}
+            if scorer is not None:
+                score = scorer.score(canvas.image, ssim=True)
+                summary[path].update(accuracy=score['accuracy'], coverage=score['coverage'], mse=score['mse'],
+                                     ssim=score['ssim'])
+            print(path + ': ' + str(frames) + ' frames, saved as ' + prefix + '.npz and ' + prefix + '.png')
+
+    elapsed = time.perf_counter() - start_time
+    print('%d frames in %.2f s (%.1f fps) with %d workers' % (total_frames, elapsed, total_frames / elapsed,
+                                                              args['workers']))
+    with open(os.path.join(args['output'], 'summary.json'), 'w') as file_handle:
+        json.dump(summary, file_handle, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,576 @@
+#!/usr/bin/python3
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+from canvas import Canvas
+from canvas_server import CanvasClient, CanvasServer, CanvasViewer
+from color_model import MarkerModel, createModel, loadModel
+from history import History
+from masks import BufferPool
+from my_functions import combine, createMask, getCentroid, maxArea, mse, refineCentroid, resizeForSegmentation, \
+    scaleCentroid
+from recording import SessionReader
+
+# Names accepted as resolutions
+RESOLUTIONS = {'480p': (640, 480), '720p': (1280, 720), '1080p': (1920, 1080), '4k': (3840, 2160)}
+
+
+def parseResolution(text):
+    """
+        Converts a resolution like 1920x1080, or a name like 720p, to (width, height).
+    """
+    if text.lower() in RESOLUTIONS:
+        return RESOLUTIONS[text.lower()]
+    width, height = text.lower().split('x')
+    return int(width), int(height)
+
+
+def markerColors(model, step=15):
+    """
+        Returns a colour the model segments (of the first marker, with a MarkerModel) and one it does not segment at all
+        (for the background). The candidates are a grid of colours, every step levels, segmented with model.apply like
+        the frames: the marker colour is the one closest to the mean of the colours segmented, and the background the
+        one furthest from it.
+    """
+    levels = np.arange(0, 256, step)
+    candidates = np.stack(np.meshgrid(levels, levels, levels, indexing='ij'), axis=-1).reshape(1, -1, 3)
+    values = model.apply(candidates.astype(np.uint8)).ravel()
+    candidates = candidates.reshape(-1, 3)
+
+    inside = candidates[values == 1] if isinstance(model, MarkerModel) else candidates[values != 0]
+    outside = candidates[values == 0]
+    if len(inside) == 0:
+        raise ValueError('The limits do not accept any colour, there is no marker colour to use')
+    if len(outside) == 0:
+        raise ValueError('The limits accept every colour, there is no background colour to use')
+
+    mean = inside.mean(axis=0)
+    inside = inside[np.argmin(np.sum((inside - mean) ** 2, axis=1))]
+    outside = outside[np.argmax(np.sum((outside - mean) ** 2, axis=1))]
+
+    return tuple(int(v) for v in inside), tuple(int(v) for v in outside)
+
+
+def syntheticFrames(limits, resolution, count, radius=20, noise=300, seed=0, blobs=1):
+    """
+        Generates frames with one marker blob at a known sub-pixel position and some noise pixels of the marker colour.
+        With blobs > 1, smaller blobs of the marker colour are added as distractors.
+        Yields (frame, true_centroid).
+    """
+    rng = np.random.default_rng(seed)
+    width, height = resolution
+    inside, outside = markerColors(limits)
+    shift = 4
+
+    for _ in range(count):
+        frame = np.empty((height, width, 3), dtype=np.uint8)
+        frame[:] = outside
+
+        # Speckle noise
+        xs = rng.integers(0, width, noise)
+        ys = rng.integers(0, height, noise)
+        frame[ys, xs] = inside
+
+        # Distractors, half the radius of the marker so it stays the largest blob
+        for _ in range(blobs - 1):
+            distractor = rng.integers((radius, radius), (width - radius, height - radius))
+            cv2.circle(frame, (int(distractor[0]), int(distractor[1])), radius // 2, inside, -1)
+
+        # Marker at a sub-pixel position, drawn with fixed point coordinates
+        center = rng.uniform((radius * 2, radius * 2), (width - radius * 2, height - radius * 2))
+        fixed = (int(round(center[0] * (1 << shift))), int(round(center[1] * (1 << shift))))
+        cv2.circle(frame, fixed, radius << shift, inside, -1, cv2.LINE_8, shift)
+
+        yield frame, np.array(fixed) / (1 << shift)
+
+
+def benchmarkScale(limits, resolution, frames, scales, refine_radius, radius):
+    """
+        Compares the centroid error and the time of createMask + getCentroid at several segmentation scales.
+    """
+    results = []
+    data = list(syntheticFrames(limits, resolution, frames, radius=radius))
+
+    for scale in scales:
+        times = []
+        errors = []
+        for frame, truth in data:
+            start = time.perf_counter()
+
+            small = resizeForSegmentation(frame, scale)
+            _, centroid = getCentroid(createMask(limits, small))
+            if centroid is not None:
+                centroid = scaleCentroid(centroid, scale)
+                if refine_radius and scale != 1:
+                    centroid = refineCentroid(limits, frame, centroid, refine_radius)
+
+            times.append(time.perf_counter() - start)
+            errors.append(np.inf if centroid is None else float(np.hypot(*(centroid - truth))))
+
+        results.append({'scale': scale, 'refine_radius': refine_radius if scale != 1 else 0,
+                        'median_ms': 1000 * float(np.median(times)),
+                        'mean_error_px': float(np.mean(errors)), 'max_error_px': float(np.max(errors))})
+
+    # Speedup against the first scale given (usually full resolution)
+    for result in results:
+        result['speedup'] = results[0]['median_ms'] / result['median_ms']
+
+    return results
+
+
+def recordedFrames(file_name, resolution, count):
+    """
+        Frames of a session recorded by ar_paint --record, resized to the resolution. Yields (frame, None).
+    """
+    reader = SessionReader(file_name)
+    try:
+        for _ in range(count):
+            ret, frame = reader.read()
+            if not ret:
+                break
+            if frame.shape[1::-1] != tuple(resolution):
+                frame = cv2.resize(frame, tuple(resolution), interpolation=cv2.INTER_LINEAR)
+            yield frame, None
+    finally:
+        reader.release()
+
+
+def hotPathStages(limits, frame, canvas, state):
+    """
+        The per frame work of ar_paint, as (name, function) pairs run in order. Each function gets the outputs of the
+        previous ones in state. The drawing stages repeat the branches of ar_paint.main: a line from the last centroid,
+        the preview of a rectangle and of a circle, and the canvas over the frame. The masks use a BufferPool kept in
+        state, as in the pipeline.
+    """
+    pool = state.setdefault('pool', BufferPool())
+
+    def stageMask():
+        state['mask_original'] = createMask(limits, frame, out=pool.get('mask', frame.shape[:2]))
+
+    def stageCentroid():
+        state['mask'], centroid = getCentroid(state['mask_original'], pool)
+        if centroid is not None:
+            state['center_prev'], state['center'] = state.get('center'), (int(centroid[0]), int(centroid[1]))
+
+    def stageMaxArea():
+        maxArea(frame, state['mask'], pool.get('green', frame.shape))
+
+    def stageLine():
+        if state.get('center_prev') is not None:
+            canvas.line(state['center_prev'], state['center'], (255, 0, 0), 5)
+
+    def stageRectangle():
+        if state.get('center') is not None:
+            canvas.setPreview(ord('r'), 'rectangle', (canvas.width // 4, canvas.height // 4), state['center'],
+                              (0, 255, 0), 5)
+            canvas.render()
+
+    def stageCircle():
+        if state.get('center') is not None:
+            radius = int(np.hypot(state['center'][0] - canvas.width // 2, state['center'][1] - canvas.height // 2))
+            canvas.setPreview(ord('o'), 'circle', (canvas.width // 2, canvas.height // 2), radius, (0, 0, 255), 5)
+            canvas.render()
+            canvas.preview = None
+
+    def stageComposite():
+        canvas.render(frame)
+
+    def stageCombine():
+        combine(canvas.image, frame)
+
+    def stageMse():
+        mse(canvas.image, frame)
+
+    return [('createMask', stageMask), ('getCentroid', stageCentroid), ('maxArea', stageMaxArea),
+            ('line', stageLine), ('rectangle preview', stageRectangle), ('circle preview', stageCircle),
+            ('composite', stageComposite), ('combine', stageCombine), ('mse', stageMse)]
+
+
+def percentiles(times):
+    times = 1000 * np.array(times)
+    return {'p50_ms': float(np.percentile(times, 50)), 'p90_ms': float(np.percentile(times, 90)),
+            'p99_ms': float(np.percentile(times, 99)), 'max_ms': float(np.max(times))}
+
+
+def benchmarkHotPath(limits, resolution, frames, blobs=1, recording=None, memory_frames=3):
+    """
+        Times every stage of the per frame work on the frames, and measures the peak memory each stage allocates
+        (with tracemalloc, in a separate pass so it does not slow the timing).
+    """
+    if recording is not None:
+        data = list(recordedFrames(recording, resolution, frames))
+    else:
+        data = list(syntheticFrames(limits, resolution, frames, blobs=blobs))
+
+    width, height = resolution
+    canvas = Canvas(width, height)
+    names = [name for name, _ in hotPathStages(limits, data[0][0], canvas, {})]
+    times = {name: [] for name in names}
+    totals = []
+
+    state = {}
+    for frame, _ in data:
+        total = 0
+        for name, stage in hotPathStages(limits, frame, canvas, state):
+            start = time.perf_counter()
+            stage()
+            elapsed = time.perf_counter() - start
+            times[name].append(elapsed)
+            total += elapsed
+        totals.append(total)
+
+    # Peak memory of each stage, above what was allocated before it
+    peaks = {name: 0 for name in names}
+    canvas.clear()
+    # The buffers of the pool are allocated once, in the timing pass
+    state = {'pool': state['pool']}
+    tracemalloc.start()
+    for frame, _ in data[:memory_frames]:
+        for name, stage in hotPathStages(limits, frame, canvas, state):
+            tracemalloc.reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+            stage()
+            _, peak = tracemalloc.get_traced_memory()
+            peaks[name] = max(peaks[name], peak - before)
+    tracemalloc.stop()
+
+    stages = {}
+    for name in names:
+        stages[name] = percentiles(times[name])
+        stages[name]['peak_memory_mb'] = peaks[name] / 2 ** 20
+
+    return {'resolution': '%dx%d' % resolution, 'blobs': blobs if recording is None else None,
+            'source': recording or 'synthetic', 'frames': len(data), 'fps': len(totals) / sum(totals),
+            'total': percentiles(totals), 'peak_memory_mb': max(peaks.values()) / 2 ** 20, 'stages': stages}
+
+
+def compareHotPath(results, baseline, tolerance):
+    """
+        Compares the median time of every stage with a baseline saved with --output. Returns the regressions, the
+        stages that got slower by more than the tolerance (0.1 is 10 %).
+    """
+    old = {(r['resolution'], r['blobs'], r['source']): r for r in baseline['results']}
+    regressions = []
+
+    print('\nresolution  blobs  stage               baseline ms   current ms   change')
+    for result in results:
+        key = (result['resolution'], result['blobs'], result['source'])
+        if key not in old:
+            continue
+        for name, stage in list(result['stages'].items()) + [('total', result['total'])]:
+            old_stage = old[key]['stages'].get(name) if name != 'total' else old[key]['total']
+            if old_stage is None:
+                continue
+            change = stage['p50_ms'] / old_stage['p50_ms'] - 1 if old_stage['p50_ms'] > 0 else 0
+            flag = ''
+            if change > tolerance:
+                flag = '  REGRESSION'
+                regressions.append((key, name, change))
+            print('%10s  %5s  %-18s  %11.3f  %11.3f  %+6.1f %%%s' % (key[0], key[1], name, old_stage['p50_ms'],
+                                                                  stage['p50_ms'], 100 * change, flag))
+
+    return regressions
+
+
+# Startup of ar_paint, run in a new interpreter: imports, then the camera opened in the background while the model
+# is loaded, as in ar_paint.main
+STARTUP_SCRIPT = '''
+import json, sys, time
+started = time.perf_counter()
+import ar_paint
+imported = time.perf_counter()
+source = int(sys.argv[2]) if sys.argv[2].isdigit() else sys.argv[2]
+camera = ar_paint.FrameGrabber(source)
+ar_paint.loadModel(sys.argv[1])
+loaded = time.perf_counter()
+ret, _ = camera.read()
+first_frame = time.perf_counter()
+camera.release()
+print(json.dumps({'import_ms': 1000 * (imported - started), 'model_ms': 1000 * (loaded - imported),
+                  'first_frame_ms': 1000 * (first_frame - started), 'opened': ret,
+                  'heavy_modules': sorted(m for m in %r if m in sys.modules)}))
+'''
+
+# Modules that ar_paint should only import when they are used
+HEAVY_MODULES = ['asyncio', 'matplotlib', 'scipy', 'skimage']
+
+
+def benchmarkStartup(json_file, source, runs):
+    """
+        Starts ar_paint's imports and camera runs times, each in a new interpreter, and returns the median times to
+        import it, to load the model and to read the first frame (from the start of the imports), and the time of the
+        whole process. The source is a camera number or a video file.
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    script = STARTUP_SCRIPT % HEAVY_MODULES
+    runs_results = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, '-c', script, os.path.abspath(json_file), str(source)],
+                                cwd=directory, capture_output=True, text=True, check=True).stdout
+        process_ms = 1000 * (time.perf_counter() - start)
+        result = json.loads(output.strip().splitlines()[-1])
+        result['process_ms'] = process_ms
+        runs_results.append(result)
+
+    times = {name: float(np.median([r[name] for r in runs_results]))
+             for name in ['import_ms', 'model_ms', 'first_frame_ms', 'process_ms']}
+
+    return {'source': str(source), 'runs': runs, 'opened': all(r['opened'] for r in runs_results),
+            'heavy_modules': runs_results[0]['heavy_modules'], 'times': times}
+
+
+def compareStartup(result, baseline, tolerance):
+    """
+        Compares the median startup times with a baseline saved with --output. Returns the regressions, the times that
+        got slower by more than the tolerance (0.1 is 10 %).
+    """
+    regressions = []
+
+    print('\ntime             baseline ms   current ms   change')
+    for name, current in result['times'].items():
+        old = baseline['times'].get(name)
+        if old is None:
+            continue
+        change = current / old - 1 if old > 0 else 0
+        flag = ''
+        if change > tolerance:
+            flag = '  REGRESSION'
+            regressions.append((name, change))
+        print('%-15s  %11.1f  %11.1f  %+6.1f %%%s' % (name, old, current, 100 * change, flag))
+
+    return regressions
+
+
+def benchmarkServer(clients, seconds, fps, resolution, address=None, seed=0):
+    """
+        Loopback test of the canvas server (see canvas_server.py): simulated drawers paint random strokes at fps, with
+        an undo now and then, and a viewer receives the tiles. Returns the traffic, the CPU time and whether the
+        canvas of the viewer ended equal to the one of the server.
+    """
+    temporary = None
+    if address is None:
+        temporary = tempfile.mkdtemp()
+        address = os.path.join(temporary, 'canvas.sock')
+
+    width, height = resolution
+    server = CanvasServer(width, height)
+    ready = threading.Event()
+    loop = asyncio.new_event_loop()
+    task = loop.create_task(server.serve(address, ready))
+
+    def run():
+        try:
+            loop.run_until_complete(task)
+        except asyncio.CancelledError:
+            pass
+        loop.close()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    ready.wait()
+
+    viewer = CanvasViewer(address)
+    rng = np.random.default_rng(seed)
+    drawers = []
+    for _ in range(clients):
+        canvas = Canvas(width, height)
+        drawers.append({'canvas': canvas, 'history': History(canvas), 'client': CanvasClient(address, canvas),
+                        'point': rng.uniform((0, 0), (width, height)), 'speed': np.zeros(2)})
+
+    colors = [(255, 0, 0), (0, 255, 0), (0, 0, 255), (0, 255, 255)]
+    frames = int(seconds * fps)
+    start_time = time.perf_counter()
+    start_cpu = time.process_time()
+    for frame in range(frames):
+        for number, drawer in enumerate(drawers):
+            # A smooth random walk, with pauses between strokes and an undo every few strokes
+            if frame % 60 < 45:
+                drawer['speed'] = 0.8 * drawer['speed'] + rng.normal(0, 3, 2)
+                point = np.clip(drawer['point'] + drawer['speed'], 0, (width - 1, height - 1))
+                drawer['canvas'].line(tuple(drawer['point'].astype(int)), tuple(point.astype(int)),
+                                      colors[number % len(colors)], 5)
+                drawer['point'] = point
+            elif frame % 60 == 45:
+                drawer['history'].endStroke()
+                if frame % 240 == 45:
+                    drawer['history'].undo()
+            drawer['client'].sync()
+
+        # Paced as a camera
+        delay = start_time + (frame + 1) / fps - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+    for drawer in drawers:
+        drawer['client'].close()
+    # Wait until the server drew everything and the viewer received it
+    time.sleep(0.5)
+    elapsed = time.perf_counter() - start_time
+    cpu = time.process_time() - start_cpu
+
+    loop.call_soon_threadsafe(task.cancel)
+    thread.join()
+    with viewer.lock:
+        consistent = bool(np.array_equal(viewer.image, server.canvas.image))
+    viewer.close()
+    if temporary is not None:
+        shutil.rmtree(temporary, ignore_errors=True)
+
+    sent = sum(drawer['client'].sent_bytes for drawer in drawers)
+    return {'clients': clients, 'frames': frames, 'resolution': '%dx%d' % resolution, 'elapsed_s': elapsed,
+            'cpu_percent': 100 * cpu / elapsed, 'messages': server.messages, 'drawer_bytes_per_s': sent / elapsed,
+            'viewer_bytes_per_s': viewer.received_bytes / elapsed, 'viewer_tiles': viewer.tiles,
+            'raw_frames_bytes_per_s': width * height * 3 * fps, 'consistent': consistent}
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Benchmarks for AR_PAINT')
+    subparsers = ap.add_subparsers(dest='benchmark', required=True)
+
+    ap_scale = subparsers.add_parser('scale', help='Centroid error against speedup of downscaled segmentation.')
+    ap_scale.add_argument('-j', '--json', required=True, help='Input json file path with the limits')
+    ap_scale.add_argument('-r', '--resolution', type=parseResolution, default=(1920, 1080),
+                          help='Frame resolution, e.g. 1280x720.')
+    ap_scale.add_argument('-n', '--frames', type=int, default=100, help='Number of frames.')
+    ap_scale.add_argument('-s', '--scales', type=float, nargs='+', default=[1, 0.5, 0.25],
+                          help='Segmentation scales to compare.')
+    ap_scale.add_argument('-rr', '--refine_radius', type=int, default=0,
+                          help='Radius of the full resolution refinement window (0 to disable).')
+    ap_scale.add_argument('--radius', type=int, default=20, help='Radius of the marker in pixels.')
+
+    ap_hot = subparsers.add_parser('hotpath', help='Latency percentiles, fps and peak memory of the per frame work.')
+    ap_hot.add_argument('-j', '--json', help='Input json file path with the limits (optional with a recording, '
+                                             'which has its own).')
+    ap_hot.add_argument('-r', '--resolutions', type=parseResolution, nargs='+',
+                        default=[RESOLUTIONS[name] for name in ['480p', '720p', '1080p', '4k']],
+                        help='Frame resolutions, e.g. 720p 1920x1080.')
+    ap_hot.add_argument('-b', '--blobs', type=int, nargs='+', default=[1, 10, 100],
+                        help='Number of blobs of the marker colour in the synthetic frames.')
+    ap_hot.add_argument('-n', '--frames', type=int, default=50, help='Number of frames.')
+    ap_hot.add_argument('-rec', '--recording', help='Use the frames of a session recorded with ar_paint --record '
+                                                    'instead of synthetic frames.')
+    ap_hot.add_argument('-o', '--output', help='Save the results to this json file.')
+    ap_hot.add_argument('-c', '--compare', help='Compare with the results saved in this json file.')
+    ap_hot.add_argument('-t', '--tolerance', type=float, default=0.1,
+                        help='Slowdown of the median above which a stage is a regression (0.1 is 10%%).')
+
+    ap_server = subparsers.add_parser('server', help='Loopback throughput of the canvas server with simulated '
+                                                     'clients.')
+    ap_server.add_argument('-c', '--clients', type=int, nargs='+', default=[1, 4, 16],
+                           help='Numbers of simulated drawers.')
+    ap_server.add_argument('-s', '--seconds', type=float, default=5, help='Duration of each run.')
+    ap_server.add_argument('-f', '--fps', type=float, default=30, help='Frame rate of the drawers.')
+    ap_server.add_argument('-r', '--resolution', type=parseResolution, default=(1280, 720),
+                           help='Size of the canvases.')
+    ap_server.add_argument('-a', '--address', help='host:port or Unix socket path of the server (a temporary Unix '
+                                                   'socket by default).')
+
+    ap_startup = subparsers.add_parser('startup', help='Import time of ar_paint and time to its first frame.')
+    ap_startup.add_argument('-j', '--json', required=True, help='Input json file path with the limits')
+    ap_startup.add_argument('-s', '--source', default='0', help='Camera number or video file to read from.')
+    ap_startup.add_argument('-n', '--runs', type=int, default=5, help='Number of runs, the median is reported.')
+    ap_startup.add_argument('-o', '--output', help='Save the results to this json file.')
+    ap_startup.add_argument('-c', '--compare', help='Compare with the results saved in this json file.')
+    ap_startup.add_argument('-t', '--tolerance', type=float, default=0.2,
+                            help='Slowdown of a time, against the baseline, that is reported as a regression.')
+
+    args = vars(ap.parse_args())
+
+    if args['benchmark'] == 'startup':
+        result = benchmarkStartup(args['json'], args['source'], args['runs'])
+        print('source %s, %d runs, camera %s' % (result['source'], result['runs'],
+                                                 'opened' if result['opened'] else 'NOT opened'))
+        for name, value in result['times'].items():
+            print('%-15s  %8.1f ms' % (name, value))
+        if result['heavy_modules']:
+            print('Imported at startup although not used: ' + ', '.join(result['heavy_modules']))
+
+        report = dict(result, created=time.strftime('%Y-%m-%d %H:%M:%S'), opencv=cv2.__version__)
+        if args['output'] is not None:
+            with open(args['output'], 'w') as file_handle:
+                json.dump(report, file_handle, indent=2)
+            print('\nResults saved as ' + args['output'])
+
+        if args['compare'] is not None:
+            with open(args['compare']) as file_handle:
+                baseline = json.load(file_handle)
+            regressions = compareStartup(result, baseline, args['tolerance'])
+            if regressions or result['heavy_modules']:
+                print('\n%d times are slower than the baseline' % len(regressions))
+                sys.exit(1)
+        return
+
+    if args['benchmark'] == 'server':
+        print('clients  messages  drawers KB/s  viewer KB/s  raw frames KB/s  CPU %  consistent')
+        for clients in args['clients']:
+            r = benchmarkServer(clients, args['seconds'], args['fps'], args['resolution'], args['address'])
+            print('%7d  %8d  %12.1f  %11.1f  %15.0f  %5.1f  %s' % (r['clients'], r['messages'],
+                                                                   r['drawer_bytes_per_s'] / 1024,
+                                                                   r['viewer_bytes_per_s'] / 1024,
+                                                                   r['raw_frames_bytes_per_s'] / 1024,
+                                                                   r['cpu_percent'], r['consistent']))
+        return
+
+    # The compiled model, as ar_paint uses it
+    if args['json'] is not None:
+        limits = loadModel(args['json'])
+    elif args['benchmark'] == 'hotpath' and args['recording'] is not None:
+        limits = createModel(json.loads(SessionReader(args['recording']).header['limits']))
+    else:
+        ap.error('the following arguments are required: -j/--json')
+
+    if args['benchmark'] == 'scale':
+        results = benchmarkScale(limits, args['resolution'], args['frames'], args['scales'], args['refine_radius'],
+                                 args['radius'])
+        print('scale  refine  median ms  speedup  mean error px  max error px')
+        for r in results:
+            print('%5.2f  %6d  %9.2f  %7.2f  %13.3f  %12.3f' % (r['scale'], r['refine_radius'], r['median_ms'],
+                                                               r['speedup'], r['mean_error_px'], r['max_error_px']))
+
+    elif args['benchmark'] == 'hotpath':
+        results = []
+        blob_counts = [None] if args['recording'] is not None else args['blobs']
+        for resolution in args['resolutions']:
+            for blobs in blob_counts:
+                result = benchmarkHotPath(limits, resolution, args['frames'], blobs or 1, args['recording'])
+                results.append(result)
+
+                print('\n%s, %s blobs: %.1f fps, total p50 %.2f ms, p99 %.2f ms, peak memory %.1f MB'
+                      % (result['resolution'], result['blobs'] or 'recorded', result['fps'], result['total']['p50_ms'],
+                         result['total']['p99_ms'], result['peak_memory_mb']))
+                print('stage               p50 ms   p90 ms   p99 ms   peak MB')
+                for name, stage in result['stages'].items():
+                    print('%-18s  %7.3f  %7.3f  %7.3f  %8.2f' % (name, stage['p50_ms'], stage['p90_ms'], stage['p99_ms'],
+                                                                 stage['peak_memory_mb']))
+
+        report = {'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'opencv': cv2.__version__, 'numpy': np.__version__,
+                  'frames': args['frames'], 'results': results}
+        if args['output'] is not None:
+            with open(args['output'], 'w') as file_handle:
+                json.dump(report, file_handle, indent=2)
+            print('\nResults saved as ' + args['output'])
+
+        if args['compare'] is not None:
+            with open(args['compare']) as file_handle:
+                baseline = json.load(file_handle)
+            regressions = compareHotPath(results, baseline, args['tolerance'])
+            if regressions:
+                print('\n%d stages are slower than the baseline' % len(regressions))
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
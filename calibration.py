@@ -0,0 +1,98 @@
+import cv2
+import numpy as np
+
+
+class Calibrator:
+    """
+        Fits the colour limits of the marker to pixels sampled from the camera.
+        The samples of every frame are accumulated into histograms of each BGR and HSV channel (one bincount per
+        channel), so adding a frame costs the same whatever the number of samples collected, and fitting only looks
+        at 256 bins per channel. The limits are the range between the percentile and 100 - percentile of each channel:
+            - 'box': a BGR box, the limits of color_segmenter
+            - 'hsv': an HSV model for ColorModel, with the hue range split in two where it wraps around red
+    """
+
+    def __init__(self, percentile=1.0):
+        self.percentile = percentile
+        self.bgr = np.zeros((3, 256), dtype=np.int64)
+        self.hsv = np.zeros((3, 256), dtype=np.int64)
+        self.samples = 0
+
+    def clear(self):
+        self.bgr.fill(0)
+        self.hsv.fill(0)
+        self.samples = 0
+
+    def add(self, image, rect):
+        """
+            Adds the pixels of the image inside the rectangle (x0, y0, x1, y1) to the histograms.
+        """
+        x0, y0, x1, y1 = rect
+        region = image[y0:y1, x0:x1]
+        if region.size == 0:
+            return
+
+        pixels = region.reshape(-1, 3)
+        hsv = cv2.cvtColor(region, cv2.COLOR_BGR2HSV).reshape(-1, 3)
+        for channel in range(3):
+            self.bgr[channel] += np.bincount(pixels[:, channel], minlength=256)
+            self.hsv[channel] += np.bincount(hsv[:, channel], minlength=256)
+        self.samples += len(pixels)
+
+    def _bounds(self, histogram):
+        """
+            Values at the percentile and 100 - percentile of a histogram.
+        """
+        cumulative = np.cumsum(histogram)
+        total = cumulative[-1]
+        low = int(np.searchsorted(cumulative, total * self.percentile / 100, side='right'))
+        high = int(np.searchsorted(cumulative, total * (1 - self.percentile / 100), side='left'))
+
+        return low, max(high, low)
+
+    def _hueRanges(self):
+        """
+            Hue ranges (OpenCV hue goes from 0 to 179, and red is at both ends). The histogram is rotated so it starts
+            after its longest run of empty bins, so a range around red is found as one range and split in two.
+        """
+        histogram = self.hsv[0, :180]
+        empty = np.concatenate([histogram, histogram]) == 0
+        # Longest run of empty bins in the circular histogram
+        best_end, best_length, length = 0, 0, 0
+        for index, is_empty in enumerate(empty):
+            length = length + 1 if is_empty else 0
+            if length > best_length:
+                best_end, best_length = index, min(length, 180)
+        start = (best_end + 1) % 180
+
+        low, high = self._bounds(np.roll(histogram, -start))
+        low, high = (low + start) % 180, (high + start) % 180
+        if low <= high:
+            return [(low, high)]
+
+        return [(low, 179), (0, high)]
+
+    def box(self):
+        limits = {}
+        for channel, name in enumerate('BGR'):
+            low, high = self._bounds(self.bgr[channel])
+            limits[name] = {'min': low, 'max': high}
+
+        return limits
+
+    def hsvModel(self, bits=6):
+        saturation = self._bounds(self.hsv[1])
+        value = self._bounds(self.hsv[2])
+        ranges = [{'H': {'min': low, 'max': high}, 'S': {'min': saturation[0], 'max': saturation[1]},
+                   'V': {'min': value[0], 'max': value[1]}} for low, high in self._hueRanges()]
+
+        return {'space': 'HSV', 'bits': bits, 'ranges': ranges}
+
+    def fit(self, kind='box'):
+        """
+            Returns the limits fitted to the samples, as a 'box' or an 'hsv' model.
+        """
+        if kind == 'hsv':
+            return self.hsvModel()
+
+        return self.box()
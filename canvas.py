@@ -0,0 +1,238 @@
+import cv2
+import numpy as np
+
+from strokes import StrokeList
+
+WHITE = (255, 255, 255)
+
+
+class Canvas:
+    """
+        White drawing canvas that keeps a coverage mask of its painted (not white) pixels.
+        Every drawing function only updates the coverage inside the rectangle it touched (the dirty rectangle), so
+        putting the canvas over a camera frame is a single masked copy into a reused output buffer, instead of
+        recomputing the mask of the whole canvas on every frame.
+        Rectangles and circles being drawn (while their key is held) are kept in a preview layer: render() draws the
+        preview on top of the shown image and commitPreview() draws it on the canvas only once, when the key is
+        released. The shown image is kept in sync with the canvas by copying only the dirty rectangles.
+        Everything drawn is also recorded as vectors in a StrokeList (see strokes.py): the image is the raster cache
+        of those strokes, updated incrementally with each new line, and they can be exported at any resolution.
+        The image can be given, for example mapped from a file (see persistence.py): its painted pixels are kept, but
+        not as strokes.
+    """
+
+    # Above this number of pending dirty rectangles the whole shown image is refreshed instead
+    max_pending = 64
+
+    def __init__(self, width, height, image=None):
+        self.width = width
+        self.height = height
+        self.image = image if image is not None else np.full((height, width, 3), 255, dtype=np.uint8)
+
+        # Vector record of the strokes, the image is their rasterization
+        self.strokes = StrokeList(width, height)
+
+        # 255 where the canvas is painted, 0 where it is white
+        self.coverage = np.zeros((height, width), dtype=np.uint8)
+
+        # Reused buffer for the shown image (the canvas, or its composition with the camera frame)
+        self.output = np.empty_like(self.image)
+        self.output_synced = False
+        self.pending = []
+
+        # Shape being drawn: (key, kind, *arguments), and the rectangle where it was drawn on the shown image
+        self.preview = None
+        self.preview_rect = None
+
+        # Undo history (see history.py), told about every rectangle before it is drawn
+        self.history = None
+
+        # Functions called with every dirty rectangle, after the image changed there
+        self.watchers = []
+
+        # Incremented on every change of the image, to know if it has to be shown again
+        self.version = 0
+
+        if image is not None:
+            self.refresh((0, 0, width, height))
+
+    def _clip(self, x0, y0, x1, y1):
+        """
+            Clips a rectangle (x1, y1 exclusive) to the canvas. Returns None if nothing is left.
+        """
+        x0, y0 = max(int(x0), 0), max(int(y0), 0)
+        x1, y1 = min(int(x1), self.width), min(int(y1), self.height)
+        if x0 >= x1 or y0 >= y1:
+            return None
+
+        return x0, y0, x1, y1
+
+    def _beforeDraw(self, rect):
+        if self.history is not None:
+            self.history.saveTiles(rect)
+
+    def refresh(self, rect):
+        """
+            Recomputes the coverage only inside the dirty rectangle, after the image was changed there.
+        """
+        if rect is None:
+            return
+        x0, y0, x1, y1 = rect
+
+        white = cv2.inRange(self.image[y0:y1, x0:x1], WHITE, WHITE)
+        cv2.bitwise_not(white, dst=self.coverage[y0:y1, x0:x1])
+        self.version += 1
+
+        for watcher in self.watchers:
+            watcher(rect)
+
+        # The shown image has to copy this rectangle
+        if len(self.pending) < self.max_pending:
+            self.pending.append(rect)
+        else:
+            self.output_synced = False
+
+    @staticmethod
+    def lineRect(pt1, pt2, size):
+        """
+            Rectangle touched by cv2.line (also used for the rectangles, which are made of lines).
+        """
+        pad = size // 2 + 2
+        return (min(pt1[0], pt2[0]) - pad, min(pt1[1], pt2[1]) - pad,
+                max(pt1[0], pt2[0]) + pad + 1, max(pt1[1], pt2[1]) + pad + 1)
+
+    @staticmethod
+    def circleRect(center, radius, size):
+        """
+            Rectangle touched by cv2.circle.
+        """
+        pad = radius + size // 2 + 2
+        return center[0] - pad, center[1] - pad, center[0] + pad + 1, center[1] + pad + 1
+
+    def line(self, pt1, pt2, color, size):
+        rect = self._clip(*self.lineRect(pt1, pt2, size))
+        self._beforeDraw(rect)
+        self.strokes.line(pt1, pt2, color, size)
+        cv2.line(self.image, pt1, pt2, color, size)
+        self.refresh(rect)
+        return rect
+
+    def polyline(self, points, color, size):
+        """
+            Draws an open polyline (an int32 array of points) in one call, as the smoothed strokes are drawn.
+        """
+        x, y, w, h = cv2.boundingRect(points)
+        rect = self._clip(*self.lineRect((x, y), (x + w - 1, y + h - 1), size))
+        self._beforeDraw(rect)
+        self.strokes.polyline(points, color, size)
+        cv2.polylines(self.image, [points], False, color, size)
+        self.refresh(rect)
+        return rect
+
+    def rectangle(self, pt1, pt2, color, size):
+        rect = self._clip(*self.lineRect(pt1, pt2, size))
+        self._beforeDraw(rect)
+        self.strokes.rectangle(pt1, pt2, color, size)
+        cv2.rectangle(self.image, pt1, pt2, color, size)
+        self.refresh(rect)
+        return rect
+
+    def circle(self, center, radius, color, size):
+        rect = self._clip(*self.circleRect(center, radius, size))
+        self._beforeDraw(rect)
+        self.strokes.circle(center, radius, color, size)
+        cv2.circle(self.image, center, radius, color, size)
+        self.refresh(rect)
+        return rect
+
+    def load(self, strokes):
+        """
+            Replaces the canvas with saved strokes, rasterized to the size of the canvas. Strokes saved at another size
+            are letterboxed into it (see StrokeList.resized), so the new strokes are stored at the scale of the old
+            ones. Use it before creating the undo history.
+        """
+        if (strokes.width, strokes.height) != (self.width, self.height):
+            strokes = strokes.resized(self.width, self.height)
+        self.strokes = strokes
+        self.image.fill(255)
+        strokes.render(1.0, self.image)
+        self.coverage.fill(0)
+        self.refresh((0, 0, self.width, self.height))
+
+    def clear(self):
+        """
+            Clears the canvas in place, without allocating a new one.
+        """
+        self._beforeDraw((0, 0, self.width, self.height))
+        self.strokes.clear()
+        self.image.fill(255)
+        self.coverage.fill(0)
+        self.preview = None
+        self.output_synced = False
+        self.version += 1
+
+        for watcher in self.watchers:
+            watcher((0, 0, self.width, self.height))
+
+    def composite(self, frame):
+        """
+            Draws the painted pixels of the canvas over the frame. The result is written in a reused buffer, that is
+            only valid until the next call.
+        """
+        np.copyto(self.output, frame)
+        cv2.copyTo(self.image, self.coverage, self.output)
+        self.output_synced = False
+
+        return self.output
+
+    def setPreview(self, key, kind, *arguments):
+        """
+            Sets the shape being drawn: kind is 'rectangle' or 'circle' and the arguments are the ones of the drawing
+            function of the same name. key is the key that is held while drawing it.
+        """
+        self.preview = (key, kind) + arguments
+
+    def commitPreview(self):
+        """
+            Draws the previewed shape on the canvas and clears the preview.
+        """
+        if self.preview is None:
+            return None
+        _, kind, *arguments = self.preview
+        self.preview = None
+
+        return getattr(self, kind)(*arguments)
+
+    def render(self, frame=None):
+        """
+            Returns the image to show: the canvas, or the canvas over the frame, with the previewed shape on top.
+            Without a frame, only the rectangles changed since the last call are copied to the shown image.
+            The result is written in a reused buffer, that is only valid until the next call.
+        """
+        if frame is not None:
+            self.composite(frame)
+        elif not self.output_synced:
+            np.copyto(self.output, self.image)
+            self.output_synced = True
+        else:
+            # Copy the dirty rectangles, and remove the preview drawn in the last call
+            if self.preview_rect is not None:
+                self.pending.append(self.preview_rect)
+            for x0, y0, x1, y1 in self.pending:
+                self.output[y0:y1, x0:x1] = self.image[y0:y1, x0:x1]
+        self.pending.clear()
+        self.preview_rect = None
+
+        # Draw the preview only on the shown image
+        if self.preview is not None:
+            _, kind, *arguments = self.preview
+            if kind == 'rectangle':
+                pt1, pt2, color, size = arguments
+                cv2.rectangle(self.output, pt1, pt2, color, size)
+                self.preview_rect = self._clip(*self.lineRect(pt1, pt2, size))
+            elif kind == 'circle':
+                center, radius, color, size = arguments
+                cv2.circle(self.output, center, radius, color, size)
+                self.preview_rect = self._clip(*self.circleRect(center, radius, size))
+
+        return self.output
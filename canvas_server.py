@@ -0,0 +1,560 @@
+#!/usr/bin/python3
+import argparse
+import asyncio
+import queue
+import socket
+import struct
+import threading
+import zlib
+
+import cv2
+import numpy as np
+
+from canvas import Canvas
+from strokes import CIRCLE, CLEAR, COUNT, FIRST, KIND, POLYLINE, RECTANGLE, VISIBLE
+
+# Messages: kind (1 byte) + payload length (uint32) + payload. The payloads are
+#   b'H' hello of a client: role (b'D' drawer or b'V' viewer), width and height of its canvas (uint16)
+#   b'S' hello of the server to a viewer: width, height and tile size (uint16)
+#   b'I' new item of the StrokeList of a drawer: index (int32), kind, blue, green, red (uint8), size, radius (uint16),
+#        number of points (uint32), then the points (int16 x, y)
+#   b'A' points appended to the last item of a drawer: index (int32), number of points (uint32), then the points
+#   b'V' items first to last - 1 of a drawer shown (1) or hidden (0) by undo or redo: first, last (int32), visible
+#   b'T' tile of the shared canvas: tx, ty (uint16), then the BGR pixels of the tile, compressed with zlib
+MESSAGE = struct.Struct('<cI')
+HELLO = struct.Struct('<cHH')
+SERVER_HELLO = struct.Struct('<HHH')
+ITEM = struct.Struct('<iBBBBHHI')
+APPEND = struct.Struct('<iI')
+VISIBILITY = struct.Struct('<iiB')
+TILE = struct.Struct('<HH')
+
+DEFAULT_ADDRESS = '127.0.0.1:8765'
+
+
+def parseAddress(address):
+    """
+        'host:port' for TCP, anything else is the path of a Unix socket.
+    """
+    host, _, port = address.rpartition(':')
+    if host and port.isdigit():
+        return host, int(port)
+
+    return address
+
+
+def connect(address):
+    address = parseAddress(address)
+    if isinstance(address, tuple):
+        sock = socket.create_connection(address)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    else:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(address)
+
+    return sock
+
+
+def packMessage(kind, payload):
+    return MESSAGE.pack(kind, len(payload)) + payload
+
+
+def packPoints(points):
+    return np.clip(points, -32768, 32767).astype('<i2').tobytes()
+
+
+def unpackPoints(payload, count):
+    return np.frombuffer(payload, dtype='<i2', count=2 * count).reshape(count, 2).astype(np.int32)
+
+
+def recvExactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('connection closed')
+        data += chunk
+
+    return bytes(data)
+
+
+def recvMessage(sock):
+    kind, length = MESSAGE.unpack(recvExactly(sock, MESSAGE.size))
+
+    return kind, recvExactly(sock, length)
+
+
+class StrokeSync:
+    """
+        Encodes what changed in a StrokeList since the last call as messages for the server: the new items, the points
+        appended to the last one and the items hidden or shown again by undo and redo. The messages grow with the
+        strokes drawn, not with the size of the canvas.
+    """
+
+    def __init__(self):
+        self.strokes = None
+        self.sent_items = 0
+        self.sent_count = 0
+        self.visible = np.zeros(0, dtype=np.int32)
+
+    def delta(self, strokes):
+        # A new StrokeList (a loaded session) is sent from the start
+        if strokes is not self.strokes:
+            self.strokes = strokes
+            self.sent_items = 0
+            self.sent_count = 0
+            self.visible = np.zeros(0, dtype=np.int32)
+
+        items, points = strokes.items, strokes.points
+        messages = []
+
+        # Points added to the last item sent
+        if self.sent_items:
+            item = items[self.sent_items - 1]
+            if item[COUNT] > self.sent_count:
+                first = item[FIRST] + self.sent_count
+                new = points[first:item[FIRST] + item[COUNT]]
+                messages.append(packMessage(b'A', APPEND.pack(self.sent_items - 1, len(new)) + packPoints(new)))
+                self.sent_count = int(item[COUNT])
+
+        # New items, sent as visible (their visibility is sent below)
+        for index in range(self.sent_items, strokes.num_items):
+            kind, first, count, blue, green, red, size, radius, _ = items[index].tolist()
+            payload = ITEM.pack(index, kind, blue, green, red, size, radius, count) + \
+                packPoints(points[first:first + count])
+            messages.append(packMessage(b'I', payload))
+        if strokes.num_items > self.sent_items:
+            self.sent_count = int(items[strokes.num_items - 1, COUNT])
+            self.visible = np.concatenate([self.visible, np.ones(strokes.num_items - self.sent_items, np.int32)])
+            self.sent_items = strokes.num_items
+
+        # Runs of items whose visibility changed
+        visible = items[:self.sent_items, VISIBLE]
+        changed = np.flatnonzero(visible != self.visible)
+        if len(changed):
+            first = last = int(changed[0])
+            for index in changed[1:].tolist() + [None]:
+                if index is None or index != last + 1 or visible[index] != visible[first]:
+                    messages.append(packMessage(b'V', VISIBILITY.pack(first, last + 1, int(visible[first]))))
+                    first = index
+                last = index
+            self.visible = visible.copy()
+
+        return b''.join(messages)
+
+
+class CanvasClient:
+    """
+        Sends the strokes of an ar_paint canvas to a canvas server. sync() is called once per frame: it encodes the
+        changes of the StrokeList (see StrokeSync) and a background thread sends them, so the frame loop never waits
+        for the network. At most one delta waits for the sender: while it is behind (a slow server), sync() does
+        nothing, and the next delta holds every change since the last one, so the memory does not grow.
+        The constructor raises OSError if the server cannot be reached. If the connection is lost later, the client is
+        no longer alive (error tells why) and sync() does nothing, so painting goes on without sharing.
+    """
+
+    def __init__(self, address, canvas):
+        self.canvas = canvas
+        self.sock = connect(address)
+        try:
+            self.sock.sendall(packMessage(b'H', HELLO.pack(b'D', canvas.width, canvas.height)))
+        except OSError:
+            self.sock.close()
+            raise
+        self.stroke_sync = StrokeSync()
+        self.sent_bytes = 0
+        self.alive = True
+        self.error = None
+
+        self.queue = queue.Queue(maxsize=1)
+        self.thread = threading.Thread(target=self._send, name='CanvasClient', daemon=True)
+        self.thread.start()
+
+    def _send(self):
+        while True:
+            data = self.queue.get()
+            if data is None:
+                break
+            # After an error the queue is still emptied, so close() never waits for room
+            if not self.alive:
+                continue
+            try:
+                self.sock.sendall(data)
+            except OSError as error:
+                self.alive = False
+                self.error = error
+                print('Lost the connection to the canvas server: ' + str(error))
+                continue
+            self.sent_bytes += len(data)
+
+    def sync(self):
+        # Only this thread adds to the queue, so it still has room after the check
+        if not self.alive or self.queue.full():
+            return
+        data = self.stroke_sync.delta(self.canvas.strokes)
+        if data:
+            self.queue.put(data)
+
+    def close(self):
+        """
+            Sends the changes not sent yet, waiting for the sender, and closes the connection.
+        """
+        if self.alive:
+            data = self.stroke_sync.delta(self.canvas.strokes)
+            if data:
+                self.queue.put(data)
+        self.queue.put(None)
+        self.thread.join()
+        self.sock.close()
+
+
+class CanvasViewer:
+    """
+        Receives the tiles of the shared canvas in a background thread and keeps an up to date copy of it in image.
+    """
+
+    def __init__(self, address):
+        self.sock = connect(address)
+        self.sock.sendall(packMessage(b'H', HELLO.pack(b'V', 0, 0)))
+        kind, payload = recvMessage(self.sock)
+        self.width, self.height, self.tile_size = SERVER_HELLO.unpack(payload)
+        self.image = np.full((self.height, self.width, 3), 255, dtype=np.uint8)
+        self.lock = threading.Lock()
+        self.tiles = 0
+        self.received_bytes = 0
+        self.version = 0
+
+        self.thread = threading.Thread(target=self._receive, name='CanvasViewer', daemon=True)
+        self.thread.start()
+
+    def _receive(self):
+        t = self.tile_size
+        while True:
+            try:
+                kind, payload = recvMessage(self.sock)
+            except (ConnectionError, OSError):
+                break
+            if kind != b'T':
+                continue
+
+            tx, ty = TILE.unpack_from(payload)
+            with self.lock:
+                tile = self.image[ty * t:(ty + 1) * t, tx * t:(tx + 1) * t]
+                tile[...] = np.frombuffer(zlib.decompress(payload[TILE.size:]), dtype=np.uint8).reshape(tile.shape)
+                self.tiles += 1
+                self.received_bytes += MESSAGE.size + len(payload)
+                self.version += 1
+
+    def close(self):
+        self.sock.close()
+
+
+class CanvasServer:
+    """
+        Shared canvas of several ar_paint stations. The drawers send the changes of their StrokeList (see StrokeSync),
+        which the server draws on its own Canvas in the order they arrive, scaled to its size. The tiles changed are
+        sent to the viewers at most rate times per second, compressed, so the traffic grows with the ink drawn and not
+        with the size of the canvas times the frame rate. A new viewer receives the tiles that are not white.
+        The points appended to the last item of a drawer extend its server item in place, unless something drawn after
+        it by another drawer is under them, so a stroke is usually one item and not one per frame.
+        Undo and redo hide or show items. The server keeps the rectangle of every item, and draws again only the
+        rectangle of the items toggled, with the visible items that overlap it, to find the tiles that changed: the
+        work grows with the ink there and not with the size of the canvas or the length of the history.
+    """
+
+    def __init__(self, width=640, height=480, tile_size=64, rate=30):
+        self.canvas = Canvas(width, height)
+        self.tile_size = tile_size
+        self.rate = rate
+        self.tiles_x = (width + tile_size - 1) // tile_size
+        self.tiles_y = (height + tile_size - 1) // tile_size
+
+        # Rectangle (x0, y0, x1, y1) of each server item, and the image the toggled rectangles are drawn again in
+        self.rects = np.zeros((64, 4), dtype=np.int32)
+        self.scratch = None
+
+        self.dirty = set()
+        self.viewers = set()
+        self.handlers = set()
+        self.canvas.watchers.append(self._markDirty)
+
+        # Counters
+        self.messages = 0
+        self.received_bytes = 0
+        self.sent_bytes = 0
+        self.sent_tiles = 0
+
+    def _markDirty(self, rect):
+        x0, y0, x1, y1 = rect
+        t = self.tile_size
+        for ty in range(y0 // t, (y1 - 1) // t + 1):
+            for tx in range(x0 // t, (x1 - 1) // t + 1):
+                self.dirty.add((tx, ty))
+
+    def _tileRect(self, tx, ty):
+        t = self.tile_size
+        return tx * t, ty * t, min((tx + 1) * t, self.canvas.width), min((ty + 1) * t, self.canvas.height)
+
+    def _tileMessage(self, tx, ty):
+        x0, y0, x1, y1 = self._tileRect(tx, ty)
+        tile = np.ascontiguousarray(self.canvas.image[y0:y1, x0:x1])
+
+        return packMessage(b'T', TILE.pack(tx, ty) + zlib.compress(tile.tobytes(), 1))
+
+    def _setRect(self, index, rect):
+        """
+            Adds a rectangle to the one of a server item.
+        """
+        while index >= len(self.rects):
+            self.rects = np.concatenate([self.rects, np.zeros_like(self.rects)])
+        if rect is None:
+            return
+        old = self.rects[index].tolist()
+        self.rects[index] = rect if old[0] >= old[2] else (min(old[0], rect[0]), min(old[1], rect[1]),
+                                                           max(old[2], rect[2]), max(old[3], rect[3]))
+
+    def _draw(self, kind, points, color, size, radius):
+        """
+            Draws a new item of a drawer as a new item of the server strokes. Returns its index.
+        """
+        strokes = self.canvas.strokes
+        # The items of different drawers are never merged
+        strokes.seal()
+        rect = None
+        if kind == POLYLINE:
+            rect = self.canvas.polyline(points, color, size)
+        elif kind == RECTANGLE:
+            rect = self.canvas.rectangle(tuple(points[0]), tuple(points[1]), color, size)
+        elif kind == CIRCLE:
+            rect = self.canvas.circle(tuple(points[0]), radius, color, size)
+        elif kind == CLEAR:
+            self.canvas.clear()
+            rect = (0, 0, self.canvas.width, self.canvas.height)
+
+        index = strokes.num_items - 1
+        self._setRect(index, rect)
+
+        return index
+
+    def _extend(self, index, points, color, size):
+        """
+            Draws points that continue the server polyline index from its last point. They are added to it in place
+            if nothing drawn after it is under them, so the order of the items does not change what is seen, and
+            as a new item otherwise. Returns the index of the server item that has them.
+        """
+        strokes = self.canvas.strokes
+        last = strokes.points[strokes.items[index, FIRST] + strokes.items[index, COUNT] - 1]
+        line = np.vstack([last, points])
+        x, y, w, h = cv2.boundingRect(line)
+        rect = self.canvas._clip(*self.canvas.lineRect((x, y), (x + w - 1, y + h - 1), size))
+
+        later = self.rects[index + 1:strokes.num_items]
+        if not strokes.items[index, VISIBLE] or (rect is not None and np.any(
+                (later[:, 0] < rect[2]) & (later[:, 2] > rect[0]) & (later[:, 1] < rect[3]) & (later[:, 3] > rect[1]))):
+            return self._draw(POLYLINE, line, color, size, 0)
+
+        strokes.extend(index, points)
+        if rect is not None:
+            cv2.polylines(self.canvas.image, [line], False, color, size)
+            self.canvas.refresh(rect)
+            self._setRect(index, rect)
+
+        return index
+
+    def _setVisible(self, indexes, visible):
+        """
+            Hides or shows items and redraws the tiles that changed, inside the rectangle of the items.
+        """
+        strokes = self.canvas.strokes
+        strokes.items[indexes, VISIBLE] = int(visible)
+        if not indexes:
+            return
+
+        # A clear changes the whole canvas, the other items their rectangles
+        width, height = self.canvas.width, self.canvas.height
+        if np.any(strokes.items[indexes, KIND] == CLEAR):
+            x0, y0, x1, y1 = 0, 0, width, height
+        else:
+            rects = self.rects[indexes]
+            rects = rects[(rects[:, 2] > rects[:, 0]) & (rects[:, 3] > rects[:, 1])]
+            if not len(rects):
+                return
+            x0, y0 = rects[:, :2].min(axis=0).tolist()
+            x1, y1 = rects[:, 2:].max(axis=0).tolist()
+
+        # The visible items over the rectangle, drawn whole in an image of the size of the canvas (drawing them moved
+        # into a smaller image would clip them differently) on the rectangle cleared to white
+        visible = strokes.visibleIndexes()
+        rects = self.rects[visible]
+        visible = visible[(rects[:, 0] < x1) & (rects[:, 2] > x0) & (rects[:, 1] < y1) & (rects[:, 3] > y0)]
+        if self.scratch is None:
+            self.scratch = np.empty_like(self.canvas.image)
+        self.scratch[y0:y1, x0:x1] = 255
+        strokes.render(1.0, self.scratch, visible)
+
+        t = self.tile_size
+        for ty in range(y0 // t, (y1 - 1) // t + 1):
+            for tx in range(x0 // t, (x1 - 1) // t + 1):
+                # Only the part of the tile inside the rectangle was drawn again
+                tile = (slice(max(ty * t, y0), min((ty + 1) * t, y1)), slice(max(tx * t, x0), min((tx + 1) * t, x1)))
+                if not np.array_equal(self.scratch[tile], self.canvas.image[tile]):
+                    self.canvas.image[tile] = self.scratch[tile]
+                    self.canvas.refresh((tile[1].start, tile[0].start, tile[1].stop, tile[0].stop))
+
+    def apply(self, drawer, kind, payload):
+        """
+            Applies a message of a drawer. drawer is its state: scale and the server items of each of its items.
+        """
+        scale, mapping = drawer['scale'], drawer['items']
+
+        if kind == b'I':
+            index, item_kind, blue, green, red, size, radius, count = ITEM.unpack_from(payload)
+            points = unpackPoints(payload[ITEM.size:], count)
+            if scale != 1:
+                points = np.round(points * scale).astype(np.int32)
+                size, radius = max(int(round(size * scale)), 1), int(round(radius * scale))
+            mapping.append([self._draw(item_kind, points, (blue, green, red), size, radius)])
+            drawer['pens'].append(((blue, green, red), size))
+
+        elif kind == b'A':
+            index, count = APPEND.unpack_from(payload)
+            points = unpackPoints(payload[APPEND.size:], count)
+            if scale != 1:
+                points = np.round(points * scale).astype(np.int32)
+            # The new points continue the item from its last point
+            color, size = drawer['pens'][index]
+            server_index = self._extend(mapping[index][-1], points, color, size)
+            if server_index != mapping[index][-1]:
+                mapping[index].append(server_index)
+
+        elif kind == b'V':
+            first, last, visible = VISIBILITY.unpack(payload)
+            indexes = [server_index for index in range(first, last) for server_index in mapping[index]]
+            self._setVisible(indexes, visible)
+
+    async def broadcast(self):
+        """
+            Sends the changed tiles to the viewers, at most rate times per second.
+        """
+        while True:
+            await asyncio.sleep(1 / self.rate)
+            if not self.dirty or not self.viewers:
+                continue
+
+            data = b''.join(self._tileMessage(tx, ty) for tx, ty in sorted(self.dirty))
+            self.sent_tiles += len(self.dirty) * len(self.viewers)
+            self.dirty.clear()
+            for writer in list(self.viewers):
+                writer.write(data)
+                self.sent_bytes += len(data)
+            await asyncio.gather(*(writer.drain() for writer in list(self.viewers)), return_exceptions=True)
+
+    async def handle(self, reader, writer):
+        self.handlers.add(asyncio.current_task())
+        try:
+            kind, length = MESSAGE.unpack(await reader.readexactly(MESSAGE.size))
+            role, width, height = HELLO.unpack(await reader.readexactly(length))
+
+            if role == b'V':
+                # A new viewer gets the size of the canvas and its painted tiles
+                writer.write(packMessage(b'S', SERVER_HELLO.pack(self.canvas.width, self.canvas.height,
+                                                                 self.tile_size)))
+                t = self.tile_size
+                for ty in range(self.tiles_y):
+                    for tx in range(self.tiles_x):
+                        if self.canvas.coverage[ty * t:(ty + 1) * t, tx * t:(tx + 1) * t].any():
+                            writer.write(self._tileMessage(tx, ty))
+                await writer.drain()
+                self.viewers.add(writer)
+                # Wait until the viewer disconnects
+                await reader.read()
+                return
+
+            drawer = {'scale': self.canvas.width / width, 'items': [], 'pens': []}
+            while True:
+                kind, length = MESSAGE.unpack(await reader.readexactly(MESSAGE.size))
+                payload = await reader.readexactly(length)
+                self.apply(drawer, kind, payload)
+                self.messages += 1
+                self.received_bytes += MESSAGE.size + length
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            # Disconnected, or the server is stopping
+            pass
+        finally:
+            self.viewers.discard(writer)
+            self.handlers.discard(asyncio.current_task())
+            writer.close()
+
+    async def serve(self, address, ready=None):
+        """
+            Serves on a 'host:port' TCP address or a Unix socket path until cancelled. ready, if given, is a
+            threading.Event set once the server listens.
+        """
+        address = parseAddress(address)
+        if isinstance(address, tuple):
+            server = await asyncio.start_server(self.handle, *address)
+        else:
+            server = await asyncio.start_unix_server(self.handle, address)
+
+        broadcast = asyncio.ensure_future(self.broadcast())
+        if ready is not None:
+            ready.set()
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            # Stop the connections too, so nothing is left pending in the loop
+            tasks = [broadcast] + list(self.handlers)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Shared canvas of several AR_PAINT stations')
+    subparsers = ap.add_subparsers(dest='command', required=True)
+
+    ap_serve = subparsers.add_parser('serve', help='Run the canvas server.')
+    ap_serve.add_argument('-a', '--address', default=DEFAULT_ADDRESS,
+                          help='host:port to listen on, or the path of a Unix socket.')
+    ap_serve.add_argument('-W', '--width', type=int, default=640, help='Width of the shared canvas.')
+    ap_serve.add_argument('-H', '--height', type=int, default=480, help='Height of the shared canvas.')
+    ap_serve.add_argument('-t', '--tile_size', type=int, default=64, help='Size of the tiles sent to the viewers.')
+    ap_serve.add_argument('-r', '--rate', type=float, default=30, help='Updates per second sent to the viewers.')
+
+    ap_view = subparsers.add_parser('view', help='Show the shared canvas, e.g. on a projector.')
+    ap_view.add_argument('-a', '--address', default=DEFAULT_ADDRESS, help='Address of the canvas server.')
+    ap_view.add_argument('-f', '--fullscreen', action='store_true', help='Show the canvas in full screen.')
+    args = vars(ap.parse_args())
+
+    if args['command'] == 'serve':
+        server = CanvasServer(args['width'], args['height'], args['tile_size'], args['rate'])
+        print('Serving a ' + str(args['width']) + 'x' + str(args['height']) + ' canvas on ' + args['address'])
+        try:
+            asyncio.run(server.serve(args['address']))
+        except KeyboardInterrupt:
+            print('%d messages, %d bytes received, %d bytes sent' % (server.messages, server.received_bytes,
+                                                                     server.sent_bytes))
+        return
+
+    viewer = CanvasViewer(args['address'])
+    name = 'Shared canvas'
+    cv2.namedWindow(name, cv2.WINDOW_NORMAL)
+    if args['fullscreen']:
+        cv2.setWindowProperty(name, cv2.WND_PROP_FULLSCREEN, cv2.WINDOW_FULLSCREEN)
+    version = -1
+    while True:
+        # Only show the canvas when tiles arrived
+        if viewer.version != version:
+            with viewer.lock:
+                version = viewer.version
+                cv2.imshow(name, viewer.image)
+        key = cv2.waitKey(30)
+        if key & 0xFF == ord('q'):
+            break
+    viewer.close()
+    cv2.destroyAllWindows()
+
+
+if __name__ == '__main__':
+    main()
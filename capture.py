@@ -0,0 +1,164 @@
+import threading
+
+import cv2
+
+
+class FrameGrabber:
+    """
+        Reads frames from a camera (or video file) in a background thread into a fixed ring of preallocated buffers.
+        With drop=True the consumer always receives the newest frame (latest-frame-wins) and the frames it never read
+        are counted as dropped. With drop=False the frames are delivered in order and the producer waits for free
+        buffers instead (useful for video files, where no frame should be lost).
+        It has the same isOpened/read/release methods as cv2.VideoCapture, so it can be used in its place.
+        The source is opened in the thread too (opening a camera can take a second), so the program can set up its
+        windows meanwhile: isOpened is True while it opens, read waits for the first frame and returns False if the
+        source could not be opened, with the reason in error.
+    """
+
+    def __init__(self, source=0, buffers=3, drop=True):
+        # The ring needs at least one buffer being written, one published and one held by the consumer
+        if buffers < 3:
+            raise ValueError('FrameGrabber needs at least 3 buffers, got ' + str(buffers))
+
+        self.source = source
+        self.capture = None
+        self.error = None
+        self.opened = threading.Event()
+
+        self.drop = drop
+        self.buffers = [None] * buffers
+        self.free = list(range(buffers))
+        self.filled = []
+        self.held = None
+
+        # Counters
+        self.captured = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+
+        self.running = True
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._produce, name='FrameGrabber', daemon=True)
+        self.thread.start()
+
+    def _open(self):
+        """
+            Opens the source, in the capture thread. Returns False if it failed or the grabber was released meanwhile.
+        """
+        try:
+            capture = cv2.VideoCapture(self.source)
+            error = None if capture.isOpened() else 'could not open ' + str(self.source)
+        except cv2.error as exception:
+            capture = None
+            error = str(exception)
+
+        if error is None:
+            # Keep the driver queue as short as possible, the ring is our queue
+            capture.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        elif capture is not None:
+            capture.release()
+            capture = None
+
+        with self.condition:
+            self.capture = capture
+            self.error = error
+            if error is not None:
+                self.running = False
+            self.condition.notify_all()
+        self.opened.set()
+
+        return self.running
+
+    def _produce(self):
+        """
+            Capture loop that runs in its own thread.
+        """
+        if not self._open():
+            return
+
+        while True:
+            # Pick a buffer to write into
+            with self.condition:
+                while self.running and not self.free and not (self.drop and self.filled):
+                    self.condition.wait()
+                if not self.running:
+                    break
+                if self.free:
+                    slot = self.free.pop()
+                else:
+                    # Latest-frame-wins: overwrite the oldest frame the consumer did not read
+                    slot = self.filled.pop(0)
+                    self.dropped += 1
+
+            # Read outside of the lock, reusing the buffer of this slot
+            ret, image = self.capture.read(self.buffers[slot])
+
+            with self.condition:
+                if not ret:
+                    self.free.append(slot)
+                    self.running = False
+                    self.condition.notify_all()
+                    break
+                self.buffers[slot] = image
+                self.filled.append(slot)
+                self.captured += 1
+                self.condition.notify_all()
+
+    def isOpened(self):
+        with self.condition:
+            return self.running or bool(self.filled)
+
+    def read(self):
+        """
+            Returns (ret, frame) like cv2.VideoCapture.read. The frame is a buffer of the ring, that stays valid until
+            the next call to read.
+        """
+        with self.condition:
+            while self.running and not self.filled:
+                self.condition.wait()
+            if not self.filled:
+                return False, None
+
+            # Give back the buffer of the previous read
+            if self.held is not None:
+                self.free.append(self.held)
+
+            self.queue_depth = len(self.filled)
+            self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+
+            if self.drop:
+                # Use the newest frame and recycle the stale ones
+                self.held = self.filled.pop()
+                self.dropped += len(self.filled)
+                self.free.extend(self.filled)
+                self.filled.clear()
+            else:
+                self.held = self.filled.pop(0)
+
+            self.delivered += 1
+            self.condition.notify_all()
+            return True, self.buffers[self.held]
+
+    def get(self, prop_id):
+        # The properties are only known once the source is open
+        self.opened.wait()
+        return self.capture.get(prop_id) if self.capture is not None else 0
+
+    def stats(self):
+        """
+            Returns the counters used to see where frames are lost.
+        """
+        with self.condition:
+            return {'captured': self.captured, 'delivered': self.delivered, 'dropped': self.dropped,
+                    'queue_depth': self.queue_depth, 'max_queue_depth': self.max_queue_depth}
+
+    def release(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        if self.thread.is_alive():
+            self.thread.join()
+        if self.capture is not None:
+            self.capture.release()
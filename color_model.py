@@ -0,0 +1,358 @@
+import hashlib
+import json
+import os
+import threading
+
+import cv2
+import numpy as np
+
+from lighting import LightingCompensator
+
+
+def isBox(limits):
+    """
+        True for the limits written by color_segmenter: {'B': {'min': .., 'max': ..}, 'G': .., 'R': ..}
+    """
+    return isinstance(limits, dict) and all(channel in limits for channel in 'BGR')
+
+
+def isMarkers(limits):
+    """
+        True for the limits of several markers: {'markers': [{'limits': .., 'pen': ..}, ...]}
+    """
+    return isinstance(limits, dict) and 'markers' in limits
+
+
+# Part of the json of the limits hashed with it for the cached tables, changed when the tables change
+TABLE_FORMAT = b'quantized-1\n'
+
+
+class LookupTable:
+    """
+        Table of 2^(3 * bits) entries over the quantized BGR colours (256 KB at 6 bits, so it stays in the cache),
+        indexed by b + g * 2^bits + r * 2^(2 * bits) with each channel shifted right to its bits.
+        The frame is converted to BGRA and each pixel, read as a 32 bit integer, is masked (clearing alpha and the
+        dropped bits) and shifted in one operation, which leaves the bytes b, g, r and 0 of its cell. Up to 6 bits those
+        bytes are also the int16 coordinates (b + 256 * g, r) of the entry in the table laid out as an image of rows of
+        256 * 2^bits (grid), and cv2.remap does the lookup. With more bits (too wide for cv2.remap) the pixel is the
+        index of np.take in the table laid out with 256 entries for b and g (the table itself with 8 bits).
+        The gains of a LightingCompensator are folded in the table: each cell takes the entry of the cell its centre
+        falls in under the reference illumination, so following the illumination costs nothing per frame. The table
+        of the last gains is kept for each thread.
+        The buffers are kept for each thread, the table can be used by several segmentation workers at once.
+    """
+
+    def __init__(self, table, bits):
+        self.table = table
+        self.bits = bits
+        self.shift = 8 - bits
+        levels = 1 << bits
+
+        # Kept bits of b, g and r in a little endian BGRA pixel
+        self.mask = np.uint32(((0xFF >> self.shift) << self.shift) * 0x010101)
+
+        self.grid = self._layout(table)
+        self.buffers = threading.local()
+
+    def _layout(self, table):
+        """
+            The table laid out for the lookup: as an image for cv2.remap, or with 256 entries for b and g.
+        """
+        levels = 1 << self.bits
+        cells = table.reshape(levels, levels, levels)
+        if self.bits <= 6:
+            grid = np.zeros((levels, 256 * levels), dtype=np.uint8)
+            grid.reshape(levels, levels, 256)[:, :, :levels] = cells
+            return grid
+
+        grid = np.zeros((levels, 256, 256), dtype=np.uint8)
+        grid[:, :levels, :levels] = cells
+        return grid.reshape(-1)
+
+    def _lightingGrid(self, gains):
+        key = gains.tobytes()
+        cached = getattr(self.buffers, 'lighting_grid', None)
+        if cached is None or cached[0] != key:
+            # Cell of each channel under the reference illumination, for the centre of each cell of the frame
+            step = 1 << self.shift
+            centres = np.arange(1 << self.bits) * step + step // 2
+            b, g, r = (np.clip(np.round(centres / gain), 0, 255).astype(np.intp) >> self.shift for gain in gains)
+            levels = 1 << self.bits
+            table = self.table.reshape(levels, levels, levels)[np.ix_(r, g, b)]
+            cached = self.buffers.lighting_grid = (key, self._layout(table))
+
+        return cached[1]
+
+    def apply(self, image, out=None, gains=None):
+        """
+            Looks every pixel of a BGR image up in the table, under the illumination of the gains if given. The result
+            is written in out if given.
+        """
+        h, w = image.shape[:2]
+        packed = getattr(self.buffers, 'packed', None)
+        if packed is None or packed.shape[:2] != (h, w):
+            packed = self.buffers.packed = np.empty((h, w, 4), dtype=np.uint8)
+        cv2.cvtColor(image, cv2.COLOR_BGR2BGRA, dst=packed)
+
+        pixels = packed.view('<u4').reshape(h, w)
+        np.bitwise_and(pixels, self.mask, out=pixels)
+        if self.shift:
+            np.right_shift(pixels, self.shift, out=pixels)
+
+        grid = self.grid if gains is None else self._lightingGrid(gains)
+        if grid.ndim == 1:
+            return np.take(grid, pixels, out=out)
+        return cv2.remap(grid, packed.view(np.int16), None, cv2.INTER_NEAREST, dst=out)
+
+
+def createModel(limits):
+    """
+        Compiles limits already read from json: a MarkerModel for several markers, a ColorModel otherwise.
+    """
+    if isMarkers(limits):
+        return MarkerModel(limits)
+
+    return ColorModel(limits)
+
+
+def loadModel(file_name):
+    """
+        Loads a limits json file as a MarkerModel for several markers, or a ColorModel otherwise.
+    """
+    with open(file_name) as file_handle:
+        limits = json.load(file_handle)
+    if isMarkers(limits):
+        return MarkerModel.load(file_name)
+
+    return ColorModel.load(file_name)
+
+
+class ColorModel:
+    """
+        Compiled colour segmentation model, shared by ar_paint and color_segmenter.
+        The model is built once from the limits and can be:
+            - the classic box of color_segmenter: {'B': {'min': 0, 'max': 50}, 'G': {...}, 'R': {...}}
+            - several boxes and ellipsoids, in BGR or HSV:
+              {'space': 'HSV', 'bits': 6,
+               'ranges': [{'H': {'min': 0, 'max': 10}, 'S': {...}, 'V': {...}}, ...],
+               'ellipsoids': [{'center': [170, 200, 150], 'radius': [10, 40, 60]}, ...]}
+        Any model other than a single BGR box is compiled into a lookup table (see LookupTable) over the BGR colours
+        quantized to the given bits per channel, so the cost per frame is one table lookup, whatever the number of
+        regions. A single BGR box uses cv2.inRange, which is exact and the fastest for that case.
+        With a LightingCompensator (see lighting.py) in lighting, the box is scaled to the illumination of the frame and
+        the lookup maps the frames back to the illumination of the table. apply() takes the gains of the frame, given
+        by the compensator when it was updated with it (by the pipeline, or by createMask), or uses its last gains.
+    """
+
+    def __init__(self, limits, table=None):
+        self.limits = limits
+        self.box = None
+        self.table = table
+        self.lighting = None
+
+        if isBox(limits):
+            # The arrays are built once, not on every frame
+            self.box = (np.array([limits['B']['min'], limits['G']['min'], limits['R']['min']]),
+                        np.array([limits['B']['max'], limits['G']['max'], limits['R']['max']]))
+        else:
+            if self.table is None:
+                self.table = self.buildTable(limits)
+            self.lookup = LookupTable(self.table, limits.get('bits', 6))
+
+    @staticmethod
+    def buildTable(limits, bits=None):
+        """
+            Evaluates the model on the centre of every quantized BGR colour and returns a table of LookupTable (0 or
+            255). bits defaults to the ones of the limits. A BGR box can be given too.
+        """
+        if bits is None:
+            bits = limits.get('bits', 6)
+        if isBox(limits):
+            limits = {'ranges': [limits]}
+        levels = 1 << bits
+        step = 256 // levels
+
+        # Centres of the quantized cells, as an image with one pixel per colour
+        values = (np.arange(levels) * step + step // 2).astype(np.uint8)
+        r, g, b = np.meshgrid(values, values, values, indexing='ij')
+        colors = np.stack([b, g, r], axis=-1).reshape(1, -1, 3)
+        if limits.get('space', 'BGR').upper() == 'HSV':
+            colors = cv2.cvtColor(colors, cv2.COLOR_BGR2HSV)
+            channels = 'HSV'
+        else:
+            channels = 'BGR'
+        colors = colors.reshape(-1, 3).astype(np.float32)
+
+        inside = np.zeros(len(colors), dtype=bool)
+
+        # Union of the boxes
+        for box in limits.get('ranges', []):
+            low = np.array([box[c]['min'] for c in channels])
+            high = np.array([box[c]['max'] for c in channels])
+            inside |= np.all((colors >= low) & (colors <= high), axis=1)
+
+        # Union of the ellipsoids
+        for ellipsoid in limits.get('ellipsoids', []):
+            center = np.array(ellipsoid['center'], dtype=np.float32)
+            radius = np.broadcast_to(np.array(ellipsoid['radius'], dtype=np.float32), (3,))
+            inside |= np.sum(((colors - center) / radius) ** 2, axis=1) <= 1
+
+        return inside.astype(np.uint8) * 255
+
+    @classmethod
+    def load(cls, file_name):
+        """
+            Loads the model from a limits json file. The lookup table is cached next to it, in a .lut.npz file that is
+            only used while the json file does not change.
+        """
+        with open(file_name, 'rb') as file_handle:
+            content = file_handle.read()
+        limits = json.loads(content)
+
+        if isBox(limits):
+            return cls(limits)
+
+        digest = hashlib.sha1(TABLE_FORMAT + content).hexdigest()
+        cache_name = os.path.splitext(file_name)[0] + '.lut.npz'
+
+        # Use the cached table if it was built from the same json
+        if os.path.exists(cache_name):
+            with np.load(cache_name) as cache:
+                if str(cache['digest']) == digest:
+                    return cls(limits, np.unpackbits(cache['table']) * np.uint8(255))
+
+        model = cls(limits)
+        np.savez_compressed(cache_name, digest=digest, table=np.packbits(model.table > 0))
+
+        return model
+
+    def apply(self, image, out=None, gains=None):
+        """
+            Returns the mask (0 or 255) of the pixels of a BGR image that belong to the model, written in out if given.
+            gains are the ones of the LightingCompensator for this image, its last ones by default.
+        """
+        if gains is None and self.lighting is not None:
+            gains = self.lighting.gains
+
+        if self.box is not None:
+            if gains is not None:
+                return cv2.inRange(image, *LightingCompensator.scaleBox(*self.box, gains), dst=out)
+            return cv2.inRange(image, self.box[0], self.box[1], dst=out)
+
+        return self.lookup.apply(image, out, gains)
+
+
+class MarkerModel:
+    """
+        Colour model of several markers, one per user, each with the limits of its colour (any limits accepted by
+        ColorModel) and the pen it paints with:
+            {'markers': [{'name': 'red', 'limits': {'B': .., 'G': .., 'R': ..}, 'pen': {'color': [0, 0, 255], 'size': 5}},
+                         {'name': 'green', 'limits': {'space': 'HSV', 'ranges': [..]}, 'pen': {...}}, ...],
+             'min_area': 100, 'bits': 6}
+        The result is an image of marker numbers (0 for none, i + 1 for the marker i, the first marker wins where they
+        overlap), which is also a mask of every marker for the labelling.
+        When every marker is a BGR box, each one is segmented with cv2.inRange, which is exact, and they are combined
+        with cv2.max over their priorities. Otherwise all the markers are compiled into one LookupTable of marker
+        numbers, over the colours quantized to bits per channel (the most bits of the markers by default), so
+        segmenting the frame is one table lookup whatever the number of markers.
+        A LightingCompensator in lighting follows the illumination, with the gains given to apply(), as in ColorModel.
+    """
+
+    def __init__(self, limits, table=None):
+        self.limits = limits
+        self.markers = limits['markers']
+        self.min_area = limits.get('min_area', 100)
+        self.lighting = None
+
+        self.boxes = None
+        self.table = None
+        if all(isBox(marker['limits']) for marker in self.markers):
+            self.boxes = [ColorModel(marker['limits']).box for marker in self.markers]
+            # Priority of each marker number (the first marker has the highest) and the number of each priority
+            count = len(self.markers)
+            self.priorities = np.zeros((256, 1), dtype=np.uint8)
+            self.priorities[1:count + 1, 0] = np.arange(count, 0, -1)
+            self.buffers = threading.local()
+        else:
+            self.bits = self.tableBits(limits)
+            self.table = table if table is not None else self.buildTable(limits)
+            self.lookup = LookupTable(self.table, self.bits)
+
+    @staticmethod
+    def tableBits(limits):
+        return limits.get('bits', max(marker['limits'].get('bits', 6) for marker in limits['markers']))
+
+    @staticmethod
+    def buildTable(limits):
+        bits = MarkerModel.tableBits(limits)
+        table = np.zeros(1 << (3 * bits), dtype=np.uint8)
+        # The first marker wins, so they are written in reverse order
+        for number in range(len(limits['markers']), 0, -1):
+            table[ColorModel.buildTable(limits['markers'][number - 1]['limits'], bits) > 0] = number
+
+        return table
+
+    def pen(self, marker):
+        """
+            Returns the (color, size) the marker paints with.
+        """
+        pen = self.markers[marker].get('pen', {})
+        return tuple(pen.get('color', (255, 0, 0))), pen.get('size', 5)
+
+    @classmethod
+    def load(cls, file_name):
+        """
+            Loads the model from a json file, with the table cached next to it as in ColorModel.load.
+        """
+        with open(file_name, 'rb') as file_handle:
+            content = file_handle.read()
+        limits = json.loads(content)
+
+        if all(isBox(marker['limits']) for marker in limits['markers']):
+            return cls(limits)
+
+        digest = hashlib.sha1(TABLE_FORMAT + content).hexdigest()
+        cache_name = os.path.splitext(file_name)[0] + '.lut.npz'
+
+        if os.path.exists(cache_name):
+            with np.load(cache_name) as cache:
+                if str(cache['digest']) == digest:
+                    return cls(limits, cache['table'])
+
+        model = cls(limits)
+        np.savez_compressed(cache_name, digest=digest, table=model.table)
+
+        return model
+
+    def _applyBoxes(self, image, out, gains):
+        h, w = image.shape[:2]
+        if out is None:
+            out = np.empty((h, w), dtype=np.uint8)
+        mask = getattr(self.buffers, 'mask', None)
+        if mask is None or mask.shape != (h, w):
+            mask = self.buffers.mask = np.empty((h, w), dtype=np.uint8)
+
+        # Each marker as its priority, the highest one is kept where they overlap
+        out.fill(0)
+        count = len(self.boxes)
+        for number, (low, high) in enumerate(self.boxes, 1):
+            if gains is not None:
+                low, high = LightingCompensator.scaleBox(low, high, gains)
+            cv2.inRange(image, low, high, dst=mask)
+            cv2.bitwise_and(mask, count + 1 - number, dst=mask)
+            cv2.max(out, mask, dst=out)
+
+        return cv2.LUT(out, self.priorities, dst=out)
+
+    def apply(self, image, out=None, gains=None):
+        """
+            Returns the image of marker numbers (0 where there is no marker, i + 1 for the marker i), written in out if
+            given. gains are the ones of the LightingCompensator for this image, as in ColorModel.apply.
+        """
+        if gains is None and self.lighting is not None:
+            gains = self.lighting.gains
+
+        if self.boxes is not None:
+            return self._applyBoxes(image, out, gains)
+
+        return self.lookup.apply(image, out, gains)
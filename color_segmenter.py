@@ -1,11 +1,45 @@
+import argparse
 import json
+import time
 from functools import partial
 from colorama import Fore, Back, Style
+from calibration import Calibrator
+from color_model import ColorModel, isBox, isMarkers
+from lighting import LightingCompensator
 from my_functions import *
+from profiler import NullProfiler, Profiler
 from termcolor import cprint
 
 
 def main():
+    # Create argparse
+    ap = argparse.ArgumentParser(description='Define the colour limits of the marker')
+    ap.add_argument('-j', '--json', help='Limits json file to start from. Models that are not a single box are '
+                                         'previewed until a trackbar is moved.')
+    ap.add_argument('-prof', '--profile', action='store_true',
+                    help='Time each stage of the loop and show the fps and milliseconds on the Camera window.')
+    ap.add_argument('--trace', help='Save the timings of every stage to this Chrome trace / Perfetto json file '
+                                    '(implies --profile).')
+    ap.add_argument('-cal', '--calibration', choices=['box', 'hsv'], default='box',
+                    help='Model fitted to the pixels selected with the mouse: a BGR box or an HSV model.')
+    ap.add_argument('-p', '--percentile', type=float, default=1.0,
+                    help='Percentage of the sampled pixels left out at each end of every channel.')
+    args = vars(ap.parse_args())
+
+    # Time the stages only when asked, the null profiler does nothing
+    if args['profile'] or args['trace'] is not None:
+        profiler = Profiler(trace=args['trace'] is not None)
+    else:
+        profiler = NullProfiler()
+
+    # Colour model used to create the mask, the same used by ar_paint
+    model = None
+    if args['json'] is not None:
+        with open(args['json']) as file_handle:
+            if isMarkers(json.load(file_handle)):
+                ap.error(args['json'] + ' has several markers, edit the limits of one of them in a file of its own')
+        model = ColorModel.load(args['json'])
+
     # Webcam video capture
     capture = cv2.VideoCapture(0)  # Camera 0 selected
 
@@ -15,49 +49,137 @@ def main():
     window_2 = 'Mask'
     cv2.namedWindow(window_2, cv2.WINDOW_AUTOSIZE)
 
+    # The trackbars are only read after one of them moves
+    trackbars_moved = [False]
+
+    def onTrackbar(_):
+        trackbars_moved[0] = True
+
+    # Calibration: the pixels inside the rectangle dragged with the mouse are sampled on every frame while the button
+    # is held, and the model is fitted to them
+    calibrator = Calibrator(args['percentile'])
+    calibration_kind = args['calibration']
+    drag = {'start': None, 'end': None, 'pressed': False}
+
+    def onMouse(event, x, y, flags, param):
+        if event == cv2.EVENT_LBUTTONDOWN:
+            drag.update(start=(x, y), end=(x, y), pressed=True)
+        elif event == cv2.EVENT_MOUSEMOVE and drag['pressed']:
+            drag['end'] = (x, y)
+        elif event == cv2.EVENT_LBUTTONUP:
+            drag['pressed'] = False
+
     if capture.isOpened() is True:
         # Use partial function for the trackbars
         TrackBars_partial = partial(TrackBars, window=window_1)
 
         # Create trackbars to control the threshold to binarize
-        cv2.createTrackbar('B min', window_1, 0, 255, TrackBars_partial)
-        cv2.createTrackbar('B max', window_1, 0, 255, TrackBars_partial)
-        cv2.createTrackbar('G min', window_1, 0, 255, TrackBars_partial)
-        cv2.createTrackbar('G max', window_1, 0, 255, TrackBars_partial)
-        cv2.createTrackbar('R min', window_1, 0, 255, TrackBars_partial)
-        cv2.createTrackbar('R max', window_1, 0, 255, TrackBars_partial)
+        cv2.createTrackbar('B min', window_1, 0, 255, onTrackbar)
+        cv2.createTrackbar('B max', window_1, 0, 255, onTrackbar)
+        cv2.createTrackbar('G min', window_1, 0, 255, onTrackbar)
+        cv2.createTrackbar('G max', window_1, 0, 255, onTrackbar)
+        cv2.createTrackbar('R min', window_1, 0, 255, onTrackbar)
+        cv2.createTrackbar('R max', window_1, 0, 255, onTrackbar)
+        cv2.setMouseCallback(window_1, onMouse)
 
         # Set the trackbars positions to 255 for maximum trackbars
         cv2.setTrackbarPos('B max', window_1, 255)
         cv2.setTrackbarPos('G max', window_1, 255)
         cv2.setTrackbarPos('R max', window_1, 255)
 
+        # Start from the limits of the json file
+        if model is not None and isBox(model.limits):
+            for channel in 'BGR':
+                cv2.setTrackbarPos(channel + ' min', window_1, model.limits[channel]['min'])
+                cv2.setTrackbarPos(channel + ' max', window_1, model.limits[channel]['max'])
+        trackbar_limit = TrackBars_partial(0)[0]
+        trackbars_moved[0] = False
+        if model is None:
+            model = ColorModel(trackbar_limit)
+
         # Hotkeys
         cprint('Color_segmenter is on.'
                , color='white')
         print('\nUse the trackbars to define the threshold limits as you wish.')
+        print('Or drag a rectangle over the marker with the mouse, and move the marker while holding the button, to '
+              'calibrate the limits automatically (' + calibration_kind + ' model).')
+        print('Press "h" to switch between the box and the HSV model, "x" to clear the samples')
         print(Back.GREEN + '\nStart capturing the webcam video.' + Back.RESET)
         print(Fore.GREEN + '\nPress "w" to exit and save the threshold' + Fore.RESET)
         print(Fore.RED + 'Press "q" to exit without saving the threshold' + Fore.RESET)
     else:
         print(Back.RED + "WARNING!" + Back.RESET + Fore.RED + " Camera is off" + Fore.RESET)
 
+    fitted = True
+    fit_time = 0
     while capture.isOpened():
+        profiler.startFrame()
 
-        # Get an image from the camera (a frame) and show it
+        # Get an image from the camera (a frame)
         _, frame = capture.read()
-        cv2.imshow(window_1, frame)
-
-        # Get ranges from trackbars in dict and numpy data structures
-        limit, min, max = TrackBars_partial(0)
-
-        # Create mask using cv2.inRange. The output is still in uint8
-        mask_frame = cv2.inRange(frame, min, max)
-
-        # Show segmented image
+        profiler.lap('capture')
+
+        # Compile the colour model again only when the trackbars move
+        if trackbars_moved[0]:
+            trackbars_moved[0] = False
+            # Get ranges from trackbars in dict and numpy data structures
+            limit, _, _ = TrackBars_partial(0)
+            if limit != trackbar_limit:
+                trackbar_limit = limit
+                model = ColorModel(limit)
+
+        # Sample the dragged rectangle while the button is held
+        rect = None
+        if drag['start'] is not None:
+            (x0, y0), (x1, y1) = drag['start'], drag['end']
+            rect = (max(min(x0, x1), 0), max(min(y0, y1), 0), max(x0, x1) + 1, max(y0, y1) + 1)
+            if drag['pressed']:
+                calibrator.add(frame, rect)
+                fitted = False
+
+        # Fit the model to the samples. The box is cheap to fit on every frame, the HSV lookup table is built twice per
+        # second while sampling and once when the button is released
+        if calibrator.samples and not fitted and (calibration_kind == 'box' or not drag['pressed'] or
+                                                  time.perf_counter() - fit_time > 0.5):
+            fitted = True
+            fit_time = time.perf_counter()
+            model = ColorModel(calibrator.fit(calibration_kind))
+            if isBox(model.limits):
+                # Show the fitted box on the trackbars, to fine tune it
+                for channel in 'BGR':
+                    cv2.setTrackbarPos(channel + ' min', window_1, model.limits[channel]['min'])
+                    cv2.setTrackbarPos(channel + ' max', window_1, model.limits[channel]['max'])
+                trackbar_limit = model.limits
+                trackbars_moved[0] = False
+        profiler.lap('model')
+
+        # Create the mask with the colour model. The output is still in uint8
+        mask_frame = model.apply(frame)
+        profiler.lap('segmentation')
+
+        # Show the frame, with the rectangle being sampled, and the segmented image
+        if rect is not None:
+            cv2.rectangle(frame, rect[:2], (rect[2] - 1, rect[3] - 1), (0, 255, 255), 1)
+        if calibrator.samples:
+            cv2.putText(frame, str(calibrator.samples) + ' samples, ' + calibration_kind + ' model',
+                        (10, frame.shape[0] - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 255), 1, cv2.LINE_AA)
+        cv2.imshow(window_1, profiler.drawHUD(frame))
         cv2.imshow(window_2, mask_frame)  # Display the image
+        profiler.lap('imshow')
 
         key = cv2.waitKey(1)  # Wait a key to stop the program
+        profiler.lap('waitKey')
+
+        # Switch the calibration model, or clear the samples
+        if key == ord('h'):
+            calibration_kind = 'hsv' if calibration_kind == 'box' else 'box'
+            fitted = False
+            print('Calibrating a ' + calibration_kind + ' model')
+        elif key == ord('x'):
+            calibrator.clear()
+            drag['start'] = None
+            model = ColorModel(trackbar_limit)
+            print('Samples cleared')
 
         # Keyboard inputs to finish
         if key == ord('q'):
@@ -66,12 +188,17 @@ def main():
         elif key == ord('w'):
             print(Fore.GREEN + '"w" (write) pressed, exiting the program and saving' + Fore.RESET)
             file_name = 'limits.json'
+            # The illumination of the calibration, the reference of the adaptive lighting of ar_paint
+            limits = dict(model.limits, illumination=LightingCompensator.estimate(frame).round(2).tolist())
             with open(file_name, 'w') as file_handle:
                 print("Creating file with threshold limits" + file_name)
-                json.dump(limit, file_handle)
+                json.dump(limits, file_handle)
 
             break
     # When finished close all
+    if args['trace'] is not None:
+        profiler.saveTrace(args['trace'])
+        print('Trace saved in: ' + Fore.BLUE + args['trace'] + Style.RESET_ALL)
     capture.release()
     cv2.destroyAllWindows()
 
@@ -0,0 +1,78 @@
+import time
+
+import cv2
+
+
+class RenderScheduler:
+    """
+        Decides which windows are shown on each frame, so showing them does not slow the tracking and painting.
+        Each window has a maximum rate (frames per second, 0 for no limit): the canvas is shown at the refresh rate
+        of the display and the debug windows (Original, Mask, MaxArea, ...) at a lower rate. A window is also skipped
+        when the key given with its image is the same as the last one shown (the image did not change) and when the
+        user closed it. The image can be given as a function, so it is only rendered when the window is shown.
+        poll() processes the window events and returns the pressed key without waiting, as cv2.waitKey(1) does.
+    """
+
+    def __init__(self, rates=None, default_rate=10, clock=time.perf_counter):
+        self.rates = dict(rates or {})
+        self.default_rate = default_rate
+        self.clock = clock
+
+        # name -> (time, key) of the last image shown
+        self.shown = {}
+        self.closed = set()
+
+    def visible(self, name):
+        """
+            False once the user closed a window that was shown. Showing it again would open it again.
+        """
+        if name in self.closed:
+            return False
+        if name not in self.shown:
+            return True
+
+        try:
+            visible = cv2.getWindowProperty(name, cv2.WND_PROP_VISIBLE) >= 1
+        except cv2.error:
+            visible = False
+        if not visible:
+            self.closed.add(name)
+
+        return visible
+
+    def due(self, name, key=None):
+        """
+            True if the window has to be shown now: its interval has passed and the key changed.
+        """
+        last = self.shown.get(name)
+        if last is None:
+            return name not in self.closed
+
+        last_time, last_key = last
+        if key is not None and key == last_key:
+            return False
+        rate = self.rates.get(name, self.default_rate)
+        if rate and self.clock() - last_time < 1 / rate:
+            return False
+
+        return self.visible(name)
+
+    def show(self, name, image, key=None):
+        """
+            Shows the image (or the result of calling it) in the window if it is due. Returns True if it was shown.
+        """
+        if not self.due(name, key):
+            return False
+
+        cv2.imshow(name, image() if callable(image) else image)
+        self.shown[name] = (self.clock(), key)
+
+        return True
+
+    @staticmethod
+    def poll():
+        # pollKey does not wait the millisecond of waitKey (it is missing in OpenCV before 4.5.2)
+        if hasattr(cv2, 'pollKey'):
+            return cv2.pollKey()
+
+        return cv2.waitKey(1)
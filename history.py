@@ -0,0 +1,131 @@
+import zlib
+from collections import deque
+
+import numpy as np
+
+
+class History:
+    """
+        Undo and redo for a Canvas, storing only the tiles each stroke changed.
+        Before the canvas draws, it asks the history to save the tiles the shape will touch (once per stroke). When the
+        stroke ends, each saved tile is XORed with its new content and compressed. The XOR delta is zero where nothing
+        changed, so it compresses very well, and applying it again switches the tile between the two states, so the
+        same delta is used to undo and to redo.
+        The compressed deltas are kept under a memory budget, evicting the oldest strokes first.
+        Each stroke also remembers its items in the vector StrokeList of the canvas, which are hidden on undo.
+    """
+
+    def __init__(self, canvas, tile_size=64, budget=16 * 1024 * 1024):
+        self.canvas = canvas
+        self.tile_size = tile_size
+        self.budget = budget
+
+        # Each stroke is ([(ty, tx, compressed delta), ...], first item, last item)
+        self.undo_stack = deque()
+        self.redo_stack = []
+        self.used = 0
+
+        # Tiles saved for the stroke being drawn: (ty, tx) -> content before the stroke, and its first item
+        self.current = {}
+        self.first_item = None
+
+        canvas.history = self
+
+    def _tiles(self, rect):
+        """
+            Tile indexes (ty, tx) covered by a rectangle.
+        """
+        x0, y0, x1, y1 = rect
+        t = self.tile_size
+        for ty in range(y0 // t, (y1 - 1) // t + 1):
+            for tx in range(x0 // t, (x1 - 1) // t + 1):
+                yield ty, tx
+
+    def _tileSlice(self, ty, tx):
+        t = self.tile_size
+        return slice(ty * t, (ty + 1) * t), slice(tx * t, (tx + 1) * t)
+
+    def _tileRect(self, ty, tx):
+        t = self.tile_size
+        return tx * t, ty * t, min((tx + 1) * t, self.canvas.width), min((ty + 1) * t, self.canvas.height)
+
+    @staticmethod
+    def _size(stroke):
+        return sum(len(delta) for _, _, delta in stroke[0])
+
+    def saveTiles(self, rect):
+        """
+            Called by the canvas before drawing in the rectangle: saves the tiles not yet saved for this stroke.
+        """
+        if self.first_item is None:
+            self.first_item = len(self.canvas.strokes)
+        if rect is None:
+            return
+        for key in self._tiles(rect):
+            if key not in self.current:
+                self.current[key] = self.canvas.image[self._tileSlice(*key)].copy()
+
+    def endStroke(self):
+        """
+            Closes the stroke being drawn and stores its compressed tile deltas. A new stroke clears the redo stack.
+        """
+        if self.first_item is None:
+            return
+
+        tiles = []
+        for (ty, tx), before in self.current.items():
+            delta = np.bitwise_xor(before, self.canvas.image[self._tileSlice(ty, tx)])
+            if delta.any():
+                tiles.append((ty, tx, zlib.compress(delta.tobytes(), 1)))
+        stroke = (tiles, self.first_item, len(self.canvas.strokes))
+        self.current = {}
+        self.first_item = None
+
+        # The next line starts a new polyline, that belongs to the next stroke
+        self.canvas.strokes.seal()
+
+        if not tiles:
+            return
+
+        for old in self.redo_stack:
+            self.used -= self._size(old)
+        self.redo_stack.clear()
+
+        self.undo_stack.append(stroke)
+        self.used += self._size(stroke)
+
+        # Evict the oldest strokes above the budget
+        while self.used > self.budget and len(self.undo_stack) > 1:
+            self.used -= self._size(self.undo_stack.popleft())
+
+    def _apply(self, stroke, visible):
+        """
+            XORs the deltas of a stroke into the canvas, which switches it between before and after the stroke.
+        """
+        tiles, first, last = stroke
+        self.canvas.strokes.setVisible(first, last, visible)
+        for ty, tx, delta in tiles:
+            region = self.canvas.image[self._tileSlice(ty, tx)]
+            np.bitwise_xor(region, np.frombuffer(zlib.decompress(delta), dtype=np.uint8).reshape(region.shape),
+                           out=region)
+            self.canvas.refresh(self._tileRect(ty, tx))
+
+    def undo(self):
+        self.endStroke()
+        if not self.undo_stack:
+            return False
+        stroke = self.undo_stack.pop()
+        self._apply(stroke, False)
+        self.redo_stack.append(stroke)
+
+        return True
+
+    def redo(self):
+        self.endStroke()
+        if not self.redo_stack:
+            return False
+        stroke = self.redo_stack.pop()
+        self._apply(stroke, True)
+        self.undo_stack.append(stroke)
+
+        return True
@@ -0,0 +1,67 @@
+import threading
+
+import numpy as np
+
+
+class LightingCompensator:
+    """
+        Follows the global illumination of the camera with the gray-world estimate: the mean of each BGR channel,
+        taken from a sparse grid of pixels (one every step pixels in each direction) every few frames and smoothed with
+        a running mean. The ratio to the reference illumination (the one of the calibration) gives a gain per channel.
+        The frame is never converted: the limits of a BGR box are scaled by the gains (scaleBox), and lookup tables are
+        remapped with them (see LookupTable), every time they change.
+        update() returns the gains to use for that frame. The pipeline calls it in capture order, in its feeder thread,
+        and gives those gains to the worker that segments the frame, so the masks do not depend on the order in which
+        the workers run.
+    """
+
+    def __init__(self, reference=None, every=10, step=16, smoothing=0.3):
+        self.reference = None if reference is None else np.asarray(reference, dtype=np.float64)
+        self.every = every
+        self.step = step
+        self.smoothing = smoothing
+
+        self.current = None
+        self.gains = np.ones(3)
+        self.frames = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def estimate(image, step=16):
+        """
+            Mean of each channel over a grid of pixels of the image.
+        """
+        return image[::step, ::step].reshape(-1, 3).mean(axis=0)
+
+    def update(self, image):
+        """
+            Called with every frame, in order: updates the estimate of the illumination every few frames. Returns the
+            gains of the frame (the array is replaced, not changed, when they are updated).
+        """
+        with self.lock:
+            self.frames += 1
+            if self.current is not None and self.frames % self.every:
+                return self.gains
+
+            estimate = np.maximum(self.estimate(image, self.step), 1)
+            if self.reference is None:
+                # Without a reference, the illumination when it starts is the reference
+                self.reference = estimate
+            if self.current is None:
+                self.current = estimate
+            else:
+                self.current = (1 - self.smoothing) * self.current + self.smoothing * estimate
+
+            self.gains = self.current / self.reference
+
+            return self.gains
+
+    @staticmethod
+    def scaleBox(low, high, gains):
+        """
+            Limits of a BGR box under the illumination of the gains. Limits at 255 stay there, as saturated pixels do.
+        """
+        low = np.clip(np.round(low * gains), 0, 255)
+        high = np.where(high >= 255, 255, np.clip(np.round(high * gains), 0, 255))
+
+        return low, high
@@ -0,0 +1,55 @@
+import threading
+
+import cv2
+import numpy as np
+
+
+class BufferPool:
+    """
+        Arrays reused from frame to frame, so the hot path does not allocate. Each thread has its own buffers, and
+        each name is a ring of ring buffers used in turn: a buffer is only written again ring calls later, so the
+        frames still queued in the pipeline keep their data. The buffers start filled with zeros.
+    """
+
+    def __init__(self, ring=2):
+        self.ring = ring
+        self.local = threading.local()
+
+    def get(self, name, shape, dtype=np.uint8):
+        buffers = getattr(self.local, 'buffers', None)
+        if buffers is None:
+            buffers = self.local.buffers = {}
+
+        entry = buffers.get(name)
+        if entry is None or entry[1][0].shape != tuple(shape) or entry[1][0].dtype != dtype:
+            entry = buffers[name] = [0, [np.zeros(shape, dtype=dtype) for _ in range(self.ring)]]
+        entry[0] = (entry[0] + 1) % self.ring
+
+        return entry[1][entry[0]]
+
+
+class MaskFilter:
+    """
+        Morphological cleanup of the mask before it is labelled: the opening removes the speckles smaller than
+        open_size, so they do not become labels, and the closing fills the holes smaller than close_size in the marker.
+        A size of 0 skips the operation. The results are written in the buffers of the pool.
+    """
+
+    def __init__(self, open_size=3, close_size=0, pool=None):
+        self.open_kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (open_size, open_size)) if open_size else None
+        self.close_kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (close_size, close_size)) \
+            if close_size else None
+        self.pool = pool or BufferPool()
+
+    def __bool__(self):
+        return self.open_kernel is not None or self.close_kernel is not None
+
+    def apply(self, mask):
+        if self.open_kernel is not None:
+            opened = self.pool.get('opened', mask.shape, mask.dtype)
+            mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, self.open_kernel, dst=opened)
+        if self.close_kernel is not None:
+            closed = self.pool.get('closed', mask.shape, mask.dtype)
+            mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, self.close_kernel, dst=closed)
+
+        return mask
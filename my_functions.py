@@ -2,9 +2,8 @@ from random import randint
 
 import cv2
 import numpy as np
-import copy
-import matplotlib.pyplot as plt
-from skimage.metrics import structural_similarity as ssim
+
+from color_model import ColorModel, MarkerModel
 
 
 def TrackBars(_, window):
@@ -31,44 +30,54 @@ def TrackBars(_, window):
     return limit, min, max
 
 
-def createMask(ranges, image):
+def createMask(ranges, image, update_lighting=True, out=None, gains=None):
+    """
+        Creates the mask of the pixels inside the ranges. The ranges can be the limits dictionary or a compiled
+        ColorModel (see color_model.py), which does not rebuild anything on each call. With a MarkerModel the mask is
+        the image of marker numbers.
+        Adaptive mode: when the model has a LightingCompensator, the illumination is estimated from the image (every
+        few calls) and the model follows it. Use update_lighting=False for images that are only part of a frame.
+        gains are the ones the compensator returned for the frame, when it was already updated with it (as the
+        pipeline does, in capture order).
+        The mask is written in out if given.
+    """
+    if isinstance(ranges, (ColorModel, MarkerModel)):
+        if gains is None and ranges.lighting is not None and update_lighting:
+            gains = ranges.lighting.update(image)
+        return ranges.apply(image, out, gains)
 
     # Create an array for minimum and maximum values
     min = np.array([ranges['B']['min'], ranges['G']['min'], ranges['R']['min']])
     max = np.array([ranges['B']['max'], ranges['G']['max'], ranges['R']['max']])
 
     # Create a mask using the previously created array
-    mask = cv2.inRange(image, min, max)
+    mask = cv2.inRange(image, min, max, dst=out)
 
     return mask
 
 
-def getCentroid(mask_original):
-
-    # Defining maximum area and mask label
-    maxArea = 0
-    maxLabel = 0
+def getCentroid(mask_original, pool=None):
+    """
+        Finds the largest blob of the mask: returns its mask and centroid. With a BufferPool (see masks.py) the labels
+        and the mask of the blob are written in reused buffers.
+    """
 
     # You need to choose 4 or 8 for connectivity type
     connectivity = 4
 
     # Perform the operation
-    num_labels, labels, stats, centroids = cv2.connectedComponentsWithStats(mask_original, connectivity, cv2.CV_32S)
-
-    # For each blob, find their area and compare it to the largest one
-    for label in range(1, num_labels):
-        # Find area
-        area = stats[label, cv2.CC_STAT_AREA]
+    labels = None if pool is None else pool.get('labels', mask_original.shape, np.int32)
+    num_labels, labels, stats, centroids = cv2.connectedComponentsWithStats(mask_original, labels=labels,
+                                                                          connectivity=connectivity,
+                                                                          ltype=cv2.CV_32S)
 
-        # If the area is larger than the max area, replace it
-        if area > maxArea:
-            maxArea = area
-            maxLabel = label
+    # If there are blobs, the label of the largest one is found with a vectorized argmax over their areas
+    if num_labels > 1:
+        maxLabel = 1 + int(np.argmax(stats[1:, cv2.CC_STAT_AREA]))
 
-    # If there are blobs, the label has to be different from zero
-    if maxLabel != 0:
         # Create a new mask and find its centroid
-        mask = labels == maxLabel
+        mask = None if pool is None else pool.get('blob', mask_original.shape, bool)
+        mask = np.equal(labels, maxLabel, out=mask)
         centroid = centroids[maxLabel]
     else:
         # If there are no blobs, the mask stays the same, and there are no centroids
@@ -78,18 +87,76 @@ def getCentroid(mask_original):
     return mask, centroid
 
 
-def maxArea(image, mask):
+def resizeForSegmentation(image, scale, out=None):
+    """
+        Resizes the camera frame for segmentation. With scale 1 the frame is returned as it is.
+        Bilinear interpolation is fast and keeps the pixel centers aligned with scaleCentroid.
+        out, if given, must have the size of the result (see segmentationSize).
+    """
+    if scale == 1:
+        return image
+
+    return cv2.resize(image, segmentationSize(image.shape, scale), dst=out, interpolation=cv2.INTER_LINEAR)
+
+
+def segmentationSize(shape, scale):
+    """
+        (width, height) of a frame of this shape resized by scale, as cv2.resize computes it.
+    """
+    return int(round(shape[1] * scale)), int(round(shape[0] * scale))
+
+
+def scaleCentroid(centroid, scale):
+    """
+        Maps a centroid found in an image resized by scale back to full resolution coordinates, with sub-pixel
+        precision (pixel centers are at integer coordinates in both images).
+    """
+    return (np.asarray(centroid) + 0.5) / scale - 0.5
+
+
+def refineCentroid(ranges, image, centroid, radius, gains=None):
+    """
+        Refines a centroid at full resolution, segmenting only a small window around it (with the lighting gains of
+        the frame, if given). If the blob does not fit inside the window the centroid is returned unchanged.
+    """
+    h, w = image.shape[:2]
+    x0 = max(int(centroid[0]) - radius, 0)
+    y0 = max(int(centroid[1]) - radius, 0)
+    x1 = min(int(centroid[0]) + radius + 1, w)
+    y1 = min(int(centroid[1]) + radius + 1, h)
+
+    # Segment and label only the window
+    window = createMask(ranges, image[y0:y1, x0:x1], update_lighting=False, gains=gains)
+    num_labels, _, stats, centroids = cv2.connectedComponentsWithStats(window, 4, cv2.CV_32S)
+    if num_labels < 2:
+        return centroid
+
+    # Largest blob of the window
+    label = 1 + int(np.argmax(stats[1:, cv2.CC_STAT_AREA]))
+    left, top, bw, bh = stats[label, :4]
+
+    # If it touches an inner border of the window, part of it is outside
+    if (left == 0 and x0 > 0) or (top == 0 and y0 > 0) or \
+            (left + bw == x1 - x0 and x1 < w) or (top + bh == y1 - y0 and y1 < h):
+        return centroid
+
+    return centroids[label] + (x0, y0)
+
+
+def maxArea(image, mask, out=None):
+    """
+        Shows the mask in green. The image is written in out if given, which must be zero in the blue and red
+        channels (as the buffers of a BufferPool are): only the green channel is written.
+    """
 
     # Determine image size
     h, w, _ = image.shape
 
-    # Creating colour channels, using the mask as the green one
-    b = np.zeros(shape=[h, w], dtype=np.uint8)
-    g = mask.astype(np.uint8) * 255
-    r = copy.deepcopy(b)
-
-    # Merge the channels to create a green mask
-    image_green = cv2.merge([b, g, r])
+    # Black image, with the mask as the green channel (0 or 255), written in place
+    image_green = np.zeros((h, w, 3), dtype=np.uint8) if out is None else out
+    green = image_green[..., 1]
+    np.not_equal(mask, 0, out=green, casting='unsafe')
+    green *= 255
 
     return image_green
 
@@ -139,7 +206,7 @@ def drawNumericPaintImage(blank_image):
     # Draw region color idx
     for centers_key, centers_value in centers.items():
 
-        idx = randint(1, len(colors) + 1)
+        idx = randint(1, len(colors))
         region_colors[centers_key] = {}
         region_colors[centers_key]['idx'] = idx
         region_colors[centers_key]['color'] = colors[idx - 1]
@@ -148,23 +215,24 @@ def drawNumericPaintImage(blank_image):
                                   cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 0), 1, cv2.LINE_AA)
 
     # Paint image to have the corrected image. After use this painted image to compare with our painting.
-    painted_image = copy.deepcopy(blank_image)
+    # The colours are looked up by label in one pass, the outlines (label 0) keep the pixels of the blank image
+    lut = np.zeros((labels.max() + 1, 3), dtype=np.uint8)
     for region_color_key, region_color_value in region_colors.items():
-        id = labels == region_color_key
-        painted_image[id] = region_color_value['color']
+        lut[region_color_key] = region_color_value['color']
+    painted_image = np.where((labels > 0)[..., None], lut[labels], blank_image)
 
     return blank_image, painted_image
 
 
 def combine(blank_image, frame):
 
-    # Create mask of white pixels
+    # Create mask of the painted (not white) pixels
     mask = cv2.inRange(blank_image, np.array([255, 255, 255]), np.array([255, 255, 255]))
-    mask = mask.astype(np.bool)
+    mask = cv2.bitwise_not(mask)
 
-    # Draw in the original frame
-    new_frame = copy.deepcopy(frame)
-    new_frame[~mask] = blank_image[~mask]
+    # Draw in a copy of the original frame. For every frame of a video use Canvas.composite instead
+    new_frame = frame.copy()
+    cv2.copyTo(blank_image, mask, new_frame)
 
     return new_frame
 
@@ -173,7 +241,8 @@ def mse(imageA, imageB):
     # the 'Mean Squared Error' between the two images is the
     # sum of the squared difference between the two images;
     # NOTE: the two images must have the same dimension
-    err = np.sum((imageA.astype("float") - imageB.astype("float")) ** 2)
+    # cv2.norm sums the squares on the uint8 images, without float copies of them
+    err = cv2.norm(imageA, imageB, cv2.NORM_L2SQR)
     err /= float(imageA.shape[0] * imageA.shape[1])
 
     # return the MSE, the lower the error, the more "similar"
@@ -182,6 +251,10 @@ def mse(imageA, imageB):
 
 
 def compare_images(imageA, imageB, title):
+    # matplotlib and skimage take most of the time to import this module, so they are only imported when used
+    import matplotlib.pyplot as plt
+    from skimage.metrics import structural_similarity as ssim
+
     # compute the mean squared error and structural similarity
     # index for the images
     m = mse(imageA, imageB)
@@ -0,0 +1,213 @@
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+
+import cv2
+import numpy as np
+
+# File layout: MAGIC, width and height (uint32), padded to DATA_OFFSET so the pixels start on a page, then the BGR
+# pixels of the canvas row by row
+MAGIC = b'ARPCANV1'
+HEADER = struct.Struct('<8sII')
+DATA_OFFSET = mmap.ALLOCATIONGRANULARITY
+
+
+class CanvasFile:
+    """
+        Pixels of a canvas in a memory-mapped file, reused across restarts: a session survives a crash of ar_paint and
+        is resumed without decoding anything, the next run with the same file maps the same pixels (resumed is True).
+        The file is started, white, if it does not exist or is empty. A file that is not a canvas file (no MAGIC) is
+        never overwritten: ValueError is raised. A canvas file of another size (e.g. another camera resolution) is
+        renamed aside (backup is its new name) and the new canvas starts with its pixels, letterboxed.
+        What is drawn on the mapped image reaches the file through the page cache of the system even if the program
+        crashes. flush() also writes it to the disk, so it survives a crash of the system: only the tiles changed
+        since the last flush (told by the canvas through markDirty), with one msync per row of tiles. start() flushes
+        in a background thread every interval seconds.
+    """
+
+    def __init__(self, file_name, width, height, tile_size=64):
+        self.file_name = file_name
+        self.width = width
+        self.height = height
+        self.tile_size = tile_size
+        size = DATA_OFFSET + width * height * 3
+
+        self.resumed = False
+        self.backup = None
+        old_pixels = None
+        if os.path.exists(file_name) and os.path.getsize(file_name):
+            with open(file_name, 'rb') as file_handle:
+                header = file_handle.read(HEADER.size)
+            if len(header) < HEADER.size or HEADER.unpack(header)[0] != MAGIC:
+                raise ValueError(file_name + ' is not an ar_paint canvas file')
+
+            _, old_width, old_height = HEADER.unpack(header)
+            if (old_width, old_height) == (width, height) and os.path.getsize(file_name) == size:
+                self.resumed = True
+            else:
+                self.backup = self._moveAside(old_width, old_height)
+                if os.path.getsize(self.backup) >= DATA_OFFSET + old_width * old_height * 3:
+                    old_pixels = np.fromfile(self.backup, dtype=np.uint8, count=old_width * old_height * 3,
+                                             offset=DATA_OFFSET).reshape(old_height, old_width, 3)
+
+        if self.resumed:
+            self.file = open(file_name, 'r+b')
+        else:
+            self.file = open(file_name, 'w+b')
+            self.file.write(HEADER.pack(MAGIC, width, height))
+            self.file.truncate(size)
+            self.file.flush()
+
+        self.map = mmap.mmap(self.file.fileno(), size)
+        self.image = np.ndarray((height, width, 3), dtype=np.uint8, buffer=self.map, offset=DATA_OFFSET)
+        if not self.resumed:
+            self.image.fill(255)
+            if old_pixels is not None:
+                self._letterbox(old_pixels)
+            self.map.flush()
+
+        # Changed columns (x0, x1) of each row of tiles, since the last flush
+        self.dirty = {}
+        self.lock = threading.Lock()
+
+        # Counters
+        self.flushes = 0
+        self.flushed_bytes = 0
+
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def _moveAside(self, old_width, old_height):
+        """
+            Renames the file to <file_name>.<width>x<height>, or .<width>x<height>_2... if that name is taken.
+        """
+        name = self.file_name + '.' + str(old_width) + 'x' + str(old_height)
+        backup = name
+        number = 1
+        while os.path.exists(backup):
+            number += 1
+            backup = name + '_' + str(number)
+        os.replace(self.file_name, backup)
+
+        return backup
+
+    def _letterbox(self, pixels):
+        """
+            Draws the pixels of an old canvas centered in the image, scaled by the same ratio in x and y, like the
+            strokes of a session loaded at another size (see StrokeList.resized).
+        """
+        old_height, old_width = pixels.shape[:2]
+        scale = min(self.width / old_width, self.height / old_height)
+        width = min(max(int(round(old_width * scale)), 1), self.width)
+        height = min(max(int(round(old_height * scale)), 1), self.height)
+        x0, y0 = (self.width - width) // 2, (self.height - height) // 2
+        self.image[y0:y0 + height, x0:x0 + width] = cv2.resize(pixels, (width, height), interpolation=cv2.INTER_AREA)
+
+    def watch(self, canvas):
+        """
+            Flushes the changes of the canvas, which has to draw on image.
+        """
+        canvas.watchers.append(self.markDirty)
+
+    def markDirty(self, rect):
+        x0, y0, x1, y1 = rect
+        t = self.tile_size
+        x0, x1 = x0 // t * t, min((x1 - 1) // t * t + t, self.width)
+        with self.lock:
+            for ty in range(y0 // t, (y1 - 1) // t + 1):
+                columns = self.dirty.get(ty)
+                self.dirty[ty] = (x0, x1) if columns is None else (min(columns[0], x0), max(columns[1], x1))
+
+    def flush(self):
+        """
+            Writes the changed tiles to the disk. Returns the number of bytes flushed.
+        """
+        with self.lock:
+            dirty, self.dirty = self.dirty, {}
+
+        flushed = 0
+        t = self.tile_size
+        for ty, (x0, x1) in sorted(dirty.items()):
+            # The tiles of a row are one range of the file, from their first pixel to their last one
+            y0, y1 = ty * t, min(ty * t + t, self.height)
+            start = DATA_OFFSET + (y0 * self.width + x0) * 3
+            end = DATA_OFFSET + ((y1 - 1) * self.width + x1) * 3
+            start -= start % mmap.ALLOCATIONGRANULARITY
+            self.map.flush(start, end - start)
+            flushed += end - start
+
+        if flushed:
+            self.flushes += 1
+            self.flushed_bytes += flushed
+
+        return flushed
+
+    def _autosave(self, interval):
+        while not self.stopped.wait(interval):
+            self.flush()
+
+    def start(self, interval=5):
+        self.thread = threading.Thread(target=self._autosave, args=(interval,), name='CanvasFile', daemon=True)
+        self.thread.start()
+
+    def close(self):
+        """
+            Stops the autosave and flushes the last changes. The image stays mapped while the canvas uses it.
+        """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.flush()
+        self.file.close()
+
+
+class SnapshotWriter:
+    """
+        Saves PNG images of the canvas in a background thread, so encoding a large canvas does not stop the frames.
+        The image is copied when save() is called. By default it is named after the date, without spaces or colons,
+        with _2, _3... added when that name is taken (several snapshots in one second), so none is overwritten.
+    """
+
+    def __init__(self, prefix='drawing_'):
+        self.prefix = prefix
+        self.queue = queue.Queue()
+        # Names queued, which may not be on the disk yet
+        self.names = set()
+        self.thread = threading.Thread(target=self._write, name='SnapshotWriter', daemon=True)
+        self.thread.start()
+
+    def _write(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+
+            file_name, image = item
+            if not cv2.imwrite(file_name, image):
+                print('Could not save ' + file_name)
+
+    def save(self, image, file_name=None):
+        """
+            Queues the image to be saved and returns the name of its file.
+        """
+        if file_name is None:
+            name = self.prefix + time.strftime('%Y-%m-%d_%H-%M-%S')
+            file_name = name + '.png'
+            number = 1
+            while file_name in self.names or os.path.exists(file_name):
+                number += 1
+                file_name = name + '_' + str(number) + '.png'
+        self.names.add(file_name)
+        self.queue.put((file_name, image.copy()))
+
+        return file_name
+
+    def close(self):
+        """
+            Waits for the queued images to be saved.
+        """
+        self.queue.put(None)
+        self.thread.join()
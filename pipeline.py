@@ -0,0 +1,196 @@
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import cv2
+
+from masks import BufferPool, MaskFilter
+from my_functions import (createMask, getCentroid, maxArea, refineCentroid, resizeForSegmentation, scaleCentroid,
+                          segmentationSize)
+from profiler import NullProfiler
+
+
+def maskFrame(frame, limits, scale=1, mask_filter=None, pool=None, gains=None):
+    """
+        Segment stage: creates the mask, at a lower resolution when scale is below 1, and cleans it with mask_filter
+        (a MaskFilter) if given. With a BufferPool the resized frame and the mask are written in reused buffers.
+        gains are the lighting gains of the frame, with an adaptive model.
+        It has no state, so several frames can be segmented at the same time.
+    """
+    small = frame
+    if scale != 1:
+        width, height = segmentationSize(frame.shape, scale)
+        small = resizeForSegmentation(frame, scale,
+                                      None if pool is None else pool.get('small', (height, width) + frame.shape[2:]))
+
+    # Create original mask
+    mask_original = createMask(limits, small, out=None if pool is None else pool.get('mask', small.shape[:2]),
+                               gains=gains)
+    if mask_filter:
+        mask_original = mask_filter.apply(mask_original)
+
+    return frame, small, mask_original
+
+
+def trackFrame(frame, small, mask_original, limits, find=getCentroid, scale=1, refine_radius=0, pool=None,
+               gains=None):
+    """
+        Track stage: finds the blob with find (getCentroid or a tracker) and maps its centroid to full resolution.
+        With refine_radius the centroid is refined at full resolution in a window of that radius.
+        With a MarkerTracker the centroid is a list of pointers, whose centroids are mapped the same way.
+        With a BufferPool find (getCentroid or the update of a tracker) and the green mask use reused buffers.
+    """
+    # Find centroid (or the pointers of every marker, with a MarkerTracker)
+    mask, centroid = find(mask_original, pool)
+
+    if isinstance(centroid, list):
+        if scale != 1:
+            centroid = [pointer._replace(centroid=scaleCentroid(pointer.centroid, scale)) for pointer in centroid]
+    elif centroid is not None and scale != 1:
+        centroid = scaleCentroid(centroid, scale)
+        if refine_radius:
+            centroid = refineCentroid(limits, frame, centroid, refine_radius, gains)
+
+    # Create a green mask for max area
+    image_green = maxArea(small, mask, None if pool is None else pool.get('green', small.shape[:2] + (3,)))
+
+    return frame, mask_original, mask, centroid, image_green
+
+
+def segmentFrame(frame, limits, scale=1, refine_radius=0, mask_filter=None, pool=None, gains=None):
+    """
+        Segment and track stage used without a tracker: both run in the worker pool.
+    """
+    return trackFrame(*maskFrame(frame, limits, scale, mask_filter, pool, gains), limits, scale=scale,
+                      refine_radius=refine_radius, pool=pool, gains=gains)
+
+
+class SegmentationPipeline:
+    """
+        Runs the capture and the segment+track stages in the background, joined by bounded queues:
+            capture (FrameGrabber thread) -> feeder thread -> worker pool (segmentation) -> tracking thread -> read()
+        The paint and display stages run in the thread that calls read(), so frame N+1 is segmented while frame N is
+        being painted and shown. Results are returned in capture order.
+        Without a tracker the workers also find the centroid with getCentroid. With a tracker (which keeps state from
+        frame to frame) the workers only create the masks and the tracker runs in the tracking thread, in order.
+        With scale below 1 the segmentation works on a resized frame, the centroids are mapped back to full resolution
+        (and refined there when refine_radius is given) and the masks are returned at the lower resolution.
+        With a Profiler (see profiler.py) the capture, segmentation and tracking stages of each thread are timed.
+        open_size and close_size clean the masks with a MaskFilter (see masks.py) before they are labelled.
+        The frames, masks and green masks are written in the buffers of a BufferPool, with a ring long enough for
+        every frame that can be in the queues, so the stages do not allocate them again on every frame.
+        With an adaptive model (a LightingCompensator in limits.lighting) the feeder updates the compensator with each
+        frame, in capture order, and the frame is segmented with the gains it returned, so the masks are the same
+        whatever the number of workers and the order in which they run.
+    """
+
+    def __init__(self, capture, limits, workers=2, tracker=None, scale=1, refine_radius=0, profiler=None,
+                 open_size=0, close_size=0):
+        self.capture = capture
+        self.profiler = profiler or NullProfiler()
+        self.limits = limits
+        self.lighting = getattr(limits, 'lighting', None)
+        self.tracker = tracker
+        self.scale = scale
+        self.refine_radius = refine_radius
+        # A buffer is written again only after every frame that could still hold it has been read
+        self.pool = BufferPool(ring=2 * workers + 4)
+        self.mask_filter = MaskFilter(open_size, close_size, self.pool)
+        if tracker is None:
+            self.segment = partial(segmentFrame, scale=scale, refine_radius=refine_radius,
+                                   mask_filter=self.mask_filter, pool=self.pool)
+        else:
+            self.segment = partial(maskFrame, scale=scale, mask_filter=self.mask_filter, pool=self.pool)
+        if self.profiler.enabled:
+            self.segment = self._timed(self.segment)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='Segmentation')
+
+        # One slot per worker plus one, so every worker is busy while the consumer paints
+        self.segmented = queue.Queue(maxsize=workers + 1)
+        self.results = queue.Queue(maxsize=1)
+        self.running = True
+        self.threads = [threading.Thread(target=self._feed, name='Feeder', daemon=True),
+                        threading.Thread(target=self._track, name='Tracking', daemon=True)]
+        for thread in self.threads:
+            thread.start()
+
+    def _timed(self, segment):
+        def timedSegment(*arguments, **keywords):
+            with self.profiler.stage('segmentation'):
+                return segment(*arguments, **keywords)
+
+        return timedSegment
+
+    def _feed(self):
+        """
+            Reads frames from the capture stage and hands them to the worker pool.
+        """
+        while self.running and self.capture.isOpened():
+            with self.profiler.stage('capture'):
+                ret, frame = self.capture.read()
+            if not ret:
+                break
+            # Mirror the frame. This also copies it out of the capture buffer, which is reused on the next read
+            with self.profiler.stage('flip'):
+                frame = cv2.flip(frame, 1, dst=self.pool.get('frame', frame.shape))
+            # The illumination follows the frames in capture order, each worker gets the gains of its frame
+            gains = None if self.lighting is None else self.lighting.update(frame)
+            future = self.executor.submit(self.segment, frame, self.limits, gains=gains)
+            self.segmented.put((future, gains))
+
+        # Mark the end of the stream
+        self.segmented.put(None)
+
+    def _track(self):
+        """
+            Collects the segmented frames in capture order and tracks the blob when a tracker is used.
+        """
+        while True:
+            item = self.segmented.get()
+            if item is None:
+                break
+            future, gains = item
+
+            if self.tracker is None:
+                result = future.result()
+            else:
+                segmented = future.result()
+                with self.profiler.stage('tracking'):
+                    result = trackFrame(*segmented, self.limits, find=self.tracker.update, scale=self.scale,
+                                        refine_radius=self.refine_radius, pool=self.pool, gains=gains)
+
+            self.results.put(result)
+
+        # Mark the end of the stream
+        self.results.put(None)
+
+    def read(self):
+        """
+            Returns (ret, frame, mask_original, mask, centroid, image_green) for the next frame, in capture order.
+        """
+        result = self.results.get()
+        if result is None:
+            self.running = False
+            return False, None, None, None, None, None
+
+        return (True,) + result
+
+    def isOpened(self):
+        return self.running
+
+    def release(self):
+        self.running = False
+        # Unblock the stages if they are waiting for a free slot
+        while any(thread.is_alive() for thread in self.threads):
+            for stage_queue in (self.segmented, self.results):
+                try:
+                    item = stage_queue.get_nowait()
+                except queue.Empty:
+                    continue
+                # Put back the end of the stream marker so the tracking thread can see it
+                if item is None and stage_queue is self.segmented:
+                    stage_queue.put(None)
+            for thread in self.threads:
+                thread.join(timeout=0.01)
+        self.executor.shutdown(wait=True)
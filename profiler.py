@@ -0,0 +1,157 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import nullcontext
+
+import cv2
+import numpy as np
+
+
+class Profiler:
+    """
+        Times the stages of a frame loop, with rolling windows of the last durations of each stage (to show
+        percentiles on a HUD) and, optionally, every event for a Chrome trace / Perfetto json file.
+        The loop thread marks its stages with laps: startFrame() at the top of the loop and lap(name) after each stage,
+        which records the time since the previous lap. Stages in other threads use the stage(name) context manager.
+        Use NullProfiler when profiling is off, it has the same methods and does nothing.
+    """
+
+    enabled = True
+
+    def __init__(self, window=120, trace=False, max_events=1000000):
+        self.window = window
+        self.durations = {}
+        self.frame_starts = deque(maxlen=window)
+        self.last = None
+
+        # Events for the trace: (name, thread id, start, duration), in seconds of perf_counter
+        self.events = deque(maxlen=max_events) if trace else None
+        self.thread_names = {}
+        self.origin = time.perf_counter()
+
+        # Text of the HUD, updated a few times per second so it can be read
+        self.hud = []
+        self.hud_time = 0
+
+    def _record(self, name, start, end):
+        durations = self.durations.get(name)
+        if durations is None:
+            durations = self.durations.setdefault(name, deque(maxlen=self.window))
+        durations.append(end - start)
+
+        if self.events is not None:
+            thread = threading.current_thread()
+            self.thread_names.setdefault(thread.ident, thread.name)
+            self.events.append((name, thread.ident, start, end - start))
+
+    def startFrame(self):
+        """
+            Marks the start of a frame of the loop (and the start of its first lap).
+        """
+        now = time.perf_counter()
+        if self.last is not None:
+            self._record('frame', self.frame_starts[-1], now)
+        self.frame_starts.append(now)
+        self.last = now
+
+    def lap(self, name):
+        """
+            Records the time since the last lap (or the start of the frame) as the stage name.
+        """
+        now = time.perf_counter()
+        self._record(name, self.last, now)
+        self.last = now
+
+    def stage(self, name):
+        """
+            Context manager that records the time of the block as the stage name, from any thread.
+        """
+        return _Stage(self, name)
+
+    def fps(self):
+        if len(self.frame_starts) < 2:
+            return 0.0
+        return (len(self.frame_starts) - 1) / (self.frame_starts[-1] - self.frame_starts[0])
+
+    def summary(self):
+        """
+            Returns {stage: (p50 ms, p99 ms)} over the rolling windows.
+        """
+        summary = {}
+        for name, durations in list(self.durations.items()):
+            values = 1000 * np.array(durations)
+            summary[name] = (float(np.percentile(values, 50)), float(np.percentile(values, 99)))
+
+        return summary
+
+    def drawHUD(self, image, refresh=0.25):
+        """
+            Writes the fps and the p50 / p99 milliseconds of each stage on the top left corner of the image.
+        """
+        now = time.perf_counter()
+        if now - self.hud_time > refresh:
+            self.hud_time = now
+            self.hud = ['%.1f fps' % self.fps()]
+            for name, (p50, p99) in self.summary().items():
+                self.hud.append('%-12s %6.2f %6.2f ms' % (name, p50, p99))
+
+        for i, text in enumerate(self.hud):
+            origin = (10, 20 + 18 * i)
+            cv2.putText(image, text, origin, cv2.FONT_HERSHEY_PLAIN, 1.1, (0, 0, 0), 3, cv2.LINE_AA)
+            cv2.putText(image, text, origin, cv2.FONT_HERSHEY_PLAIN, 1.1, (255, 255, 255), 1, cv2.LINE_AA)
+
+        return image
+
+    def saveTrace(self, file_name):
+        """
+            Saves the events in the Chrome trace event format, that chrome://tracing and ui.perfetto.dev open.
+        """
+        pid = os.getpid()
+        trace = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}}
+                 for tid, name in self.thread_names.items()]
+        for name, tid, start, duration in list(self.events or []):
+            trace.append({'name': name, 'ph': 'X', 'pid': pid, 'tid': tid,
+                          'ts': 1e6 * (start - self.origin), 'dur': 1e6 * duration})
+
+        with open(file_name, 'w') as file_handle:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, file_handle)
+
+
+class _Stage:
+    __slots__ = ('profiler', 'name', 'start')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.profiler._record(self.name, self.start, time.perf_counter())
+
+
+class NullProfiler:
+    """
+        Profiler that does nothing, used when profiling is off.
+    """
+
+    enabled = False
+    _null = nullcontext()
+
+    def startFrame(self):
+        pass
+
+    def lap(self, name):
+        pass
+
+    def stage(self, name):
+        return self._null
+
+    def drawHUD(self, image, refresh=0.25):
+        return image
+
+    def saveTrace(self, file_name):
+        pass
@@ -0,0 +1,146 @@
+#!/usr/bin/python3
+import argparse
+
+import cv2
+import numpy as np
+
+# Colours of the numbers 1 to 4, the same as the keys of ar_paint (yellow has no key yet)
+COLORS = np.array([(255, 0, 0), (0, 255, 0), (0, 0, 255), (0, 255, 255)], dtype=np.uint8)
+
+
+def voronoiOutlines(width, height, regions, rng, thickness):
+    """
+        Outlines of the Voronoi cells of random seeds: the label of the closest seed of every pixel is found with one
+        distance transform, and the borders are where it changes.
+    """
+    seeds = np.full((height, width), 255, dtype=np.uint8)
+    seeds[rng.integers(0, height, regions), rng.integers(0, width, regions)] = 0
+    _, cells = cv2.distanceTransformWithLabels(seeds, cv2.DIST_L2, 5, labelType=cv2.DIST_LABEL_CCOMP)
+
+    border = np.zeros((height, width), dtype=np.uint8)
+    border[:, 1:] |= cells[:, 1:] != cells[:, :-1]
+    border[1:, :] |= cells[1:, :] != cells[:-1, :]
+    if thickness > 1:
+        border = cv2.dilate(border, np.ones((thickness, thickness), dtype=np.uint8))
+
+    return border == 0
+
+
+def polygonOutlines(width, height, regions, rng, thickness):
+    """
+        Outlines of random convex polygons, that overlap and split each other in more regions.
+    """
+    outlines = np.full((height, width), 255, dtype=np.uint8)
+    size = min(width, height)
+    for _ in range(regions):
+        center = rng.uniform((0, 0), (width, height))
+        points = center + rng.normal(scale=size / 6, size=(rng.integers(3, 8), 2))
+        hull = cv2.convexHull(points.astype(np.int32))
+        cv2.polylines(outlines, [hull], True, 0, thickness)
+
+    return outlines > 0
+
+
+def regionCenters(inside, labels, num_labels):
+    """
+        For each region, the point farthest from its border, where its number is written (the centroid can be outside
+        of a region that is not convex).
+    """
+    distance = cv2.distanceTransform(inside.astype(np.uint8), cv2.DIST_L2, 3).ravel()
+    flat = labels.ravel()
+
+    # Sort by label, then by distance: the last pixel of each label is the farthest from its border
+    order = np.lexsort((distance, flat))
+    last = np.searchsorted(flat[order], np.arange(num_labels), side='right') - 1
+    ys, xs = np.divmod(order[last], labels.shape[1])
+
+    return np.stack([xs, ys], axis=1), distance[order[last]]
+
+
+def generatePuzzle(width, height, regions=20, kind='voronoi', seed=None, colors=COLORS):
+    """
+        Generates a numbered image to paint, with random regions (Voronoi cells or overlapping polygons).
+        Returns (image_to_paint, painted_image, labels, region_colors): region_colors[label] is the index (0 based) of
+        the colour of each region, -1 for label 0 (the outlines).
+    """
+    rng = np.random.default_rng(seed)
+    thickness = max(int(round(min(width, height) / 240)), 1)
+    if kind == 'voronoi':
+        inside = voronoiOutlines(width, height, regions, rng, thickness)
+    else:
+        inside = polygonOutlines(width, height, regions, rng, thickness)
+
+    # Border of the image, so the numbers are kept away from it too
+    inside[:thickness] = inside[-thickness:] = False
+    inside[:, :thickness] = inside[:, -thickness:] = False
+
+    num_labels, labels = cv2.connectedComponents(inside.astype(np.uint8), connectivity=4, ltype=cv2.CV_32S)
+
+    # The colour of every region, drawn in the range of the colours
+    region_colors = rng.integers(0, len(colors), num_labels)
+    region_colors[0] = -1
+
+    # Solution in one pass, with a lookup table of colours indexed by label (the outlines are black)
+    lut = np.zeros((num_labels, 3), dtype=np.uint8)
+    lut[1:] = colors[region_colors[1:]]
+    painted_image = lut[labels]
+
+    # Outlines and numbers on white
+    image_to_paint = np.where(inside[..., None], np.uint8(255), np.uint8(0)).repeat(3, axis=2)
+    centers, distances = regionCenters(inside, labels, num_labels)
+    font_scale = min(width, height) / 720
+    for label in range(1, num_labels):
+        # Only where the number fits
+        if distances[label] < 12 * font_scale:
+            continue
+        text = str(region_colors[label] + 1)
+        (text_width, text_height), _ = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, font_scale, 1)
+        origin = (int(centers[label][0] - text_width / 2), int(centers[label][1] + text_height / 2))
+        cv2.putText(image_to_paint, text, origin, cv2.FONT_HERSHEY_SIMPLEX, font_scale, (0, 0, 0), 1, cv2.LINE_AA)
+
+    return image_to_paint, painted_image, labels, region_colors
+
+
+def savePuzzle(prefix, image_to_paint, painted_image, labels, region_colors):
+    """
+        Saves prefix_numerada.png, prefix_pintada.png and prefix.regions.npz, the region index (labels, in the smallest
+        integer type, and the colour of each region).
+    """
+    dtype = np.uint16 if len(region_colors) <= np.iinfo(np.uint16).max else np.int32
+    cv2.imwrite(prefix + '_numerada.png', image_to_paint)
+    cv2.imwrite(prefix + '_pintada.png', painted_image)
+    np.savez_compressed(prefix + '.regions.npz', labels=labels.astype(dtype), region_colors=region_colors)
+
+
+def loadPuzzle(prefix):
+    """
+        Loads a puzzle saved by savePuzzle, without computing the regions again.
+        Returns (image_to_paint, painted_image, labels, region_colors).
+    """
+    image_to_paint = cv2.imread(prefix + '_numerada.png')
+    painted_image = cv2.imread(prefix + '_pintada.png')
+    with np.load(prefix + '.regions.npz') as data:
+        labels = data['labels'].astype(np.int32)
+        region_colors = data['region_colors']
+
+    return image_to_paint, painted_image, labels, region_colors
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Generate numbered images to paint with AR_PAINT')
+    ap.add_argument('-o', '--output', default='puzzle', help='Prefix of the files to save.')
+    ap.add_argument('-r', '--resolution', default='640x480', help='Resolution of the images, e.g. 1280x720.')
+    ap.add_argument('-n', '--regions', type=int, default=20, help='Number of Voronoi cells or polygons.')
+    ap.add_argument('-k', '--kind', choices=['voronoi', 'polygons'], default='voronoi', help='Kind of regions.')
+    ap.add_argument('-s', '--seed', type=int, help='Seed of the random generator, to generate the same puzzle again.')
+    args = vars(ap.parse_args())
+
+    width, height = (int(v) for v in args['resolution'].lower().split('x'))
+    puzzle = generatePuzzle(width, height, args['regions'], args['kind'], args['seed'])
+    savePuzzle(args['output'], *puzzle)
+    print('Puzzle with ' + str(len(puzzle[3]) - 1) + ' regions saved as ' + args['output'] + '_numerada.png, ' +
+          args['output'] + '_pintada.png and ' + args['output'] + '.regions.npz')
+
+
+if __name__ == '__main__':
+    main()
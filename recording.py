@@ -0,0 +1,174 @@
+import json
+import queue
+import struct
+import threading
+import time
+
+import cv2
+import numpy as np
+
+# File layout: MAGIC, header length (uint32) and header (json), then records of
+#   b'F' + length (uint32) + timestamp (float64) + PNG of the frame
+#   b'E' + length (uint32) + frame index (uint32) + key (int32) + n * (event, x, y, flags) (int32)
+MAGIC = b'ARPAINT1'
+RECORD = struct.Struct('<cI')
+TIMESTAMP = struct.Struct('<d')
+EVENTS = struct.Struct('<Ii')
+MOUSE_EVENT = struct.Struct('<4i')
+
+
+class SessionRecorder:
+    """
+        Records a session of ar_paint: every frame read from the camera (compressed without loss, as PNG) and the key
+        and mouse events of each processed frame. The encoding and writing run in a background thread.
+        At most max_queued records wait for it. When the thread falls behind, writeFrame and writeEvents wait for room
+        instead of dropping anything, since a replay needs every frame: the number of waits and the time spent
+        waiting are counted (stalls, stalled_time), to see when the disk or the encoding slows the capture down.
+    """
+
+    def __init__(self, file_name, header, max_queued=32):
+        self.file = open(file_name, 'wb')
+        header = json.dumps(header).encode()
+        self.file.write(MAGIC + struct.pack('<I', len(header)) + header)
+
+        self.start = time.perf_counter()
+        self.queue = queue.Queue(maxsize=max_queued)
+        self.stalls = 0
+        self.stalled_time = 0.0
+        self.thread = threading.Thread(target=self._write, name='SessionRecorder', daemon=True)
+        self.thread.start()
+
+    def _write(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+
+            kind, data = item
+            if kind == b'F':
+                timestamp, frame = data
+                _, encoded = cv2.imencode('.png', frame, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+                payload = TIMESTAMP.pack(timestamp) + encoded.tobytes()
+            else:
+                payload = data
+            self.file.write(RECORD.pack(kind, len(payload)) + payload)
+
+    def _put(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            started = time.perf_counter()
+            self.queue.put(item)
+            self.stalls += 1
+            self.stalled_time += time.perf_counter() - started
+
+    def writeFrame(self, frame):
+        # The capture buffer is reused, so the frame is copied before it is encoded in the background
+        self._put((b'F', (time.perf_counter() - self.start, frame.copy())))
+
+    def writeEvents(self, index, key, mouse_events):
+        payload = EVENTS.pack(index, key) + b''.join(MOUSE_EVENT.pack(*event) for event in mouse_events)
+        self._put((b'E', payload))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.file.close()
+
+
+class RecordingCapture:
+    """
+        Wraps a capture (cv2.VideoCapture or FrameGrabber) and records every frame that is read from it.
+    """
+
+    def __init__(self, capture, recorder):
+        self.capture = capture
+        self.recorder = recorder
+
+    def isOpened(self):
+        return self.capture.isOpened()
+
+    def read(self):
+        ret, frame = self.capture.read()
+        if ret:
+            self.recorder.writeFrame(frame)
+        return ret, frame
+
+    def stats(self):
+        return self.capture.stats()
+
+    def release(self):
+        self.capture.release()
+
+
+class SessionReader:
+    """
+        Plays a recorded session back, with the same isOpened/read/release methods as cv2.VideoCapture.
+        The frames are read as fast as possible, or at the recorded times with realtime=True. events() returns the key
+        and mouse events recorded for each processed frame.
+    """
+
+    def __init__(self, file_name, realtime=False):
+        self.file = open(file_name, 'rb')
+        if self.file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(file_name + ' is not an ar_paint recording')
+        header_length, = struct.unpack('<I', self.file.read(4))
+        self.header = json.loads(self.file.read(header_length))
+
+        # Index the records, skipping the frames
+        self.frames = []
+        self.key_events = {}
+        while True:
+            record = self.file.read(RECORD.size)
+            if len(record) < RECORD.size:
+                break
+            kind, length = RECORD.unpack(record)
+            if kind == b'F':
+                timestamp, = TIMESTAMP.unpack(self.file.read(TIMESTAMP.size))
+                self.frames.append((timestamp, self.file.tell(), length - TIMESTAMP.size))
+                self.file.seek(length - TIMESTAMP.size, 1)
+            else:
+                payload = self.file.read(length)
+                index, key = EVENTS.unpack_from(payload)
+                mouse_events = [MOUSE_EVENT.unpack_from(payload, offset)
+                                for offset in range(EVENTS.size, length, MOUSE_EVENT.size)]
+                self.key_events[index] = (key, mouse_events)
+
+        self.realtime = realtime
+        self.position = 0
+        self.start = None
+
+    def isOpened(self):
+        return self.position < len(self.frames)
+
+    def read(self):
+        if self.position >= len(self.frames):
+            return False, None
+        timestamp, offset, length = self.frames[self.position]
+        self.position += 1
+
+        # Wait for the time the frame was recorded
+        if self.realtime:
+            if self.start is None:
+                self.start = time.perf_counter() - timestamp
+            delay = self.start + timestamp - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+        self.file.seek(offset)
+        frame = cv2.imdecode(np.frombuffer(self.file.read(length), dtype=np.uint8), cv2.IMREAD_COLOR)
+
+        return True, frame
+
+    def events(self, index):
+        """
+            Returns (key, mouse_events) recorded for the processed frame index.
+        """
+        return self.key_events.get(index, (-1, []))
+
+    def stats(self):
+        return {'captured': len(self.frames), 'delivered': self.position, 'dropped': 0, 'queue_depth': 0,
+                'max_queue_depth': 0}
+
+    def release(self):
+        self.file.close()
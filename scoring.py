@@ -0,0 +1,227 @@
+import cv2
+import numpy as np
+
+WHITE = 0xFFFFFF
+
+
+class RegionScorer:
+    """
+        Scores a painting against the painted reference of the numeric painting, region by region.
+        The regions are the labels of findFormsCentroids on the numbered image. The colour each region should have is
+        the most common colour of the reference inside it, found once. On every call the canvas is packed to one
+        uint32 per pixel in a reused buffer, so checking a pixel is one integer comparison, and the accuracy (pixels of
+        the right colour) and the coverage (pixels painted) of every region are counted with bincount.
+        The mean squared error is computed by cv2.norm on the uint8 images, and the SSIM, which is optional, on
+        grayscale images downsampled by ssim_scale, in float32.
+        It is fast enough to score every frame.
+    """
+
+    def __init__(self, painted_image, labels, ssim_scale=0.25, min_area=50, colors=None):
+        self.height, self.width = labels.shape
+        self.labels = labels.astype(np.intp).ravel()
+        self.num_labels = int(self.labels.max()) + 1
+        self.ssim_scale = ssim_scale
+
+        # Reused buffers: the canvas at the size of the reference and its pixels packed as uint32
+        self.resized = np.empty((self.height, self.width, 3), dtype=np.uint8)
+        self.packed = np.zeros((self.height, self.width, 4), dtype=np.uint8)
+
+        # Pixels of each region. Label 0 (the outlines and the numbers) and the regions below min_area (the holes of
+        # the numbers) are not scored
+        self.areas = np.bincount(self.labels, minlength=self.num_labels)
+        self.areas[0] = 0
+        self.areas[self.areas < min_area] = 0
+        self.ignored = self.areas == 0
+
+        # Colour of each region, and the colour each pixel should have
+        if colors is None:
+            self.colors = self._mostCommonColors(self._pack(painted_image).ravel())
+        else:
+            colors = np.asarray(colors, dtype=np.uint32)
+            self.colors = colors[:, 0] | colors[:, 1] << 8 | colors[:, 2] << 16
+        self.colors[0] = 0
+        self.target = self.colors[self.labels]
+
+        self.painted_image = painted_image
+        self.reference_ssim = self._ssimStatistics(painted_image)
+
+    def _mostCommonColors(self, reference):
+        """
+            Most common packed colour of each region (the lowest one on a tie). The pairs (label, colour) are counted
+            with one np.unique on label * 2^24 + colour, and sorted by label and decreasing count, so the first pair of
+            every label is its colour.
+        """
+        keys, counts = np.unique(self.labels.astype(np.int64) << 24 | reference, return_counts=True)
+        order = np.lexsort((-counts, keys >> 24))
+        keys = keys[order]
+        first = np.r_[True, keys[1:] >> 24 != keys[:-1] >> 24]
+
+        colors = np.zeros(self.num_labels, dtype=np.uint32)
+        colors[keys[first] >> 24] = keys[first] & WHITE
+        return colors
+
+    def _pack(self, image):
+        """
+            Packs a BGR image in the reused buffer and returns it as one uint32 (B + G * 256 + R * 65536) per pixel.
+        """
+        cv2.mixChannels([image], [self.packed], [0, 0, 1, 1, 2, 2])
+        return self.packed.view('<u4').reshape(self.height, self.width)
+
+    def fit(self, image):
+        """
+            The canvas at the size of the reference.
+        """
+        if image.shape[:2] == (self.height, self.width):
+            return image
+        cv2.resize(image, (self.width, self.height), dst=self.resized, interpolation=cv2.INTER_NEAREST)
+        return self.resized
+
+    def _ssimStatistics(self, image):
+        """
+            Downsampled grayscale image, in float32, with its local means and variances.
+        """
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        if self.ssim_scale != 1:
+            gray = cv2.resize(gray, None, fx=self.ssim_scale, fy=self.ssim_scale, interpolation=cv2.INTER_AREA)
+        gray = gray.astype(np.float32)
+
+        mean = cv2.GaussianBlur(gray, (7, 7), 1.5)
+        variance = cv2.GaussianBlur(gray * gray, (7, 7), 1.5) - mean * mean
+
+        return gray, mean, variance
+
+    def ssim(self, image):
+        """
+            Structural similarity between the reference and the image, with a 7x7 gaussian window.
+        """
+        c1, c2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2
+        x, mean_x, variance_x = self.reference_ssim
+        y, mean_y, variance_y = self._ssimStatistics(image)
+        covariance = cv2.GaussianBlur(x * y, (7, 7), 1.5) - mean_x * mean_y
+
+        ssim = ((2 * mean_x * mean_y + c1) * (2 * covariance + c2)) / \
+               ((mean_x * mean_x + mean_y * mean_y + c1) * (variance_x + variance_y + c2))
+
+        return float(ssim.mean())
+
+    def score(self, canvas_image, ssim=False):
+        """
+            Returns a dictionary with the accuracy and coverage (0 to 1) of the whole painting and of each region
+            ({label: {'accuracy': .., 'coverage': .., 'area': ..}}), the mean squared error and, with ssim=True,
+            the structural similarity.
+        """
+        image = self.fit(canvas_image)
+        packed = self._pack(image).ravel()
+
+        correct = np.bincount(self.labels[packed == self.target], minlength=self.num_labels)
+        painted = np.bincount(self.labels[packed != WHITE], minlength=self.num_labels)
+        correct[self.ignored] = 0
+        painted[self.ignored] = 0
+
+        total = max(int(self.areas.sum()), 1)
+        regions = {}
+        for label in np.flatnonzero(self.areas):
+            regions[int(label)] = {'accuracy': float(correct[label] / self.areas[label]),
+                                   'coverage': float(painted[label] / self.areas[label]),
+                                   'area': int(self.areas[label])}
+
+        result = {'accuracy': float(correct.sum() / total), 'coverage': float(painted.sum() / total), 'regions': regions,
+                  'mse': cv2.norm(self.painted_image, image, cv2.NORM_L2SQR) / (self.height * self.width)}
+        if ssim:
+            result['ssim'] = self.ssim(image)
+
+        return result
+
+
+class ProgressScorer(RegionScorer):
+    """
+        RegionScorer that keeps the score of a Canvas up to date as it is painted.
+        It keeps the state of every pixel of the reference (0 white, 1 wrong colour, 2 right colour) and the counts of
+        painted and correct pixels of each region. The canvas tells it the dirty rectangle of every change, and only
+        those pixels are checked again, so the cost of progress() depends on what was painted since the last call and
+        not on the size of the image.
+        The canvas is mapped to the reference by nearest neighbour, like fit().
+    """
+
+    def __init__(self, painted_image, labels, canvas, ssim_scale=0.25, min_area=50, colors=None):
+        super().__init__(painted_image, labels, ssim_scale, min_area, colors)
+        self.canvas = canvas
+        self.labels_image = self.labels.reshape(self.height, self.width)
+        self.target_image = self.target.reshape(self.height, self.width)
+
+        # Canvas pixel of each reference column and row (the same sampling as cv2.resize with INTER_NEAREST)
+        self.same_size = (canvas.height, canvas.width) == (self.height, self.width)
+        self.map_x = np.minimum(np.arange(self.width) * canvas.width // self.width, canvas.width - 1)
+        self.map_y = np.minimum(np.arange(self.height) * canvas.height // self.height, canvas.height - 1)
+
+        self.status = np.zeros((self.height, self.width), dtype=np.uint8)
+        self.correct = np.zeros(self.num_labels, dtype=np.int64)
+        self.painted = np.zeros(self.num_labels, dtype=np.int64)
+        self.dirty = [(0, 0, canvas.width, canvas.height)]
+
+        # Region with most pixels changed in the last update, for the feedback
+        self.last_region = None
+
+        canvas.watchers.append(self.dirty.append)
+
+    def _referenceRect(self, rect):
+        """
+            Rectangle of the reference whose pixels sample the canvas rectangle.
+        """
+        x0, y0, x1, y1 = rect
+        if self.same_size:
+            return rect
+        return (int(np.searchsorted(self.map_x, x0)), int(np.searchsorted(self.map_y, y0)),
+                int(np.searchsorted(self.map_x, x1)), int(np.searchsorted(self.map_y, y1)))
+
+    def _update(self, rect):
+        x0, y0, x1, y1 = self._referenceRect(rect)
+        if x0 >= x1 or y0 >= y1:
+            return
+        window = (slice(y0, y1), slice(x0, x1))
+
+        if self.same_size:
+            patch = self.canvas.image[window]
+        else:
+            patch = self.canvas.image[self.map_y[y0:y1, None], self.map_x[None, x0:x1]]
+        packed = patch[..., 0].astype(np.uint32) | (patch[..., 1].astype(np.uint32) << 8) | \
+                 (patch[..., 2].astype(np.uint32) << 16)
+
+        status = np.where(packed == self.target_image[window], 2, packed != WHITE).astype(np.uint8)
+        old = self.status[window]
+        changed = status != old
+        if not changed.any():
+            return
+
+        labels = self.labels_image[window][changed]
+        old_status, new_status = old[changed], status[changed]
+        self.correct -= np.bincount(labels[old_status == 2], minlength=self.num_labels)
+        self.correct += np.bincount(labels[new_status == 2], minlength=self.num_labels)
+        self.painted -= np.bincount(labels[old_status > 0], minlength=self.num_labels)
+        self.painted += np.bincount(labels[new_status > 0], minlength=self.num_labels)
+        self.status[window] = status
+
+        touched = np.bincount(labels, minlength=self.num_labels)
+        touched[self.ignored] = 0
+        if touched.any():
+            self.last_region = int(np.argmax(touched))
+
+    def progress(self):
+        """
+            Updates the counts with the rectangles changed since the last call and returns the accuracy and coverage
+            of the painting and of each region, with the wrong pixels of each region, as score() does.
+        """
+        while self.dirty:
+            self._update(self.dirty.pop())
+
+        correct = np.where(self.ignored, 0, self.correct)
+        painted = np.where(self.ignored, 0, self.painted)
+        total = max(int(self.areas.sum()), 1)
+        regions = {}
+        for label in np.flatnonzero(self.areas):
+            regions[int(label)] = {'accuracy': float(correct[label] / self.areas[label]),
+                                   'coverage': float(painted[label] / self.areas[label]),
+                                   'wrong': int(painted[label] - correct[label]), 'area': int(self.areas[label])}
+
+        return {'accuracy': float(correct.sum() / total), 'coverage': float(painted.sum() / total),
+                'regions': regions, 'last_region': self.last_region}
@@ -0,0 +1,187 @@
+import math
+
+import numpy as np
+
+# Uniform Catmull-Rom spline: point(t) = [t^3, t^2, t, 1] . CATMULL_ROM . [p0, p1, p2, p3], from p1 (t = 0) to p2
+CATMULL_ROM = 0.5 * np.array([[-1, 3, -3, 1],
+                              [2, -5, 4, -1],
+                              [-1, 0, 1, 0],
+                              [0, 2, 0, 0]], dtype=np.float64)
+
+
+class OneEuroFilter:
+    """
+        One Euro filter of a 2D point (Casiez et al. 2012): an exponential filter whose cutoff frequency grows with
+        the speed of the point, so it removes the jitter of a still marker and follows a fast one without lag.
+            - min_cutoff (Hz): cutoff when the point is still, lower is smoother
+            - beta: how fast the cutoff grows with the speed (in pixels per second), higher follows faster
+        It works on Python floats, which is faster than numpy for a single point.
+    """
+
+    def __init__(self, min_cutoff=1.0, beta=0.02, d_cutoff=1.0):
+        self.min_cutoff = min_cutoff
+        self.beta = beta
+        self.d_cutoff = d_cutoff
+        self.reset()
+
+    def reset(self):
+        self.point = None
+        self.speed = (0.0, 0.0)
+
+    @staticmethod
+    def _alpha(cutoff, dt):
+        tau = 1 / (2 * math.pi * cutoff)
+        return 1 / (1 + tau / dt)
+
+    def __call__(self, point, dt):
+        x, y = float(point[0]), float(point[1])
+        if self.point is None:
+            self.point = (x, y)
+            return self.point
+
+        # Filtered speed, which sets the cutoff of the point
+        px, py = self.point
+        alpha = self._alpha(self.d_cutoff, dt)
+        vx = self.speed[0] + alpha * ((x - px) / dt - self.speed[0])
+        vy = self.speed[1] + alpha * ((y - py) / dt - self.speed[1])
+        self.speed = (vx, vy)
+
+        alpha = self._alpha(self.min_cutoff + self.beta * math.hypot(vx, vy), dt)
+        self.point = (px + alpha * (x - px), py + alpha * (y - py))
+
+        return self.point
+
+
+class StrokeSmoother:
+    """
+        Turns the centroids of the marker, one per frame, into a smooth stroke:
+            - outliers: a point farther than max_jump pixels from where the marker was expected (moving at its last
+              speed) is only accepted if the next point confirms it, so a wrong detection in one frame is dropped but
+              a fast stroke is not broken
+            - filter: a OneEuroFilter, with the time of each frame from fps
+            - curve: the filtered points are joined with Catmull-Rom segments through the last four points, kept in a
+              fixed size buffer, and sampled every step pixels
+        update() returns the points of the new part of the curve (an int32 array for cv2.polylines) or None. Each
+        segment is returned one frame later, when the point after it is known. The stroke ends after max_missing
+        frames without the marker, or with end().
+    """
+
+    def __init__(self, fps=30, min_cutoff=1.0, beta=0.02, max_jump=50, max_missing=3, step=2, max_samples=32):
+        self.dt = 1 / fps
+        self.filter = OneEuroFilter(min_cutoff, beta)
+        self.max_jump = max_jump
+        self.max_missing = max_missing
+        self.step = step
+        self.max_samples = max_samples
+
+        # Last four filtered points. A stroke starts with its first point repeated, which makes its first segment
+        # start at that point
+        self.buffer = np.zeros((4, 2))
+        self.points = 0
+        self.last = None
+        self.velocity = (0.0, 0.0)
+        self.candidate = None
+        self.missing = 0
+
+        # Basis of the samples of a segment, by number of samples
+        self.bases = {}
+
+    def _basis(self, samples):
+        basis = self.bases.get(samples)
+        if basis is None:
+            t = np.linspace(0, 1, samples + 1)
+            basis = self.bases[samples] = np.stack([t ** 3, t ** 2, t, np.ones_like(t)], axis=1) @ CATMULL_ROM
+
+        return basis
+
+    def _push(self, point):
+        if self.points == 0:
+            self.buffer[:] = point
+        else:
+            self.buffer[:-1] = self.buffer[1:]
+            self.buffer[-1] = point
+        self.points += 1
+
+    def _segment(self):
+        """
+            Samples of the curve between the second and the third point of the buffer.
+        """
+        (x1, y1), (x2, y2) = self.buffer[1], self.buffer[2]
+        samples = min(max(int(math.hypot(x2 - x1, y2 - y1) / self.step), 1), self.max_samples)
+        curve = self._basis(samples) @ self.buffer
+
+        return np.rint(curve, out=curve).astype(np.int32)
+
+    def update(self, point):
+        """
+            Adds the centroid of a frame, or None if the marker was not found.
+        """
+        if point is None:
+            self.missing += 1
+            if self.missing > self.max_missing:
+                return self.end()
+            return None
+
+        x, y = float(point[0]), float(point[1])
+
+        # A jump away from the expected position is only accepted if the next point is close to it (or farther in
+        # the same direction)
+        if self.last is not None:
+            steps = self.missing + 1
+            expected_x, expected_y = self.last[0] + steps * self.velocity[0], self.last[1] + steps * self.velocity[1]
+            jump = math.hypot(x - expected_x, y - expected_y)
+            if jump > self.max_jump * steps:
+                candidate = self.candidate
+                if candidate is None or math.hypot(x - candidate[0], y - candidate[1]) > \
+                        max(self.max_jump, math.hypot(candidate[0] - self.last[0], candidate[1] - self.last[1])):
+                    self.candidate = (x, y)
+                    self.missing += 1
+                    return None
+
+                # Confirmed: the candidate was a real point of the stroke, one frame before this one
+                self.candidate = None
+                self.missing -= 1
+                before = self._add(candidate)
+                after = self._add((x, y))
+                if before is None:
+                    return after
+                return np.concatenate([before, after[1:]])
+
+        return self._add((x, y))
+
+    def _add(self, point):
+        """
+            Adds an accepted point: returns the segment that ends one point before it, or None.
+        """
+        x, y = point
+        steps = self.missing + 1
+        if self.last is not None:
+            self.velocity = ((x - self.last[0]) / steps, (y - self.last[1]) / steps)
+        self.candidate = None
+        self.missing = 0
+        self.last = (x, y)
+
+        self._push(self.filter((x, y), self.dt * steps))
+        if self.points < 3:
+            return None
+
+        return self._segment()
+
+    def end(self):
+        """
+            Ends the stroke: returns its last segment (or its only point) and starts a new one. None without a stroke.
+        """
+        curve = None
+        if self.points:
+            # The last point repeated ends the curve at it
+            self._push(self.buffer[-1].copy())
+            curve = self._segment()
+
+        self.points = 0
+        self.filter.reset()
+        self.last = None
+        self.velocity = (0.0, 0.0)
+        self.candidate = None
+        self.missing = 0
+
+        return curve
@@ -0,0 +1,265 @@
+#!/usr/bin/python3
+import argparse
+
+import cv2
+import numpy as np
+
+# Kinds of items
+POLYLINE = 0
+RECTANGLE = 1
+CIRCLE = 2
+CLEAR = 3
+
+# Columns of the items array
+KIND, FIRST, COUNT, BLUE, GREEN, RED, SIZE, RADIUS, VISIBLE = range(9)
+
+
+class StrokeList:
+    """
+        Vector record of everything drawn on the canvas, kept in two growing numpy arrays:
+            points: (x, y) of every polyline vertex, rectangle corner and circle center
+            items: one row per polyline, rectangle, circle or clear, with its first point, number of points, colour,
+                   size, radius and visibility (strokes undone are hidden)
+        Consecutive lines with the same colour and size that continue each other are merged into one polyline, so the
+        memory grows with the amount of ink and not with the size of the canvas.
+        The strokes can be rendered at any scale, exported to SVG and saved to / loaded from a .npz session file.
+    """
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.points = np.empty((256, 2), dtype=np.int32)
+        self.items = np.empty((64, 9), dtype=np.int32)
+        self.num_points = 0
+        self.num_items = 0
+        # Points no item uses any more, left by extend()
+        self.unused_points = 0
+
+        # Lines never continue the polylines before this item, so each undo stroke has its own items
+        self.sealed = 0
+
+    def __len__(self):
+        return self.num_items
+
+    def _grow(self, points, items):
+        """
+            Doubles the capacity of the arrays when needed.
+        """
+        while self.num_points + points > len(self.points):
+            self.points = np.concatenate([self.points, np.empty_like(self.points)])
+        while self.num_items + items > len(self.items):
+            self.items = np.concatenate([self.items, np.empty_like(self.items)])
+
+    def _addItem(self, kind, points, color=(0, 0, 0), size=0, radius=0):
+        self._grow(len(points), 1)
+        self.points[self.num_points:self.num_points + len(points)] = points
+        self.items[self.num_items] = (kind, self.num_points, len(points), color[0], color[1], color[2], size, radius, 1)
+        self.num_points += len(points)
+        self.num_items += 1
+
+    def line(self, pt1, pt2, color, size):
+        self.polyline([pt1, pt2], color, size)
+
+    def polyline(self, points, color, size):
+        # Continue the last polyline if this one starts where it ends, with the same colour and size
+        if self.num_items > self.sealed:
+            # Compared as Python ints, which is faster than numpy for a single row
+            kind, first, count, blue, green, red, last_size, _, visible = self.items[self.num_items - 1].tolist()
+            if kind == POLYLINE and visible and first + count == self.num_points and \
+                    (blue, green, red) == tuple(color) and last_size == size and \
+                    self.points[self.num_points - 1].tolist() == [int(points[0][0]), int(points[0][1])]:
+                self._grow(len(points) - 1, 0)
+                self.points[self.num_points:self.num_points + len(points) - 1] = points[1:]
+                self.num_points += len(points) - 1
+                self.items[self.num_items - 1, COUNT] += len(points) - 1
+                return
+
+        self._addItem(POLYLINE, points, color, size)
+
+    def extend(self, index, points):
+        """
+            Adds points to the end of the polyline index, which need not be the last item (e.g. the stroke of a drawer
+            of the canvas server, continued after the items of the others). Its points are moved to the end of the
+            array when other points follow them, and compact() reclaims the space they leave once it is half of it.
+        """
+        first, count = int(self.items[index, FIRST]), int(self.items[index, COUNT])
+        if first + count != self.num_points:
+            self._grow(count, 0)
+            self.points[self.num_points:self.num_points + count] = self.points[first:first + count]
+            self.items[index, FIRST] = self.num_points
+            self.num_points += count
+            self.unused_points += count
+
+        self._grow(len(points), 0)
+        self.points[self.num_points:self.num_points + len(points)] = points
+        self.num_points += len(points)
+        self.items[index, COUNT] += len(points)
+
+        if self.unused_points > self.num_points // 2:
+            self.compact()
+
+    def compact(self):
+        """
+            Packs the points of the items in their order, without the ones no item uses.
+        """
+        items = self.items[:self.num_items]
+        counts = items[:, COUNT]
+        firsts = np.cumsum(counts) - counts
+        total = int(counts.sum())
+        self.points[:total] = self.points[np.arange(total) + np.repeat(items[:, FIRST] - firsts, counts)]
+        items[:, FIRST] = firsts
+        self.num_points = total
+        self.unused_points = 0
+
+    def rectangle(self, pt1, pt2, color, size):
+        self._addItem(RECTANGLE, [pt1, pt2], color, size)
+
+    def circle(self, center, radius, color, size):
+        self._addItem(CIRCLE, [center], color, size, radius)
+
+    def clear(self):
+        self._addItem(CLEAR, np.empty((0, 2)))
+
+    def seal(self):
+        """
+            Makes the next line start a new polyline.
+        """
+        self.sealed = self.num_items
+
+    def setVisible(self, first, last, visible):
+        """
+            Shows or hides the items first to last - 1 (used by undo and redo).
+        """
+        self.items[first:last, VISIBLE] = int(visible)
+
+    def resized(self, width, height):
+        """
+            Copy of the strokes for a canvas of another size, letterboxed: scaled by the same ratio in x and y, so the
+            shapes keep their proportions, and centered. The points, sizes and radii are rounded to whole pixels.
+        """
+        scale = min(width / self.width, height / self.height)
+        offset = ((width - self.width * scale) / 2, (height - self.height * scale) / 2)
+
+        strokes = StrokeList(width, height)
+        strokes._grow(self.num_points, self.num_items)
+        strokes.num_points = self.num_points
+        strokes.num_items = self.num_items
+        strokes.points[:self.num_points] = np.round(self.points[:self.num_points] * scale + offset)
+        items = strokes.items[:self.num_items]
+        items[:] = self.items[:self.num_items]
+        # Lines keep a width of at least one pixel, as in render()
+        items[:, SIZE] = np.maximum(np.round(items[:, SIZE] * scale), np.minimum(items[:, SIZE], 1))
+        items[:, RADIUS] = np.round(items[:, RADIUS] * scale)
+        strokes.sealed = self.num_items
+
+        return strokes
+
+    def visibleIndexes(self):
+        """
+            Indexes of the visible items after the last visible clear, which are the ones that can be seen.
+        """
+        visible = np.flatnonzero(self.items[:self.num_items, VISIBLE] == 1)
+        clears = np.flatnonzero(self.items[visible, KIND] == CLEAR)
+        if len(clears):
+            visible = visible[clears[-1] + 1:]
+
+        return visible
+
+    def _visibleItems(self):
+        return self.items[self.visibleIndexes()]
+
+    def render(self, scale=1.0, image=None, indexes=None):
+        """
+            Rasterizes the strokes at any scale. The coordinates use 4 fractional bits, so non integer scales keep
+            sub-pixel precision. With indexes only those items are drawn (in that order, e.g. the visible ones over a
+            region), on the image as it is.
+        """
+        shift = 4
+        factor = scale * (1 << shift)
+        if image is None:
+            image = np.full((int(round(self.height * scale)), int(round(self.width * scale)), 3), 255, dtype=np.uint8)
+
+        for item in self._visibleItems() if indexes is None else self.items[indexes]:
+            points = np.round(self.points[item[FIRST]:item[FIRST] + item[COUNT]] * factor).astype(np.int32)
+            color = (int(item[BLUE]), int(item[GREEN]), int(item[RED]))
+            size = max(int(round(item[SIZE] * scale)), 1)
+
+            if item[KIND] == POLYLINE:
+                cv2.polylines(image, [points], False, color, size, cv2.LINE_8, shift)
+            elif item[KIND] == RECTANGLE:
+                cv2.rectangle(image, tuple(points[0]), tuple(points[1]), color, size, cv2.LINE_8, shift)
+            elif item[KIND] == CIRCLE:
+                radius = int(round(item[RADIUS] * factor))
+                cv2.circle(image, tuple(points[0]), radius, color, size, cv2.LINE_8, shift)
+
+        return image
+
+    def toSVG(self, scale=1.0):
+        """
+            Returns the strokes as an SVG document.
+        """
+        width, height = self.width * scale, self.height * scale
+        lines = ['<svg xmlns="http://www.w3.org/2000/svg" width="%g" height="%g" viewBox="0 0 %d %d">'
+                 % (width, height, self.width, self.height),
+                 '<rect width="100%" height="100%" fill="white"/>']
+
+        for item in self._visibleItems():
+            points = self.points[item[FIRST]:item[FIRST] + item[COUNT]]
+            style = 'fill="none" stroke="rgb(%d,%d,%d)" stroke-width="%d" stroke-linecap="round" ' \
+                    'stroke-linejoin="round"' % (item[RED], item[GREEN], item[BLUE], item[SIZE])
+
+            if item[KIND] == POLYLINE:
+                lines.append('<polyline points="%s" %s/>' % (' '.join('%d,%d' % tuple(p) for p in points), style))
+            elif item[KIND] == RECTANGLE:
+                (x0, y0), (x1, y1) = np.minimum(points[0], points[1]), np.maximum(points[0], points[1])
+                lines.append('<rect x="%d" y="%d" width="%d" height="%d" %s/>' % (x0, y0, x1 - x0, y1 - y0, style))
+            elif item[KIND] == CIRCLE:
+                lines.append('<circle cx="%d" cy="%d" r="%d" %s/>' % (points[0][0], points[0][1], item[RADIUS], style))
+
+        lines.append('</svg>')
+
+        return '\n'.join(lines)
+
+    def save(self, file_name):
+        """
+            Saves the session, only the used part of the arrays.
+        """
+        np.savez_compressed(file_name, size=np.array([self.width, self.height]),
+                            points=self.points[:self.num_points], items=self.items[:self.num_items])
+
+    @classmethod
+    def load(cls, file_name):
+        with np.load(file_name) as data:
+            strokes = cls(*(int(v) for v in data['size']))
+            strokes._grow(len(data['points']), len(data['items']))
+            strokes.num_points = len(data['points'])
+            strokes.num_items = len(data['items'])
+            strokes.points[:strokes.num_points] = data['points']
+            strokes.items[:strokes.num_items] = data['items']
+            strokes.sealed = strokes.num_items
+
+        return strokes
+
+
+def main():
+    # Create argparse
+    ap = argparse.ArgumentParser(description='Export a saved AR_PAINT session at any resolution')
+    ap.add_argument('session', help='Session file (.npz) saved by ar_paint')
+    ap.add_argument('-s', '--scale', type=float, default=1.0, help='Scale of the exported image.')
+    ap.add_argument('-p', '--png', help='Output image file.')
+    ap.add_argument('--svg', help='Output SVG file.')
+    args = vars(ap.parse_args())
+
+    strokes = StrokeList.load(args['session'])
+
+    if args['png']:
+        cv2.imwrite(args['png'], strokes.render(args['scale']))
+        print('Image saved as ' + args['png'])
+    if args['svg']:
+        with open(args['svg'], 'w') as file_handle:
+            file_handle.write(strokes.toSVG(args['scale']))
+        print('SVG saved as ' + args['svg'])
+
+
+if __name__ == '__main__':
+    main()
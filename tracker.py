@@ -0,0 +1,233 @@
+from collections import namedtuple
+
+import cv2
+import numpy as np
+
+# A blob of a marker: stable id across frames, marker number (index in MarkerModel.markers), centroid and area
+Pointer = namedtuple('Pointer', 'id marker centroid area')
+
+
+class BlobTracker:
+    """
+        Tracks the largest blob of a mask from frame to frame.
+        Instead of labelling the whole mask, it only labels a window around the position predicted by a constant
+        velocity model. A full frame scan is only done when the blob is lost, when the blob touches the border of the
+        window, or every rescan_every frames so a larger blob that appears elsewhere is found.
+        update() returns (mask, centroid) like getCentroid. The masks come from a small ring of reused buffers, so a
+        mask stays valid for the next buffers - 1 calls. With a BufferPool (see masks.py) the labels are written in a
+        reused buffer too, as large as the frame, whose first rows * columns values hold the labels of the window.
+    """
+
+    def __init__(self, margin=40, rescan_every=30, connectivity=4, buffers=3):
+        self.margin = margin
+        self.rescan_every = rescan_every
+        self.connectivity = connectivity
+
+        # State of the tracked blob
+        self.centroid = None
+        self.velocity = np.zeros(2)
+        self.half_size = np.zeros(2)
+        self.frames_since_scan = 0
+
+        # Reused output masks and the region of each one that was written the last time it was used
+        self.masks = [None] * buffers
+        self.mask_rois = [None] * buffers
+        self.index = 0
+
+        # Counters
+        self.full_scans = 0
+        self.window_scans = 0
+
+    def _label(self, mask_original, x0, y0, x1, y1, pool=None):
+        """
+            Labels a region of the mask and returns the largest blob as (label, labels, stats, centroids), or None.
+            The stats and centroids are converted to frame coordinates.
+        """
+        labels = None
+        if pool is not None:
+            h, w = mask_original.shape[:2]
+            labels = pool.get('window_labels', (h * w,), np.int32)[:(y1 - y0) * (x1 - x0)].reshape(y1 - y0, x1 - x0)
+        num_labels, labels, stats, centroids = cv2.connectedComponentsWithStats(mask_original[y0:y1, x0:x1],
+                                                                              labels=labels,
+                                                                              connectivity=self.connectivity,
+                                                                              ltype=cv2.CV_32S)
+        if num_labels < 2:
+            return None
+
+        # Vectorized search for the largest blob
+        label = 1 + int(np.argmax(stats[1:, cv2.CC_STAT_AREA]))
+        stats[:, cv2.CC_STAT_LEFT] += x0
+        stats[:, cv2.CC_STAT_TOP] += y0
+        centroids += (x0, y0)
+
+        return label, labels, stats, centroids
+
+    def _predictWindow(self, shape):
+        """
+            Window around the predicted centroid, big enough for the blob, the margin and the last motion.
+        """
+        h, w = shape[:2]
+        predicted = self.centroid + self.velocity
+        half = self.half_size * 2 + self.margin + np.abs(self.velocity)
+
+        x0 = int(max(predicted[0] - half[0], 0))
+        y0 = int(max(predicted[1] - half[1], 0))
+        x1 = int(min(predicted[0] + half[0] + 1, w))
+        y1 = int(min(predicted[1] + half[1] + 1, h))
+
+        return x0, y0, x1, y1
+
+    def update(self, mask_original, pool=None):
+        h, w = mask_original.shape[:2]
+
+        # Next buffer of the ring
+        self.index = (self.index + 1) % len(self.masks)
+        mask = self.masks[self.index]
+        if mask is None or mask.shape != (h, w):
+            mask = self.masks[self.index] = np.zeros((h, w), dtype=bool)
+            self.mask_rois[self.index] = None
+
+        found = None
+        window = (0, 0, w, h)
+
+        # Search around the predicted position first
+        if self.centroid is not None and self.frames_since_scan < self.rescan_every:
+            x0, y0, x1, y1 = self._predictWindow(mask_original.shape)
+            if x1 > x0 and y1 > y0:
+                window = (x0, y0, x1, y1)
+                found = self._label(mask_original, x0, y0, x1, y1, pool)
+                self.window_scans += 1
+
+                # If the blob touches an inner border of the window it may continue outside of it
+                if found is not None:
+                    label, _, stats, _ = found
+                    left, top, bw, bh = stats[label, :4]
+                    if (left == x0 and x0 > 0) or (top == y0 and y0 > 0) or \
+                            (left + bw == x1 and x1 < w) or (top + bh == y1 and y1 < h):
+                        found = None
+
+        # Fall back to a full frame scan
+        if found is None:
+            window = (0, 0, w, h)
+            found = self._label(mask_original, 0, 0, w, h, pool)
+            self.full_scans += 1
+            self.frames_since_scan = 0
+        else:
+            self.frames_since_scan += 1
+
+        # Clear the region of the output mask written the last time it was used
+        if self.mask_rois[self.index] is not None:
+            mask[self.mask_rois[self.index]] = False
+            self.mask_rois[self.index] = None
+
+        if found is None:
+            # Blob lost. As in getCentroid, the mask stays the same, and there is no centroid
+            self.centroid = None
+            self.velocity[:] = 0
+            return mask_original, None
+
+        label, labels, stats, centroids = found
+        centroid = centroids[label].copy()
+
+        # Update the constant velocity model
+        if self.centroid is not None:
+            self.velocity = centroid - self.centroid
+        self.centroid = centroid
+        self.half_size = stats[label, 2:4] / 2
+
+        # Write the blob into the reused mask, only inside the window that was labelled
+        x0, y0, x1, y1 = window
+        roi = self.mask_rois[self.index] = (slice(y0, y1), slice(x0, x1))
+        np.equal(labels, label, out=mask[roi])
+
+        return mask, centroid
+
+    def reset(self):
+        self.centroid = None
+        self.velocity[:] = 0
+
+
+class MarkerTracker:
+    """
+        Finds the blobs of several markers in the image of marker numbers of a MarkerModel, with a single labelling
+        pass for all of them, and keeps a stable id for each blob from frame to frame.
+        Every blob above min_area is a pointer. Its marker is the most common marker number inside it, so two blobs of
+        different colours that touch are one pointer. Pointers are matched to the ones of the last frame of the same
+        marker by nearest centroid, within max_distance pixels, and keep their id while they are missing for up to
+        max_missing frames.
+        update() returns (mask, pointers) with the pointers sorted by id, so the oldest comes first. With a BufferPool
+        the labels and the mask are written in reused buffers.
+    """
+
+    def __init__(self, min_area=100, max_distance=80, max_missing=5, connectivity=4):
+        self.min_area = min_area
+        self.max_distance = max_distance
+        self.max_missing = max_missing
+        self.connectivity = connectivity
+
+        # id -> [marker, centroid, frames missing]
+        self.tracks = {}
+        self.next_id = 0
+
+    def _blobs(self, markers, pool=None):
+        """
+            Labels every marker at once and returns [(marker, centroid, area), ...] for the blobs above min_area.
+        """
+        labels = None if pool is None else pool.get('labels', markers.shape, np.int32)
+        num_labels, labels, stats, centroids = cv2.connectedComponentsWithStats(markers, labels=labels,
+                                                                              connectivity=self.connectivity,
+                                                                              ltype=cv2.CV_32S)
+        blobs = []
+        for label in np.flatnonzero(stats[1:, cv2.CC_STAT_AREA] >= self.min_area) + 1:
+            left, top, bw, bh, area = stats[label]
+
+            # The most common marker number inside the bounding box of the blob
+            window = (slice(top, top + bh), slice(left, left + bw))
+            marker = int(np.argmax(np.bincount(markers[window][labels[window] == label]))) - 1
+            blobs.append((marker, centroids[label], int(area)))
+
+        return blobs
+
+    def update(self, markers, pool=None):
+        blobs = self._blobs(markers, pool)
+
+        # Pairs of (distance, track, blob) of the same marker, matched from the closest
+        pairs = []
+        for track_id, (marker, centroid, _) in self.tracks.items():
+            for index, (blob_marker, blob_centroid, _) in enumerate(blobs):
+                if blob_marker == marker:
+                    distance = float(np.hypot(*(blob_centroid - centroid)))
+                    if distance <= self.max_distance:
+                        pairs.append((distance, track_id, index))
+        pairs.sort()
+
+        matched = {}
+        for _, track_id, index in pairs:
+            if track_id not in matched and index not in matched.values():
+                matched[track_id] = index
+
+        # Tracks not found in this frame are kept for a few frames
+        for track_id in list(self.tracks):
+            if track_id not in matched:
+                self.tracks[track_id][2] += 1
+                if self.tracks[track_id][2] > self.max_missing:
+                    del self.tracks[track_id]
+
+        # New blobs get new ids
+        found = set(matched.values())
+        for index in range(len(blobs)):
+            if index not in found:
+                matched[self.next_id] = index
+                self.next_id += 1
+
+        pointers = []
+        for track_id, index in sorted(matched.items()):
+            marker, centroid, area = blobs[index]
+            self.tracks[track_id] = [marker, centroid, 0]
+            pointers.append(Pointer(track_id, marker, centroid, area))
+
+        mask = None if pool is None else pool.get('pointers', markers.shape, bool)
+        return np.not_equal(markers, 0, out=mask), pointers
+
+    def reset(self):
+        self.tracks = {}